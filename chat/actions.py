@@ -0,0 +1,193 @@
+"""
+Message actions shared by the HTTP views and ChatConsumer: edit,
+delete, react and pin.
+
+Each one checks permissions, writes, and once the transaction commits
+sends the chat group a small delta event (the new text, a tombstone,
+the message's reaction counts, the pin) instead of making clients
+reload the page. The functions are synchronous; the consumer calls
+them through database_sync_to_async.
+
+Reactions also keep ReactionCount, the per-message emoji totals that
+history pages and the reaction deltas are built from. Reactions made
+over a socket are not broadcast one by one: ``reaction_broadcasts``
+sends each changed message's current counts once per window.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+
+from .broadcast import chat_event, group_broadcast_sync
+from .buffers import WriteBehindBuffer
+from .coalesce import REACTION_WINDOW
+from .membership import is_member
+from .models import Message, PinnedMessage, Reaction, ReactionCount
+
+
+MAX_EMOJI_LENGTH = Reaction._meta.get_field("emoji").max_length
+
+
+class ActionError(Exception):
+    pass
+
+
+def reaction_counts(msg):
+    """
+    {emoji: count} for a message, in first-used order, from the
+    ReactionCount rows message_feed prefetches.
+    """
+    return {row.emoji: row.count for row in msg.reaction_counts.all()}
+
+
+def broadcast_delta(chat_id, kind, payload, handler="chat_delta"):
+
+    # numbered once committed, so sequence order is the order clients can see
+    transaction.on_commit(lambda: group_broadcast_sync(
+        f"chat_{chat_id}",
+        chat_event(chat_id, handler, kind, payload, msg_id=payload["id"]),
+    ))
+
+
+class ReactionBroadcasts(WriteBehindBuffer):
+    """
+    Sender side, one per process: ids of messages whose reactions changed
+    here. Every ``interval`` seconds each gets one chat_reactions event
+    with its counts read then, so a burst of N reactions costs one
+    broadcast to the chat rather than N (and one sequence number).
+    """
+
+    def __init__(self, interval=REACTION_WINDOW):
+        super().__init__(interval)
+
+    def push(self, msg_id):
+        self.pending[msg_id] = True
+        self.schedule()
+
+    def write(self, pending):
+
+        chats = dict(Message.objects.filter(id__in=pending).values_list("id", "chat_id"))
+
+        counts = defaultdict(dict)
+        rows = ReactionCount.objects.filter(message_id__in=chats).order_by("id")
+
+        for msg_id, emoji, count in rows.values_list("message_id", "emoji", "count"):
+            counts[msg_id][emoji] = count
+
+        for msg_id, chat_id in chats.items():
+            group_broadcast_sync(f"chat_{chat_id}", chat_event(
+                chat_id, "chat_reactions", "reactions", {"id": msg_id, "reactions": counts[msg_id]}, msg_id=msg_id
+            ))
+
+
+reaction_broadcasts = ReactionBroadcasts()
+
+
+def get_message(user, msg_id, own=False):
+
+    msg = Message.objects.select_related("sender").filter(id=msg_id).first()
+
+    # someone else's message in a chat the user cannot see looks the same as none
+    if msg is None or not is_member(msg.chat_id, user.id):
+        raise ActionError("message not found")
+
+    if own and msg.sender_id != user.id:
+        raise ActionError("only the sender can do that")
+
+    return msg
+
+
+@transaction.atomic
+def edit_message(user, msg_id, text):
+
+    text = (text or "").strip()
+
+    if not text:
+        raise ActionError("empty message")
+
+    msg = get_message(user, msg_id, own=True)
+
+    if msg.is_deleted:
+        raise ActionError("message is deleted")
+
+    msg.text = text
+    msg.edited = True
+    msg.save()
+
+    broadcast_delta(msg.chat_id, "edit", {"id": msg.id, "message": msg.text, "edited": True})
+
+    return msg
+
+
+@transaction.atomic
+def delete_message(user, msg_id):
+
+    msg = get_message(user, msg_id, own=True)
+
+    msg.is_deleted = True
+
+    # releases the file, gc_media removes it once nothing else points at it
+    msg.file = None
+    msg.audio = None
+    msg.save()
+
+    broadcast_delta(msg.chat_id, "delete", {"id": msg.id})
+
+    return msg
+
+
+@transaction.atomic
+def react(user, msg_id, emoji, remove=False, broadcast=True):
+    """
+    Add or remove a reaction, returns the message's counts. Callers on the
+    event loop pass ``broadcast=False`` and push the id to
+    ``reaction_broadcasts`` once this returns.
+    """
+
+    if not emoji or len(emoji) > MAX_EMOJI_LENGTH:
+        raise ActionError("bad emoji")
+
+    msg = get_message(user, msg_id)
+
+    totals = ReactionCount.objects.filter(message=msg, emoji=emoji)
+
+    if remove:
+        if Reaction.objects.filter(message=msg, user=user, emoji=emoji).delete()[0]:
+            totals.update(count=F("count") - 1)
+            totals.filter(count__lte=0).delete()
+    else:
+        _, created = Reaction.objects.get_or_create(message=msg, user=user, emoji=emoji)
+
+        if created:
+            # the row is locked by the update until commit, concurrent reactions queue up on it
+            ReactionCount.objects.get_or_create(message=msg, emoji=emoji)
+            totals.update(count=F("count") + 1)
+
+    counts = dict(ReactionCount.objects.filter(message=msg).order_by("id").values_list("emoji", "count"))
+
+    if broadcast:
+        broadcast_delta(msg.chat_id, "reactions", {"id": msg.id, "reactions": counts}, handler="chat_reactions")
+
+    return counts
+
+
+@transaction.atomic
+def pin_message(user, msg_id, unpin=False):
+
+    msg = get_message(user, msg_id)
+
+    if unpin:
+        PinnedMessage.objects.filter(chat_id=msg.chat_id, message=msg).delete()
+        payload = {"id": None}
+    else:
+        PinnedMessage.objects.update_or_create(chat_id=msg.chat_id, defaults={"message": msg})
+        payload = {
+            "id": msg.id,
+            "username": msg.sender.username,
+            "message": "" if msg.is_deleted else msg.text,
+        }
+
+    broadcast_delta(msg.chat_id, "pin", payload)
+
+    return msg
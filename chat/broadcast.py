@@ -0,0 +1,82 @@
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from .protocol import encode_all
+
+
+def group_event(handler, kind, payload, **extra):
+    """
+    Build a channel-layer event whose wire payload is already encoded for
+    every protocol. Recipients only pick their encoding and forward it;
+    ``extra`` carries the few raw fields a recipient needs to decide
+    whether or how to deliver it (ids for read acks, who sent it).
+    """
+
+    return {"type": handler, "frames": encode_all(kind, payload), **extra}
+
+
+def seq_key(chat_id):
+    return f"chat:seq:{chat_id}"
+
+
+def next_seq(chat_id, count=1):
+    """
+    Reserve ``count`` sequence numbers for the chat, returns the last one.
+    """
+
+    key = seq_key(chat_id)
+
+    try:
+        return cache.incr(key, count)
+    except ValueError:
+        cache.add(key, 0, None)
+        return cache.incr(key, count)
+
+
+def assign_seqs(messages):
+    """
+    Set ``msg.seq`` on new messages in order, one reservation per chat.
+    """
+
+    last = {chat_id: next_seq(chat_id, count) for chat_id, count in Counter(m.chat_id for m in messages).items()}
+
+    for msg in reversed(messages):
+        msg.seq = last[msg.chat_id]
+        last[msg.chat_id] -= 1
+
+
+def current_seq(chat_id):
+    return cache.get(seq_key(chat_id)) or 0
+
+
+def chat_event(chat_id, handler, kind, payload, seq=None, **extra):
+    """
+    group_event for events a reconnecting socket must not miss: the
+    payload carries the chat's next sequence number (or ``seq``, reserved
+    earlier), see chat/replay.py.
+    """
+
+    if seq is None:
+        seq = next_seq(chat_id)
+
+    return group_event(handler, kind, {**payload, "seq": seq}, seq=seq, chat_id=int(chat_id), **extra)
+
+
+def message_event(msg, username, text=None, seq=None):
+
+    time = msg.timestamp.strftime("%H:%M")
+
+    return chat_event(msg.chat_id, "chat_message", "message", {
+        "id": msg.id,
+        "username": username,
+        "message": msg.text if text is None else text,
+        "time": time,
+        "edited": False
+    }, seq=seq, msg_id=msg.id, username=username)
+
+
+def group_broadcast_sync(group, event):
+    async_to_sync(get_channel_layer().group_send)(group, event)
@@ -0,0 +1,55 @@
+import asyncio
+
+from channels.db import database_sync_to_async
+
+
+class WriteBehindBuffer:
+    """
+    Base for in-memory buffers that are written to the database in bulk.
+
+    Subclasses fill ``self.pending`` from the event loop, call
+    ``self.schedule()`` and implement ``write(pending)``, which runs in the
+    database thread pool at most once per ``interval`` seconds.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self._task = None
+
+    def schedule(self):
+
+        loop = asyncio.get_running_loop()
+
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+        if not self.pending:
+            return
+
+        # swap before handing off, entries arriving meanwhile go to the next batch
+        pending, self.pending = self.pending, {}
+
+        await database_sync_to_async(self.write)(pending)
+
+    def flush_now(self):
+        """
+        Write what is pending from synchronous code, e.g. at process exit.
+        """
+
+        pending, self.pending = self.pending, {}
+
+        if pending:
+            self.write(pending)
+
+    def write(self, pending):
+        raise NotImplementedError
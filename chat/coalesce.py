@@ -0,0 +1,44 @@
+import asyncio
+
+from django.conf import settings
+
+
+REACTION_WINDOW = getattr(settings, "CHAT_REACTION_WINDOW", 0.25)
+
+
+class LatestFrames:
+    """
+    Receiver side, one per socket: holds frames that replace each other
+    (a message's reaction counts) and every ``window`` seconds sends the
+    newest one per key, so a burst of reactions on a message is a single
+    frame to the client however many users took part.
+    """
+
+    def __init__(self, send, window=REACTION_WINDOW):
+        self.send = send
+        self.window = window
+        self.pending = {}
+        self._timer = None
+
+    def push(self, key, frame):
+
+        self.pending[key] = frame
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush(self):
+
+        self._timer = None
+        frames, self.pending = list(self.pending.items()), {}
+
+        asyncio.get_running_loop().create_task(self._send_all(frames))
+
+    async def _send_all(self, frames):
+        for key, frame in frames:
+            await self.send(key, frame)
@@ -1,18 +1,315 @@
-import json
 from django.utils import timezone
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
-from .models import Message, Chat
+from .receipts import read_receipts
+from .unread import get_unread, reset_unread
+from .history import history_page, serialize_message
+from .membership import is_member, local_members
+from .presence import presence
+from .ingest import ingest
+from .typing import TypingSnapshot, typing_throttle
+from .coalesce import LatestFrames
+from .outbox import MAX_BATCH, Outbox
+from .protocol import negotiate
+from .broadcast import current_seq, group_event, message_event
+from .replay import missed_messages, replay_buffer
+from . import actions
+
+
+# WS action name -> (service function, extra arguments taken from the frame)
+ACTIONS = {
+    "edit": (actions.edit_message, ("text",)),
+    "delete": (actions.delete_message, ()),
+    "react": (lambda user, msg_id, emoji: actions.react(user, msg_id, emoji, broadcast=False), ("emoji",)),
+    "unreact": (lambda user, msg_id, emoji: actions.react(user, msg_id, emoji, remove=True, broadcast=False),
+                ("emoji",)),
+    "pin": (actions.pin_message, ()),
+    "unpin": (lambda user, msg_id: actions.pin_message(user, msg_id, unpin=True), ()),
+}
+
+# broadcast by this worker once per window, see actions.ReactionBroadcasts
+COALESCED = {"react", "unreact"}
+
+
+class SocketConsumer(AsyncWebsocketConsumer):
+    """
+    What ChatConsumer (one chat per socket) and UserConsumer (all of a
+    user's chats on one socket) share: the outbound queue, presence and
+    the frames a client sends for a chat. ``wrap_event`` is where they
+    differ, UserConsumer tags every chat event with its chat id.
+    """
+
+    def open_outbox(self):
+
+        self.codec = negotiate(self.scope.get("subprotocols"))
+        self.outbox = Outbox(self.write_events, self.drop_slow_socket, batch=MAX_BATCH if self.codec.batches else 1)
+        self.reactions = LatestFrames(self.send_reactions)
+        self.last_unread = {}
+
+    def close_outbox(self):
+
+        self.reactions.close()
+        self.outbox.close()
+
+    async def handle_chat_frame(self, chat_id, data):
+        """
+        A frame from the client for ``chat_id``, which the caller has
+        checked the user is in.
+        """
 
+        reply_id = data.get("reply_to")
+
+        # HISTORY PAGE (only to the requesting socket)
+        if data.get("action") == "load_older":
+
+            try:
+                before = int(data.get("before") or 0)
+            except (TypeError, ValueError):
+                return
+
+            messages, next_cursor = await self.load_older(chat_id, before)
+
+            await self.emit_chat(chat_id, "history", {
+                "history": messages,
+                "next_cursor": next_cursor
+            })
+
+            return
+
+        # RECONNECT: what was broadcast since the last event the client saw
+        if data.get("action") == "resume":
+
+            try:
+                seq = int(data.get("seq") or 0)
+                last_id = int(data.get("last_id") or 0)
+            except (TypeError, ValueError):
+                return
+
+            await self.resume(chat_id, seq, last_id)
+
+            return
+
+        # EDIT / DELETE / REACT / PIN, the delta comes back through the group
+        if data.get("action") in ACTIONS:
+            msg_id = await self.run_action(data)
+
+            if msg_id is not None and data["action"] in COALESCED:
+                actions.reaction_broadcasts.push(msg_id)
+
+            return
+
+        # TYPING EVENT (rate limited per user, coalesced by each recipient)
+        if data.get("typing"):
+
+            if not typing_throttle.allow(chat_id, self.user.id):
+                return
+
+            await self.channel_layer.group_send(
+                f"chat_{chat_id}",
+                {
+                    "type": "typing_message",
+                    "chat_id": chat_id,
+                    "username": self.user.username
+                }
+            )
+
+            return
+
+        # MESSAGE EVENT
+        message = data.get("message")
+
+        if not message:
+            return
+
+        msg = await self.save_message(chat_id, message, reply_id)
+
+        # encoded once here for every wire format, not once per recipient
+        await self.channel_layer.group_send(
+            f"chat_{chat_id}",
+            message_event(msg, self.user.username, seq=msg.seq)
+        )
+
+    async def send_reactions(self, msg_id, frame):
+        await self.emit_encoded(frame, "reactions", ("reactions", msg_id))
+
+    async def resume(self, chat_id, seq, last_id):
+
+        events = replay_buffer.since(chat_id, seq)
+
+        if events is not None:
+            # through the handlers, as if they had arrived just now
+            for event in events:
+                await getattr(self, event["type"])(event)
+            return
+
+        # not (or no longer) in this worker's buffer, the messages are in the database
+        messages, latest, complete = await self.load_missed(chat_id, last_id)
+
+        await self.emit_chat(chat_id, "replay", {
+            "messages": messages,
+            "seq": latest,
+            "complete": complete
+        })
+
+    async def presence_update(self, event):
+
+        if event["user_id"] == self.user.id:
+            return
+
+        await self.emit_encoded(event["frames"][self.codec.key], "presence", ("presence", event["user_id"]))
+
+    async def broadcast_presence(self, online):
+
+        # deltas go to every chat the user is in, not only this one
+        event = group_event("presence_update", "presence", {
+            "user_id": self.user.id,
+            "online": online,
+            "last_seen": None if online else timezone.now().strftime("%H:%M")
+        }, user_id=self.user.id)
+
+        for chat_id in await self.get_chat_ids():
+            await self.channel_layer.group_send(f"chat_{chat_id}", event)
+
+    async def send_unread_count(self, chat_id):
+        # cache first, then the ChatReadState row, in one hop off the event loop
+        await self.push_unread(chat_id, await self.get_unread_count(chat_id))
+
+    async def clear_unread(self, chat_id):
+        # the client shows the chat, so nothing in it is unread
+        await self.reset_unread_count(chat_id)
+        await self.push_unread(chat_id, 0)
+
+    async def push_unread(self, chat_id, count):
 
-class ChatConsumer(AsyncWebsocketConsumer):
+        # personalised side payload, only sent when it changes
+        if count == self.last_unread.get(chat_id):
+            return
+
+        self.last_unread[chat_id] = count
+
+        await self.emit_chat(chat_id, "unread", {
+            "unread_count": count
+        }, key=("unread", chat_id))
+
+    # =========================
+    # OUTBOUND FRAMES
+    # =========================
+
+    def wrap_event(self, chat_id, event):
+        return event
+
+    async def emit(self, kind, payload, key=None):
+        await self.emit_encoded(self.codec.encode_event(kind, payload), kind, key)
+
+    async def emit_chat(self, chat_id, kind, payload, key=None):
+        await self.emit_encoded(self.wrap_event(chat_id, self.codec.encode_event(kind, payload)), kind, key)
+
+    async def emit_encoded(self, event, kind, key=None):
+        # queued, never awaited here: a slow client must not stall the channel layer
+        self.outbox.put(event, kind, key)
+
+    def client_ack(self, data):
+        """
+        Flow control frames, see chat/outbox.py; True if ``data`` was one.
+        """
+
+        if data.get("action") != "ack":
+            return False
+
+        try:
+            self.outbox.ack(int(data.get("frames") or 0))
+        except (TypeError, ValueError):
+            pass
+
+        return True
+
+    async def write_events(self, events):
+        # one frame per call, the outbox counts them against the ack window
+        await self.send_frame(self.codec.frame(events))
+
+    async def drop_slow_socket(self):
+        # chat.js reconnects and resumes from the replay buffer
+        await self.close(code=4008)
+
+    async def send_frame(self, frame):
+
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    # =========================
+    # DATABASE METHODS
+    # =========================
+
+    async def save_message(self, chat_id, text, reply_id=None):
+
+        try:
+            reply_id = int(reply_id) if reply_id else None
+        except (TypeError, ValueError):
+            reply_id = None
+
+        # batched with other consumers' messages, see chat/ingest.py
+        return await ingest.submit(chat_id, self.user.id, text, reply_id)
+
+    @database_sync_to_async
+    def load_missed(self, chat_id, last_id):
+
+        # read first: an event racing the query is sent twice, never skipped
+        latest = current_seq(chat_id)
+
+        messages, complete = missed_messages(chat_id, last_id)
+
+        return [serialize_message(m) for m in messages], latest, complete
+
+    @database_sync_to_async
+    def run_action(self, data):
+        """
+        Returns the message id once the action has committed, else None.
+        """
+
+        action, fields = ACTIONS[data["action"]]
+
+        try:
+            msg_id = int(data.get("id"))
+            action(self.user, msg_id, *(data.get(field) for field in fields))
+        except (TypeError, ValueError, actions.ActionError):
+            # bad or forbidden requests are dropped, like malformed frames
+            return None
+
+        return msg_id
+
+    @database_sync_to_async
+    def load_older(self, chat_id, before):
+
+        messages, next_cursor = history_page(chat_id, before=before)
+
+        return [serialize_message(m) for m in messages], next_cursor
+
+    @database_sync_to_async
+    def get_chat_ids(self):
+
+        return list(self.user.chats.values_list("id", flat=True))
+
+    @database_sync_to_async
+    def get_unread_count(self, chat_id):
+
+        return get_unread(chat_id, self.user.id)
+
+    @database_sync_to_async
+    def reset_unread_count(self, chat_id):
+
+        reset_unread(chat_id, self.user.id)
+
+
+class ChatConsumer(SocketConsumer):
 
     async def connect(self):
 
         self.user = self.scope["user"]
-        self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
+        self.chat_id = int(self.scope["url_route"]["kwargs"]["chat_id"])
 
         if self.user.is_anonymous:
             await self.close()
@@ -32,143 +329,291 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        self.typing = TypingSnapshot(self.send_typing)
+        self.open_outbox()
+
+        await self.accept(subprotocol=self.codec.name)
 
-        # set online
-        await self.set_online(True)
+        # online only on the user's first socket across all workers
+        if await presence.connect(self.user.id):
+            await self.broadcast_presence(True)
 
     async def disconnect(self, close_code):
 
-        await self.set_online(False)
+        # rejected in connect, nothing was registered
+        if not hasattr(self, "room_group_name"):
+            return
+
+        self.typing.close()
+        self.close_outbox()
+
+        if await presence.disconnect(self.user.id):
+            await self.broadcast_presence(False)
 
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
 
-        data = json.loads(text_data)
+        data = self.codec.decode(text_data, bytes_data)
 
-        reply_id = data.get("reply_to")
+        presence.heartbeat(self.user.id)
 
-        # TYPING EVENT
-        if data.get("typing"):
+        if self.client_ack(data):
+            return
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing_message",
-                    "username": self.user.username
-                }
-            )
+        await self.handle_chat_frame(self.chat_id, data)
+
+    async def chat_message(self, event):
+        replay_buffer.record(self.chat_id, event)
+
+        self.typing.stopped(event["username"])
+
+        read_receipts.ack(self.chat_id, self.user.id, event["msg_id"])
+
+        await self.clear_unread(self.chat_id)
 
+        await self.emit_encoded(event["frames"][self.codec.key], "message")
+
+    async def chat_delta(self, event):
+        replay_buffer.record(self.chat_id, event)
+
+        await self.emit_encoded(event["frames"][self.codec.key], "delta")
+
+    async def chat_reactions(self, event):
+        replay_buffer.record(self.chat_id, event)
+
+        # each frame carries the full counts, only the newest per message matters
+        self.reactions.push(event["msg_id"], event["frames"][self.codec.key])
+
+    async def typing_message(self, event):
+
+        if event["username"] == self.user.username:
             return
 
-        # MESSAGE EVENT
-        message = data.get("message")
+        self.typing.typing(event["username"])
 
-        if not message:
+    async def send_typing(self, usernames):
+
+        await self.emit("typing", {
+            "typing_users": usernames
+        }, key="typing")
+
+    @database_sync_to_async
+    def is_chat_member(self):
+
+        return is_member(self.chat_id, self.user.id)
+
+
+class UserConsumer(SocketConsumer):
+    """
+    One socket for all of a user's chats (``ws/user/``), for the chat
+    list and clients with several chats open.
+
+    Connecting subscribes to every chat the user is in, found with one
+    query, plus the personal ``user_<id>`` group that announces chats
+    joined or left. Chat events go out wrapped with their chat id (see
+    ``wrap`` in chat/protocol.py); frames from the client carry a
+    ``chat_id`` and otherwise look like ChatConsumer's, with
+    ``subscribe`` / ``unsubscribe`` / ``read`` actions on top. Only
+    messages of the chats the client marks read count as read.
+    """
+
+    async def connect(self):
+
+        self.user = self.scope["user"]
+
+        if self.user.is_anonymous:
+            await self.close()
             return
 
-        msg = await self.save_message(message, reply_id)
+        self.user_group_name = f"user_{self.user.id}"
+        self.chats = set()
+        self.typing = {}
+        self.seen_presence = {}
+        self.open_outbox()
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "msg_id": msg.id,
-                "username": self.user.username,
-                "message": msg.text,
-                "time": msg.timestamp.strftime("%H:%M"),
-            }
-        )
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
 
-    async def chat_message(self, event):
-        await self.mark_read(event["msg_id"])
-        await self.send_unread_count()
+        for chat_id in await self.load_chats():
+            await self.subscribe(chat_id)
 
-        await self.send(text_data=json.dumps({
-            "id": event["msg_id"],
-            "username": event["username"],
-            "message": event["message"],
-            "edited": False
-        }))
+        await self.accept(subprotocol=self.codec.name)
 
-    async def typing_message(self, event):
+        if await presence.connect(self.user.id):
+            await self.broadcast_presence(True)
+
+    async def disconnect(self, close_code):
+
+        if not hasattr(self, "user_group_name"):
+            return
+
+        for snapshot in self.typing.values():
+            snapshot.close()
+
+        self.close_outbox()
+
+        if await presence.disconnect(self.user.id):
+            await self.broadcast_presence(False)
+
+        for chat_id in list(self.chats):
+            await self.unsubscribe(chat_id)
+
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+
+        data = self.codec.decode(text_data, bytes_data)
 
-        await self.send(text_data=json.dumps({
-            "typing": True,
-            "username": event["username"]
-        }))
+        presence.heartbeat(self.user.id)
+
+        if self.client_ack(data):
+            return
+
+        try:
+            chat_id = int(data.get("chat_id") or 0)
+        except (TypeError, ValueError):
+            return
+
+        action = data.get("action")
+
+        if action == "subscribe":
+            if chat_id not in self.chats and await self.is_chat_member(chat_id):
+                await self.subscribe(chat_id)
+            return
+
+        if action == "unsubscribe":
+            await self.unsubscribe(chat_id)
+            return
+
+        # SECURITY: only chats this socket is subscribed to, all checked members
+        if chat_id not in self.chats:
+            return
+
+        if action == "read":
+
+            try:
+                msg_id = int(data.get("id") or 0)
+            except (TypeError, ValueError):
+                return
+
+            read_receipts.ack(chat_id, self.user.id, msg_id)
+
+            await self.clear_unread(chat_id)
+
+            return
+
+        await self.handle_chat_frame(chat_id, data)
+
+    async def subscribe(self, chat_id):
+
+        self.chats.add(chat_id)
+
+        await self.channel_layer.group_add(f"chat_{chat_id}", self.channel_name)
+
+    async def unsubscribe(self, chat_id):
+
+        if chat_id not in self.chats:
+            return
+
+        self.chats.discard(chat_id)
+
+        snapshot = self.typing.pop(chat_id, None)
+        if snapshot is not None:
+            snapshot.close()
+
+        await self.channel_layer.group_discard(f"chat_{chat_id}", self.channel_name)
+
+    def wrap_event(self, chat_id, event):
+        return self.codec.wrap(chat_id, event)
 
     # =========================
-    # DATABASE METHODS
+    # GROUP EVENTS
     # =========================
 
-    @database_sync_to_async
-    def save_message(self, text, reply_id=None):
+    async def chat_message(self, event):
 
-        chat = Chat.objects.get(id=self.chat_id)
+        chat_id = event["chat_id"]
+        replay_buffer.record(chat_id, event)
 
-        reply_msg = None
-        if reply_id:
-            reply_msg = Message.objects.get(id=reply_id)
+        if chat_id in self.typing:
+            self.typing[chat_id].stopped(event["username"])
 
-        return Message.objects.create(
-            chat=chat,
-            sender=self.user,
-            text=text,
-            reply_to=reply_msg,
-        )
+        await self.emit_encoded(self.wrap_event(chat_id, event["frames"][self.codec.key]), "message")
 
-    @database_sync_to_async
-    def set_online(self, status):
+        if event["username"] != self.user.username:
+            await self.send_unread_count(chat_id)
 
-        profile = self.user.profile
-        profile.online = status
+    async def chat_delta(self, event):
+        replay_buffer.record(event["chat_id"], event)
 
-        if not status:
-            profile.last_seen = timezone.now()
+        await self.emit_encoded(self.wrap_event(event["chat_id"], event["frames"][self.codec.key]), "delta")
 
-        profile.save()
+    async def chat_reactions(self, event):
+        replay_buffer.record(event["chat_id"], event)
 
-    @database_sync_to_async
-    def mark_read(self, msg_id):
+        self.reactions.push(event["msg_id"], self.wrap_event(event["chat_id"], event["frames"][self.codec.key]))
 
-        msg = Message.objects.get(id=msg_id)
-        msg.is_read = True
-        msg.save()
+    async def typing_message(self, event):
 
-    @database_sync_to_async
-    def is_chat_member(self):
+        if event["username"] == self.user.username:
+            return
 
-        chat = Chat.objects.get(id=self.chat_id)
+        chat_id = event["chat_id"]
 
-        return self.user in chat.participants.all()
+        if chat_id not in self.typing:
+            self.typing[chat_id] = TypingSnapshot(lambda usernames: self.send_typing(chat_id, usernames))
 
-    @database_sync_to_async
-    def mark_chat_read(self):
+        self.typing[chat_id].typing(event["username"])
+
+    async def send_typing(self, chat_id, usernames):
 
-        Message.objects.filter(
-            chat_id=self.chat_id,
-            is_read=False
-        ).exclude(sender=self.user).update(is_read=True)
+        await self.emit_chat(chat_id, "typing", {
+            "typing_users": usernames
+        }, key=("typing", chat_id))
 
+    async def presence_update(self, event):
+
+        # the same change arrives once through every chat shared with that user
+        if self.seen_presence.get(event["user_id"]) == event["frames"]["legacy"]:
+            return
+
+        self.seen_presence[event["user_id"]] = event["frames"]["legacy"]
+
+        await super().presence_update(event)
+
+    async def membership_update(self, event):
+
+        chat_id = event["chat_id"]
+
+        if event["member"]:
+            await self.subscribe(chat_id)
+        else:
+            await self.unsubscribe(chat_id)
+
+        await self.emit("membership", {
+            "chat_id": chat_id,
+            "member": event["member"]
+        })
+
+    # =========================
+    # DATABASE METHODS
+    # =========================
 
     @database_sync_to_async
-    def get_unread_count(self):
+    def load_chats(self):
 
-        return Message.objects.filter(
-            chat_id=self.chat_id,
-            is_read=False
-        ).exclude(sender=self.user).count()
+        chat_ids = list(self.user.chats.values_list("id", flat=True))
 
+        # the membership checks of later frames are answered from here
+        for chat_id in chat_ids:
+            local_members.set((chat_id, self.user.id), True)
 
-    async def send_unread_count(self):
+        return chat_ids
 
-        count = await self.get_unread_count()
+    @database_sync_to_async
+    def is_chat_member(self, chat_id):
 
-        await self.send(text_data=json.dumps({
-            "unread_count": count
-        }))
+        return is_member(chat_id, self.user.id)
@@ -0,0 +1,88 @@
+"""
+Prefix search over user names and group chat names.
+
+Every user and group chat has a DirectoryEntry row holding its name
+normalized to NFKC + casefold. A prefix lookup is a range scan on the
+(kind, key) index: key >= prefix AND key < prefix + U+10FFFF, which
+reads only the first ``limit`` matching index entries instead of
+scanning the table like ``icontains`` does.
+"""
+
+import unicodedata
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from .models import Chat, DirectoryEntry
+
+
+LIMIT = getattr(settings, "CHAT_DIRECTORY_LIMIT", 10)
+
+# sorts after every character a key can contain
+HIGHEST = "\U0010ffff"
+
+
+def normalize(name):
+    return unicodedata.normalize("NFKC", name).casefold()
+
+
+def user_entry(user):
+    return DirectoryEntry(kind="user", object_id=user.pk, key=normalize(user.username), label=user.username)
+
+
+def group_entry(chat):
+    return DirectoryEntry(kind="group", object_id=chat.pk, key=normalize(chat.name), label=chat.name)
+
+
+def save_entries(entries):
+    DirectoryEntry.objects.bulk_create(
+        entries,
+        update_conflicts=True,
+        unique_fields=["kind", "object_id"],
+        update_fields=["key", "label"],
+    )
+
+
+def remove_entry(kind, object_id):
+    DirectoryEntry.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def lookup(kind, prefix, limit=LIMIT, exclude=None):
+    """
+    Return up to ``limit`` (object_id, label) pairs whose name starts
+    with ``prefix``, shortest match first among equal prefixes.
+    """
+
+    key = normalize(prefix)
+
+    if not key:
+        return []
+
+    entries = DirectoryEntry.objects.filter(kind=kind, key__gte=key, key__lt=key + HIGHEST)
+
+    if exclude is not None:
+        entries = entries.exclude(object_id=exclude)
+
+    return list(entries.order_by("key").values_list("object_id", "label")[:limit])
+
+
+def autocomplete(prefix, user_id=None, limit=LIMIT):
+
+    return {
+        "users": [
+            {"id": object_id, "username": label}
+            for object_id, label in lookup("user", prefix, limit, exclude=user_id)
+        ],
+        "groups": [
+            {"id": object_id, "name": label}
+            for object_id, label in lookup("group", prefix, limit)
+        ],
+    }
+
+
+def rebuild():
+
+    DirectoryEntry.objects.all().delete()
+
+    save_entries([user_entry(user) for user in User.objects.only("id", "username").iterator()])
+    save_entries([group_entry(chat) for chat in Chat.objects.filter(type="group").only("id", "name").iterator()])
@@ -0,0 +1,92 @@
+from django.contrib.auth.models import User
+from django.db.models import F, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Chat, ChatReadState, Message, ReactionCount
+
+
+def participants_prefetch():
+    return Prefetch("participants", queryset=User.objects.select_related("profile"))
+
+
+def get_chat(chat_id):
+    """
+    Load a chat with everything chat.html touches per participant.
+    """
+
+    return Chat.objects.select_related(
+        "pinnedmessage__message__sender"
+    ).prefetch_related(
+        participants_prefetch()
+    ).get(id=chat_id)
+
+
+def message_feed(chat_id):
+    """
+    Messages of a chat with sender, reply and reaction totals loaded up
+    front, so rendering a page costs the same number of queries at any size.
+    """
+
+    return Message.objects.filter(chat_id=chat_id).select_related(
+        "sender__profile",
+        "reply_to__sender",
+    ).prefetch_related(
+        Prefetch("reaction_counts", queryset=ReactionCount.objects.order_by("id"))
+    )
+
+
+def user_chats(user):
+    """
+    The user's chats, most recently active first, in one query: the last
+    message comes from the denormalized Chat.last_message and the unread
+    count from the user's ChatReadState row.
+    """
+
+    unread = ChatReadState.objects.filter(chat=OuterRef("pk"), user=user).values("unread_count")[:1]
+
+    return user.chats.select_related(
+        "last_message__sender"
+    ).annotate(
+        unread=Coalesce(Subquery(unread), 0),
+        activity=Coalesce("last_activity_at", "created_at"),
+    ).order_by(
+        F("activity").desc(), "-id"
+    )
+
+
+def serialize_chat(chat):
+
+    last = chat.last_message
+
+    return {
+        "id": chat.id,
+        "name": chat.name,
+        "type": chat.type,
+        "unread": chat.unread,
+        "activity": chat.activity.isoformat(),
+        "last_message": last and {
+            "id": last.id,
+            "username": last.sender.username,
+            "message": "" if last.is_deleted else last.text,
+            "deleted": last.is_deleted,
+            "time": last.timestamp.strftime("%H:%M"),
+        },
+    }
+
+
+def record_activity(messages):
+    """
+    Move Chat.last_message forward for a batch of new messages, one
+    UPDATE per chat. The id guard keeps a slower writer from moving it back.
+    """
+
+    newest = {}
+    for msg in messages:
+        if msg.chat_id not in newest or msg.id > newest[msg.chat_id].id:
+            newest[msg.chat_id] = msg
+
+    for chat_id, msg in newest.items():
+        Chat.objects.filter(
+            Q(last_message__isnull=True) | Q(last_message_id__lt=msg.id),
+            id=chat_id,
+        ).update(last_message=msg, last_activity_at=msg.timestamp)
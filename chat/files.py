@@ -0,0 +1,318 @@
+"""
+ASGI file serving for STATIC_URL and MEDIA_URL.
+
+FileServer sits in front of the Django ASGI app and answers GET/HEAD
+for static and media files itself:
+
+* ETag / Last-Modified from the file's stat, with 304 for
+  If-None-Match / If-Modified-Since;
+* single byte ranges (206, 416, If-Range), which <audio> needs to seek;
+* the body goes out through the server's ``http.response.pathsend`` or
+  ``http.response.zerocopysend`` extension when it offers one, and
+  otherwise in blocks read on a worker thread;
+* hashed static names (HashedStaticStorage) and content-addressed media
+  blobs are immutable and cached for a year.
+
+Media is only served to logged-in users, and a file attached to a
+message only to members of a chat it was posted in.
+"""
+
+import mimetypes
+import os
+import re
+import stat
+
+from asgiref.sync import sync_to_async
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.core.exceptions import SuspiciousFileOperation
+from django.db.models import Q
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+
+from .membership import is_member
+from .models import Blob, Message
+from .storage import is_blob
+
+
+BLOCK_SIZE = 256 * 1024
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# name.0123456789ab.css, as written by ManifestStaticFilesStorage
+HASHED_STATIC_RE = re.compile(r"\.[0-9a-f]{12}\.[^./]+$")
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# user uploads of any other type are downloaded, never rendered by the browser
+INLINE_TYPES = ("image/", "audio/", "video/")
+
+
+def can_read_media(user, name):
+
+    if not user.is_authenticated:
+        return False
+
+    # avatars and their thumbnails are visible to everyone logged in
+    if name.startswith("avatars/") or Blob.objects.filter(name=name, public=True).exists():
+        return True
+
+    chat_ids = Message.objects.filter(Q(file=name) | Q(audio=name)).values_list("chat_id", flat=True).distinct()
+
+    return any(is_member(chat_id, user.id) for chat_id in chat_ids)
+
+
+def parse_range(header, size):
+    """
+    Return (start, end) inclusive for a single "bytes=" range, None to
+    send the whole file, or False when the range cannot be satisfied.
+    """
+
+    match = RANGE_RE.match(header.strip())
+
+    # malformed or multipart ranges: ignoring the header is allowed
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+
+    if first == "":
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        return False
+
+    return start, end
+
+
+def etag_matches(header, etag):
+
+    if header.strip() == "*":
+        return True
+
+    # weak comparison, as If-None-Match requires
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+    return etag in tags
+
+
+class FileServer:
+
+    def __init__(self, application):
+        self.application = application
+        self.static_url = "/" + settings.STATIC_URL.strip("/") + "/"
+        self.media_url = "/" + settings.MEDIA_URL.strip("/") + "/"
+        self.media = AuthMiddlewareStack(self.serve_media)
+
+    async def __call__(self, scope, receive, send):
+
+        if scope["type"] == "http":
+            path = scope["path"]
+
+            if path.startswith(self.static_url):
+                return await self.serve_static(scope, receive, send)
+
+            if path.startswith(self.media_url):
+                return await self.media(scope, receive, send)
+
+        return await self.application(scope, receive, send)
+
+    # =========================
+    # LOOKUP
+    # =========================
+
+    def static_path(self, name):
+
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            return None
+
+        if not os.path.isfile(path) and settings.DEBUG:
+            # runserver without collectstatic
+            path = finders.find(name)
+
+        return path
+
+    async def serve_static(self, scope, receive, send):
+
+        name = scope["path"][len(self.static_url):]
+        path = self.static_path(name)
+
+        cache_control = IMMUTABLE if HASHED_STATIC_RE.search(name) else "public, no-cache"
+
+        await self.respond(scope, send, path, cache_control)
+
+    async def serve_media(self, scope, receive, send):
+
+        name = scope["path"][len(self.media_url):]
+
+        try:
+            path = safe_join(settings.MEDIA_ROOT, name)
+        except SuspiciousFileOperation:
+            path = None
+
+        # same answer for "missing" and "not yours", nothing to probe
+        if path is None or not await database_sync_to_async(can_read_media)(scope["user"], name):
+            return await send_plain(send, 404, b"Not Found")
+
+        cache_control = "private, max-age=31536000, immutable" if is_blob(name) else "private, no-cache"
+
+        await self.respond(scope, send, path, cache_control, user_content=True)
+
+    # =========================
+    # RESPONSE
+    # =========================
+
+    async def respond(self, scope, send, path, cache_control, user_content=False):
+
+        method = scope["method"]
+
+        if method not in ("GET", "HEAD"):
+            return await send_plain(send, 405, b"Method Not Allowed", [(b"allow", b"GET, HEAD")])
+
+        try:
+            fh = open(path, "rb") if path else None
+        except OSError:
+            fh = None
+
+        if fh is None:
+            return await send_plain(send, 404, b"Not Found")
+
+        with fh:
+            info = os.fstat(fh.fileno())
+
+            if not stat.S_ISREG(info.st_mode):
+                return await send_plain(send, 404, b"Not Found")
+
+            size = info.st_size
+            etag = f'"{info.st_mtime_ns:x}-{size:x}"'
+            last_modified = http_date(info.st_mtime)
+
+            request = {key.decode().lower(): value.decode("latin-1") for key, value in scope["headers"]}
+
+            content_type, encoding = mimetypes.guess_type(path)
+            content_type = content_type or "application/octet-stream"
+
+            headers = [
+                (b"etag", etag.encode()),
+                (b"last-modified", last_modified.encode()),
+                (b"cache-control", cache_control.encode()),
+                (b"accept-ranges", b"bytes"),
+            ]
+
+            if self.not_modified(request, etag, info.st_mtime):
+                return await send_headers_only(send, 304, headers)
+
+            if content_type.startswith("text/") or content_type in ("application/javascript", "application/json"):
+                content_type += "; charset=utf-8"
+
+            headers.append((b"content-type", content_type.encode()))
+
+            if encoding:
+                headers.append((b"content-encoding", encoding.encode()))
+
+            if user_content:
+                headers.append((b"x-content-type-options", b"nosniff"))
+                if not content_type.startswith(INLINE_TYPES):
+                    headers.append((b"content-disposition", b"attachment"))
+
+            status, start, end = 200, 0, size - 1
+
+            byte_range = None
+            if "range" in request and self.range_applies(request, etag, last_modified):
+                byte_range = parse_range(request["range"], size)
+
+            if byte_range is False:
+                return await send_headers_only(send, 416, [(b"content-range", f"bytes */{size}".encode())])
+
+            if byte_range:
+                status, (start, end) = 206, byte_range
+                headers.append((b"content-range", f"bytes {start}-{end}/{size}".encode()))
+
+            count = end - start + 1
+            headers.append((b"content-length", str(count).encode()))
+
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+
+            if method == "HEAD" or count <= 0:
+                return await send({"type": "http.response.body", "body": b""})
+
+            await self.send_file(scope, send, fh, path, start, count, whole=status == 200)
+
+    def not_modified(self, request, etag, mtime):
+
+        if "if-none-match" in request:
+            return etag_matches(request["if-none-match"], etag)
+
+        if "if-modified-since" in request:
+            since = parse_http_date_safe(request["if-modified-since"])
+            return since is not None and int(mtime) <= since
+
+        return False
+
+    def range_applies(self, request, etag, last_modified):
+
+        # If-Range: only send the part if the client's copy is still current
+        if "if-range" not in request:
+            return True
+
+        return request["if-range"].strip() in (etag, last_modified)
+
+    async def send_file(self, scope, send, fh, path, start, count, whole):
+
+        extensions = scope.get("extensions") or {}
+
+        if whole and "http.response.pathsend" in extensions:
+            return await send({"type": "http.response.pathsend", "path": os.path.abspath(path)})
+
+        if "http.response.zerocopysend" in extensions:
+            return await send({
+                "type": "http.response.zerocopysend",
+                "file": fh,
+                "offset": start,
+                "count": count,
+            })
+
+        read = sync_to_async(os.pread, thread_sensitive=False)
+
+        offset, remaining = start, count
+        while remaining:
+            block = await read(fh.fileno(), min(BLOCK_SIZE, remaining), offset)
+            if not block:
+                break
+            offset += len(block)
+            remaining -= len(block)
+            await send({"type": "http.response.body", "body": block, "more_body": bool(remaining)})
+
+        if remaining:
+            # the file shrank under us, end the response rather than hang
+            await send({"type": "http.response.body", "body": b""})
+
+
+async def send_plain(send, status, body, headers=()):
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", str(len(body)).encode()),
+            *headers,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_headers_only(send, status, headers):
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,55 @@
+from django.conf import settings
+
+from .actions import reaction_counts
+from .feed import message_feed
+
+
+PAGE_SIZE = getattr(settings, "CHAT_HISTORY_PAGE_SIZE", 50)
+MAX_PAGE_SIZE = getattr(settings, "CHAT_HISTORY_MAX_PAGE_SIZE", 200)
+
+
+def history_page(chat_id, before=None, limit=PAGE_SIZE):
+    """
+    Return (messages, next_cursor) for one page of chat history.
+
+    Pages are keyed on message id, newest first in the query and oldest
+    first in the result, so every page is a range scan on (chat, id) no
+    matter how deep the user has scrolled. next_cursor is the id to pass
+    as ``before`` for the page above, or None at the start of the chat.
+    """
+
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    messages = message_feed(chat_id)
+
+    if before:
+        messages = messages.filter(id__lt=before)
+
+    # one extra row tells us whether there is anything older
+    page = list(messages.order_by("-id")[:limit + 1])
+
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = page[-1].id
+
+    page.reverse()
+
+    return page, next_cursor
+
+
+def serialize_message(msg):
+
+    return {
+        "id": msg.id,
+        "username": msg.sender.username,
+        "message": "" if msg.is_deleted else msg.text,
+        "time": msg.timestamp.strftime("%H:%M"),
+        "deleted": msg.is_deleted,
+        "file": msg.file.url if msg.file else None,
+        "file_name": msg.file_name,
+        "audio": msg.audio.url if msg.audio else None,
+        "reply_to": msg.reply_to_id,
+        "edited": msg.edited,
+        "reactions": reaction_counts(msg),
+    }
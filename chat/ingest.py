@@ -0,0 +1,129 @@
+import asyncio
+
+from django.conf import settings
+from django.db import transaction
+from channels.db import database_sync_to_async
+
+from .broadcast import assign_seqs
+from .models import Message
+from .signals import messages_created
+
+
+MAX_BATCH = getattr(settings, "CHAT_INGEST_MAX_BATCH", 100)
+MAX_LATENCY = getattr(settings, "CHAT_INGEST_MAX_LATENCY", 0.005)
+
+
+def write_messages(messages):
+    """
+    Insert a batch of unsaved messages, oldest first, and return them with
+    ids and broadcast sequence numbers (``seq``).
+    """
+
+    # reply targets are checked for the whole batch at once, a reply to a
+    # missing message or one from another chat is dropped instead of failing the batch
+    reply_ids = {m.reply_to_id for m in messages if m.reply_to_id}
+
+    if reply_ids:
+        valid = set(Message.objects.filter(id__in=reply_ids).values_list("id", "chat_id"))
+
+        for msg in messages:
+            if msg.reply_to_id and (msg.reply_to_id, msg.chat_id) not in valid:
+                msg.reply_to_id = None
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        messages_created.send(sender=Message, messages=messages)
+
+    # in this thread, so the broadcast makes no cache round trip on the event loop
+    assign_seqs(messages)
+
+    return messages
+
+
+class MessageIngest:
+    """
+    Collects messages from all consumers of the event loop and writes them
+    with one bulk_create per batch.
+
+    A batch is written when it reaches ``max_batch`` messages or when the
+    first message in it has waited ``max_latency`` seconds. Batches are
+    written one at a time in arrival order, so ids (and therefore
+    history order) follow the order in which messages were submitted.
+    """
+
+    def __init__(self, max_batch=MAX_BATCH, max_latency=MAX_LATENCY):
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = []
+        self._timer = None
+        self._lock = None
+        self._loop = None
+
+    async def submit(self, chat_id, sender_id, text, reply_to_id=None):
+
+        loop = asyncio.get_running_loop()
+
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+
+        future = loop.create_future()
+
+        msg = Message(chat_id=chat_id, sender_id=sender_id, text=text, reply_to_id=reply_to_id)
+        self.queue.append((msg, future))
+
+        if len(self.queue) >= self.max_batch:
+            self._start_batch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_latency, self._start_batch)
+
+        return await future
+
+    def _start_batch(self):
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self.queue = self.queue, []
+
+        if batch:
+            self._loop.create_task(self._write(batch))
+
+    async def _write(self, batch):
+
+        async with self._lock:
+            try:
+                await database_sync_to_async(write_messages)([msg for msg, _ in batch])
+            except Exception as exc:
+                if len(batch) == 1:
+                    self._fail(batch, exc)
+                    return
+
+                # one bad row fails the whole insert, retry the rows one by
+                # one (still in order) so only the offending messages fail
+                for msg, future in batch:
+                    msg.pk = None
+                    msg._state.adding = True
+
+                    try:
+                        await database_sync_to_async(write_messages)([msg])
+                    except Exception as exc:
+                        self._fail([(msg, future)], exc)
+                    else:
+                        if not future.done():
+                            future.set_result(msg)
+                return
+
+        for msg, future in batch:
+            if not future.done():
+                future.set_result(msg)
+
+    def _fail(self, batch, exc):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+
+ingest = MessageIngest()
@@ -0,0 +1,56 @@
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+def _hash(value):
+
+    if isinstance(value, str):
+        value = value.encode("utf8")
+
+    return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+
+def _host_name(host):
+
+    if "address" in host:
+        return str(host["address"])
+
+    if "master_name" in host:
+        return f"sentinel:{host['master_name']}"
+
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer that places groups and channels on a hash ring.
+
+    The stock layer picks a host with crc32 modulo the number of hosts, so
+    adding a Redis host moves almost every ``chat_<id>`` group. With a ring
+    of virtual nodes only about 1/N of the groups move, and every worker
+    process computes the same placement from the same host list.
+    """
+
+    def __init__(self, hosts=None, virtual_nodes=160, **kwargs):
+
+        super().__init__(hosts=hosts, **kwargs)
+
+        ring = sorted(
+            (_hash(f"{_host_name(host)}#{vnode}"), index)
+            for index, host in enumerate(self.hosts)
+            for vnode in range(virtual_nodes)
+        )
+
+        self._ring_keys = [key for key, _ in ring]
+        self._ring_hosts = [index for _, index in ring]
+
+    def consistent_hash(self, value):
+
+        if self.ring_size == 1:
+            return 0
+
+        position = bisect.bisect(self._ring_keys, _hash(value)) % len(self._ring_keys)
+
+        return self._ring_hosts[position]
@@ -0,0 +1,106 @@
+import os
+import statistics
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+
+from chat.history import history_page
+from chat.models import Chat, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure concurrent message-insert throughput against the configured database. "
+        "Run once per CHAT_DB_PROFILE to compare profiles."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--messages", type=int, default=200, help="Messages per writer.")
+        parser.add_argument("--readers", type=int, default=2,
+                            help="Threads paging history while the writers run.")
+
+    def handle(self, *args, writers, messages, readers, **options):
+
+        users = [User.objects.create(username=f"bench-{time.time_ns()}-{i}") for i in range(writers)]
+        chat = Chat.objects.create(name="bench", type="group")
+        chat.participants.add(*users)
+
+        latencies = []
+        errors = []
+        reads = []
+        done = threading.Event()
+        lock = threading.Lock()
+
+        def write(user):
+            mine = []
+            try:
+                for i in range(messages):
+                    started = time.perf_counter()
+                    try:
+                        Message.objects.create(chat_id=chat.id, sender_id=user.id, text=f"bench {i}")
+                    except OperationalError as exc:
+                        with lock:
+                            errors.append(exc)
+                        continue
+                    mine.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+
+            with lock:
+                latencies.extend(mine)
+
+        def read():
+            count = 0
+            try:
+                while not done.is_set():
+                    history_page(chat.id)
+                    count += 1
+            finally:
+                connections.close_all()
+
+            with lock:
+                reads.append(count)
+
+        writer_threads = [threading.Thread(target=write, args=(user,)) for user in users]
+        reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+
+        for thread in reader_threads:
+            thread.start()
+
+        started = time.perf_counter()
+
+        for thread in writer_threads:
+            thread.start()
+        for thread in writer_threads:
+            thread.join()
+
+        elapsed = time.perf_counter() - started
+
+        done.set()
+        for thread in reader_threads:
+            thread.join()
+
+        chat.delete()
+        User.objects.filter(id__in=[u.id for u in users]).delete()
+
+        latencies.sort()
+
+        def percentile(p):
+            if not latencies:
+                return 0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write(f"profile          {os.environ.get('CHAT_DB_PROFILE', 'sqlite')} ({connection.vendor})")
+        self.stdout.write(f"writers          {writers} x {messages}")
+        self.stdout.write(f"inserted         {len(latencies)}")
+        self.stdout.write(f"failed           {len(errors)}")
+        self.stdout.write(f"throughput       {len(latencies) / elapsed:.0f} msg/s")
+        self.stdout.write(
+            f"insert latency   p50 {percentile(0.5):.2f} ms  p95 {percentile(0.95):.2f} ms  "
+            f"p99 {percentile(0.99):.2f} ms  mean {statistics.fmean(latencies) * 1000 if latencies else 0:.2f} ms"
+        )
+        self.stdout.write(f"history reads    {sum(reads) / elapsed:.0f} pages/s")
@@ -0,0 +1,86 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.directory import HIGHEST, lookup, normalize
+from chat.models import DirectoryEntry
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the directory with synthetic users (1M by default) and compare prefix "
+        "lookups on the (kind, key) index with the icontains scan they replace. "
+        "Everything runs in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1_000_000)
+        parser.add_argument("--queries", type=int, default=500)
+        parser.add_argument("--scans", type=int, default=20, help="icontains queries, they are slow.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, users, queries, scans, seed, **options):
+
+        random.seed(seed)
+
+        alphabet = string.ascii_lowercase + string.digits + "_"
+        names = [
+            random.choice(string.ascii_letters) + "".join(random.choices(alphabet, k=random.randint(3, 14)))
+            for _ in range(users)
+        ]
+
+        # prefixes of real names, 1-4 characters, like someone typing
+        prefixes = [name[:random.randint(1, 4)] for name in random.sample(names, min(queries, users))]
+
+        try:
+            with transaction.atomic():
+
+                started = time.perf_counter()
+                DirectoryEntry.objects.bulk_create(
+                    (DirectoryEntry(kind="user", object_id=-i - 1, key=normalize(name), label=name)
+                     for i, name in enumerate(names)),
+                    batch_size=5000,
+                )
+                self.stdout.write(f"filled {users} entries in {time.perf_counter() - started:.1f}s")
+
+                self.report("prefix lookup", [self.timed(lookup, "user", prefix) for prefix in prefixes])
+
+                def scan(prefix):
+                    return list(DirectoryEntry.objects.filter(kind="user", label__icontains=prefix)
+                                .values_list("object_id", "label")[:10])
+
+                self.report("icontains scan", [self.timed(scan, prefix) for prefix in prefixes[:scans]])
+
+                sample = prefixes[0]
+                plan = DirectoryEntry.objects.filter(
+                    kind="user", key__gte=sample, key__lt=sample + HIGHEST
+                ).order_by("key")[:10].explain()
+                self.stdout.write(f"plan: {plan}")
+
+                raise Rollback
+        except Rollback:
+            pass
+
+    def timed(self, func, *args):
+        started = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - started
+
+    def report(self, name, timings):
+
+        timings.sort()
+
+        def at(p):
+            return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+        self.stdout.write(
+            f"{name:<16}{len(timings):>6} queries   p50 {at(0.50):8.3f} ms   "
+            f"p95 {at(0.95):8.3f} ms   p99 {at(0.99):8.3f} ms"
+        )
@@ -0,0 +1,77 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.protocol import ALL_CODECS, LEGACY, encode_all
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare wire formats for a group broadcast: bytes per recipient and CPU per "
+        "1k recipients for delivering one message plus its unread counter."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=1000)
+        parser.add_argument("--rounds", type=int, default=20)
+
+    def handle(self, *args, recipients, rounds, **options):
+
+        message = {
+            "id": 1234567,
+            "username": "alice",
+            "message": "See you at the station at half past six, I will bring the tickets",
+            "time": "18:04",
+            "edited": False,
+        }
+
+        rows = []
+
+        # what ChatConsumer did before: encode the message for every recipient
+        started = time.process_time()
+        for _ in range(rounds):
+            sent = 0
+            for recipient in range(recipients):
+                sent += len(LEGACY.encode_event("unread", {"unread_count": recipient % 3}))
+                sent += len(LEGACY.encode_event("message", message))
+        rows.append(("legacy, per recipient", 2, sent, time.process_time() - started))
+
+        for codec in ALL_CODECS:
+
+            started = time.process_time()
+            for _ in range(rounds):
+                sent = 0
+                shared = encode_all("message", message)[codec.key]
+
+                for recipient in range(recipients):
+                    unread = codec.encode_event("unread", {"unread_count": recipient % 3})
+
+                    if codec.batches:
+                        frames = [codec.frame([unread, shared])]
+                    else:
+                        frames = [unread, shared]
+
+                    sent += sum(len(frame) for frame in frames)
+
+            rows.append((f"{codec.name or 'legacy'}, encoded once", len(frames), sent, time.process_time() - started))
+
+            # ChatConsumer now: the recipient has just acked, its unread counter
+            # is unchanged, so it forwards the shared encoding and nothing else
+            started = time.process_time()
+            for _ in range(rounds):
+                sent = 0
+                shared = encode_all("message", message)[codec.key]
+
+                for recipient in range(recipients):
+                    frame = codec.frame([shared])
+                    sent += len(frame)
+
+            rows.append((f"{codec.name or 'legacy'}, forwarded", 1, sent, time.process_time() - started))
+
+        self.stdout.write(f"{'format':<34}{'frames':>8}{'bytes/recipient':>17}{'cpu ms/1k':>12}")
+
+        for name, frames, sent, cpu in rows:
+            self.stdout.write(
+                f"{name:<34}{frames:>8}{sent / recipients:>17.1f}"
+                f"{cpu / rounds / recipients * 1000 * 1000:>12.3f}"
+            )
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Profile
+from chat.thumbnails import build_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Make avatar thumbnails for profiles that do not have them yet (e.g. avatars uploaded before)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Rebuild every profile, e.g. after changing sizes.")
+
+    def handle(self, *args, all, **options):
+
+        profiles = Profile.objects.exclude(avatar="").exclude(avatar__isnull=True)
+
+        if not all:
+            profiles = profiles.filter(thumbnails={})
+
+        count = 0
+        for profile_id, avatar in profiles.values_list("id", "avatar").iterator():
+            build_thumbnails(profile_id, avatar)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Thumbnails built for {count} profiles"))
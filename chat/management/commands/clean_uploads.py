@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import Upload
+from chat.uploads import discard_upload
+
+
+class Command(BaseCommand):
+    help = "Delete resumable uploads that were started but never finished."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=float, default=24, help="Age after which an upload is abandoned.")
+
+    def handle(self, *args, hours, **options):
+
+        cutoff = timezone.now() - timedelta(hours=hours)
+        stale = Upload.objects.filter(message__isnull=True, created_at__lt=cutoff)
+
+        count = 0
+        for upload in stale.iterator():
+            discard_upload(upload)
+            count += 1
+
+        # finished uploads only keep the hash, their file belongs to the message now
+        Upload.objects.filter(message__isnull=False, created_at__lt=cutoff).delete()
+
+        self.stdout.write(self.style.SUCCESS(f"Removed {count} abandoned uploads"))
@@ -0,0 +1,94 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.utils import timezone
+
+from chat.models import Blob, Profile
+from chat.storage import BLOB_FIELDS, is_blob, publish, recount_refs
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete media blobs that no Message or Profile references. "
+        "--adopt first moves files saved before content-addressed storage into blobs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace", type=float, default=1,
+                            help="Hours a new blob may stay unreferenced (an upload still being saved).")
+        parser.add_argument("--recount", action="store_true", help="Rebuild reference counts from the rows first.")
+        parser.add_argument("--adopt", action="store_true", help="Deduplicate pre-existing media into blobs.")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, grace, recount, adopt, dry_run, **options):
+
+        if adopt and not dry_run:
+            self.adopt()
+            recount = True
+
+        if recount and not dry_run:
+            recount_refs()
+
+        cutoff = timezone.now() - timedelta(hours=grace)
+        garbage = Blob.objects.filter(refs=0, created_at__lt=cutoff)
+
+        count = freed = 0
+
+        for blob in garbage.iterator():
+            count += 1
+            freed += blob.size
+
+            if dry_run:
+                self.stdout.write(f"would delete {blob.name}")
+                continue
+
+            # skipped if a row picked the blob up since the query above
+            if Blob.objects.filter(pk=blob.pk, refs=0).delete()[0]:
+                default_storage.delete(blob.name)
+
+        verb = "Would free" if dry_run else "Freed"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {freed} bytes in {count} blobs"))
+
+    def adopt(self):
+
+        legacy = set()
+        moved = 0
+
+        for model, fields in BLOB_FIELDS.items():
+            for field in fields:
+                if not isinstance(model._meta.get_field(field), models.FileField):
+                    continue
+
+                rows = model.objects.exclude(**{field: ""}).exclude(**{f"{field}__isnull": True})
+
+                for row in rows.iterator():
+                    old = getattr(row, field)
+
+                    if is_blob(old.name):
+                        continue
+
+                    if not default_storage.exists(old.name):
+                        continue
+
+                    legacy.add(old.name)
+
+                    with default_storage.open(old.name) as content:
+                        new = default_storage.save(old.name, content)
+
+                    update = {field: new}
+                    if model._meta.model_name == "message" and field == "file" and not row.file_name:
+                        update["file_name"] = old.name.rsplit("/", 1)[-1]
+
+                    # no signals, refs are rebuilt from the rows right after
+                    model.objects.filter(pk=row.pk).update(**update)
+
+                    if model is Profile:
+                        publish([new])
+                    moved += 1
+
+        for name in legacy:
+            default_storage.delete(name)
+
+        self.stdout.write(f"Adopted {moved} files from {len(legacy)} legacy paths")
@@ -0,0 +1,357 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from chat.models import Chat, Profile
+from chat.protocol import EVENT_FIELDS, EVENT_KINDS, msgpack
+
+
+MARKER = "lt:"
+
+MESSAGE_KIND = EVENT_KINDS["message"]
+MESSAGE_TEXT = 1 + EVENT_FIELDS["message"].index("message")
+
+
+def message_texts(frame, protocol):
+    """
+    Yield the text of every chat message in a frame of the given protocol.
+    """
+
+    if protocol == "legacy":
+        yield json.loads(frame).get("message") or ""
+        return
+
+    events = msgpack.unpackb(frame) if isinstance(frame, bytes) else json.loads(frame)
+
+    for event in events:
+        if event[0] == MESSAGE_KIND:
+            yield event[MESSAGE_TEXT] or ""
+
+
+class QueryCounter:
+    """
+    Counts queries on every database connection, including the ones
+    opened later by the database_sync_to_async thread pool.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _on_connect(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self):
+        connection_created.connect(self._on_connect)
+        for conn in connections.all(initialized_only=True):
+            self._on_connect(None, conn)
+
+    def uninstall(self):
+        connection_created.disconnect(self._on_connect)
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+class Stats:
+
+    def __init__(self):
+        self.sent = 0
+        self.typing = 0
+        self.delivered = 0
+        self.sessions = 0
+        self.failed_connects = 0
+        self.latencies = []
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+class InProcessClient:
+    """
+    Talks to config.asgi.application inside this process.
+    """
+
+    def __init__(self, application, path, cookie, subprotocols):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(
+            application, path, headers=[(b"cookie", cookie.encode())], subprotocols=subprotocols
+        )
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self):
+        # a long timeout: a timed out receive cancels the application under test
+        return await self.communicator.receive_from(timeout=3600)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkClient:
+    """
+    Talks to a running server (for example Daphne) over a real socket.
+    """
+
+    def __init__(self, url, path, cookie, subprotocols):
+        self.uri = url.rstrip("/") + path
+        self.cookie = cookie
+        self.subprotocols = subprotocols
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+
+        try:
+            self.socket = await websockets.connect(
+                self.uri, additional_headers={"Cookie": self.cookie}, subprotocols=self.subprotocols
+            )
+        except (OSError, websockets.InvalidHandshake):
+            return False
+        return True
+
+    async def send(self, text):
+        await self.socket.send(text)
+
+    async def recv(self):
+        return await self.socket.recv()
+
+    async def close(self):
+        await self.socket.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive many authenticated WebSocket clients against ws/chat/<id>/ and report "
+        "delivery latency, throughput and DB queries per message."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=200)
+        parser.add_argument("--chats", type=int, default=10, help="Clients are spread over this many groups.")
+        parser.add_argument("--duration", type=float, default=20, help="Seconds of traffic.")
+        parser.add_argument("--rate", type=float, default=0.2, help="Frames per second per client.")
+        parser.add_argument("--typing", type=float, default=0.5, help="Share of frames that are typing events.")
+        parser.add_argument("--churn", type=float, default=0.1,
+                            help="Share of sessions that leave early and reconnect.")
+        parser.add_argument("--url", help="ws://host:port of a running server instead of the in-process app. "
+                                          "Needs the websockets package.")
+        parser.add_argument("--protocol", default="legacy", choices=["legacy", "chat.v1.json", "chat.v1.msgpack"],
+                            help="WebSocket subprotocol the clients ask for.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument("--baseline", help="JSON from an earlier --output run to compare against.")
+
+    def handle(self, *args, **opts):
+
+        if opts["url"]:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError("--url needs the websockets package: pip install websockets")
+
+        if opts["protocol"] == "chat.v1.msgpack" and msgpack is None:
+            raise CommandError("chat.v1.msgpack needs the msgpack package")
+
+        random.seed(opts["seed"])
+
+        users, chats, cookies = self.setup(opts["clients"], opts["chats"])
+
+        counter = QueryCounter()
+
+        try:
+            if opts["url"]:
+                application = None
+            else:
+                from config.asgi import application
+
+            counter.install()
+            stats, elapsed = asyncio.run(self.run(application, users, chats, cookies, opts))
+        finally:
+            # before teardown, its deletes are not part of the run
+            counter.uninstall()
+            self.teardown(users, chats)
+
+        results = {
+            "protocol": opts["protocol"],
+            "clients": opts["clients"],
+            "chats": opts["chats"],
+            "duration": round(elapsed, 2),
+            "sent": stats.sent,
+            "typing": stats.typing,
+            "delivered": stats.delivered,
+            "sessions": stats.sessions,
+            "failed_connects": stats.failed_connects,
+            "sent_per_s": round(stats.sent / elapsed, 1),
+            "delivered_per_s": round(stats.delivered / elapsed, 1),
+            "latency_p50_ms": round(stats.percentile(0.50), 2),
+            "latency_p95_ms": round(stats.percentile(0.95), 2),
+            "latency_p99_ms": round(stats.percentile(0.99), 2),
+            "latency_mean_ms": round(statistics.fmean(stats.latencies) * 1000, 2) if stats.latencies else 0,
+            "queries_per_message": round(counter.count / stats.sent, 2) if stats.sent and not opts["url"] else None,
+        }
+
+        self.report(results, opts["baseline"])
+
+        if opts["output"]:
+            with open(opts["output"], "w") as fh:
+                json.dump(results, fh, indent=2)
+
+    # =========================
+    # SETUP
+    # =========================
+
+    def setup(self, clients, chat_count):
+
+        run = time.time_ns()
+
+        users = User.objects.bulk_create([
+            User(username=f"load-{run}-{i}", password="!") for i in range(clients)
+        ])
+        users = list(User.objects.filter(username__startswith=f"load-{run}-").order_by("id"))
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+
+        chats = [Chat.objects.create(name=f"load-{run}-{i}", type="group") for i in range(chat_count)]
+
+        for index, chat in enumerate(chats):
+            chat.participants.add(*users[index::chat_count])
+
+        cookies = {}
+        for user in users:
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            cookies[user.pk] = f"sessionid={session.session_key}"
+
+        self.session_keys = [cookie.split("=", 1)[1] for cookie in cookies.values()]
+
+        return users, chats, cookies
+
+    def teardown(self, users, chats):
+
+        Chat.objects.filter(id__in=[chat.id for chat in chats]).delete()
+        User.objects.filter(id__in=[user.id for user in users]).delete()
+        Session.objects.filter(session_key__in=self.session_keys).delete()
+
+    # =========================
+    # TRAFFIC
+    # =========================
+
+    async def run(self, application, users, chats, cookies, opts):
+
+        stats = Stats()
+        deadline = time.perf_counter() + opts["duration"]
+
+        protocol = opts["protocol"]
+        subprotocols = None if protocol == "legacy" else [protocol]
+
+        def make_client(user, chat):
+            path = f"/ws/chat/{chat.id}/"
+            if opts["url"]:
+                return NetworkClient(opts["url"], path, cookies[user.pk], subprotocols)
+            return InProcessClient(application, path, cookies[user.pk], subprotocols)
+
+        async def read(client):
+            received = 0
+
+            while True:
+                frame = await client.recv()
+
+                # keep the outbox window open, see chat/outbox.py
+                received += 1
+                await client.send(json.dumps({"action": "ack", "frames": received}))
+
+                for text in message_texts(frame, protocol):
+                    if text.startswith(MARKER):
+                        stats.delivered += 1
+                        stats.latencies.append(time.perf_counter() - float(text[len(MARKER):]))
+
+        async def drive(index, user):
+
+            chat = chats[index % len(chats)]
+
+            while time.perf_counter() < deadline:
+
+                client = make_client(user, chat)
+
+                if not await client.connect():
+                    stats.failed_connects += 1
+                    return
+
+                stats.sessions += 1
+                reader = asyncio.create_task(read(client))
+
+                session_end = deadline
+                if random.random() < opts["churn"]:
+                    session_end = min(deadline, time.perf_counter() + random.uniform(1, 5))
+
+                while time.perf_counter() < session_end:
+                    await asyncio.sleep(random.expovariate(opts["rate"]))
+
+                    if time.perf_counter() >= session_end:
+                        break
+
+                    if random.random() < opts["typing"]:
+                        await client.send(json.dumps({"typing": True}))
+                        stats.typing += 1
+                    else:
+                        await client.send(json.dumps({"message": f"{MARKER}{time.perf_counter()}"}))
+                        stats.sent += 1
+
+                # let in-flight deliveries land before the reader goes away
+                await asyncio.sleep(0.5)
+                reader.cancel()
+                await client.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[drive(index, user) for index, user in enumerate(users)])
+
+        return stats, time.perf_counter() - started
+
+    # =========================
+    # REPORT
+    # =========================
+
+    def report(self, results, baseline_path):
+
+        baseline = {}
+        if baseline_path:
+            with open(baseline_path) as fh:
+                baseline = json.load(fh)
+
+        for key, value in results.items():
+            line = f"{key:<22}{value}"
+
+            before = baseline.get(key)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                line += f"   (baseline {before}, {(value - before) / before * 100:+.1f}%)"
+
+            self.stdout.write(line)
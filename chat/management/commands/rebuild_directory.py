@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from chat.directory import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user and group directory used by autocomplete."
+
+    def handle(self, *args, **options):
+
+        rebuild()
+
+        self.stdout.write(self.style.SUCCESS("Directory rebuilt"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from chat.search import get_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the message search index from Message."
+
+    def handle(self, *args, **options):
+
+        get_backend().rebuild()
+
+        self.stdout.write(self.style.SUCCESS("Search index rebuilt"))
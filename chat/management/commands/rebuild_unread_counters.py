@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import Chat, ChatReadState
+from chat.unread import add_read_states, recount
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-member unread counters from Message when they drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chat", type=int, action="append", dest="chats",
+                            help="Only rebuild these chat ids (repeatable).")
+
+    def handle(self, *args, chats=None, **options):
+
+        through = Chat.participants.through.objects.all()
+        states = ChatReadState.objects.all()
+
+        if chats:
+            through = through.filter(chat_id__in=chats)
+            states = states.filter(chat_id__in=chats)
+
+        # members added before counters existed get a row first
+        add_read_states(list(through.values_list("chat_id", "user_id")))
+
+        updated = recount(states)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {updated} unread counters"))
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Chat
+
+
+CACHE_SIZE = getattr(settings, "CHAT_MEMBERSHIP_CACHE_SIZE", 10000)
+CACHE_TTL = getattr(settings, "CHAT_MEMBERSHIP_CACHE_TTL", 30)
+SHARED_CACHE = getattr(settings, "CHAT_MEMBERSHIP_SHARED_CACHE", False)
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU whose entries also expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+
+        with self.lock:
+            item = self.data.get(key)
+
+            if item is None:
+                return None
+
+            value, expires = item
+
+            if expires < time.monotonic():
+                del self.data[key]
+                return None
+
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+
+        with self.lock:
+            self.data.clear()
+
+
+local_members = TTLCache(CACHE_SIZE, CACHE_TTL)
+
+
+def cache_key(chat_id, user_id):
+    return f"chat:member:{chat_id}:{user_id}"
+
+
+def is_member(chat_id, user_id):
+    """
+    EXISTS check on the participants table, fronted by a per-process LRU
+    and, when enabled, the shared Django cache.
+
+    Only positive answers are kept locally, so a user added on another
+    worker is never locked out by a stale entry here.
+    """
+
+    key = (int(chat_id), user_id)
+
+    if local_members.get(key):
+        return True
+
+    member = None
+
+    if SHARED_CACHE:
+        member = cache.get(cache_key(*key))
+
+    if member is None:
+        member = Chat.participants.through.objects.filter(
+            chat_id=chat_id,
+            user_id=user_id
+        ).exists()
+
+        if SHARED_CACHE:
+            cache.set(cache_key(*key), member, CACHE_TTL)
+
+    if member:
+        local_members.set(key, True)
+
+    return member
+
+
+def forget_members(pairs):
+
+    for chat_id, user_id in pairs:
+        local_members.delete((int(chat_id), user_id))
+
+    if SHARED_CACHE:
+        cache.delete_many([cache_key(chat_id, user_id) for chat_id, user_id in pairs])
@@ -0,0 +1,58 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_watermarks(apps, schema_editor):
+
+    Chat = apps.get_model("chat", "Chat")
+    Message = apps.get_model("chat", "Message")
+    ChatReadState = apps.get_model("chat", "ChatReadState")
+
+    # carry the old is_read flag over: a member has seen everything up to
+    # the newest message marked read or sent by themselves
+    seen = Message.objects.filter(
+        Q(is_read=True) | Q(sender_id=OuterRef("user_id")),
+        chat_id=OuterRef("chat_id"),
+    ).order_by("-id").values("id")[:1]
+
+    members = Chat.participants.through.objects.annotate(
+        last_read=Coalesce(Subquery(seen), 0)
+    ).values_list("chat_id", "user_id", "last_read")
+
+    ChatReadState.objects.bulk_create(
+        [
+            ChatReadState(chat_id=chat_id, user_id=user_id, last_read_message_id=last_read)
+            for chat_id, user_id, last_read in members.iterator()
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_reaction'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('chat', 'user')},
+            },
+        ),
+        migrations.RunPython(fill_watermarks, migrations.RunPython.noop),
+    ]
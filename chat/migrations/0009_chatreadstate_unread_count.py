@@ -0,0 +1,37 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:10
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_unread_counts(apps, schema_editor):
+
+    ChatReadState = apps.get_model("chat", "ChatReadState")
+    Message = apps.get_model("chat", "Message")
+
+    # the count chat.unread.recount does, on the historical models
+    unread = Message.objects.filter(
+        chat_id=OuterRef("chat_id"),
+        id__gt=OuterRef("last_read_message_id")
+    ).exclude(
+        sender_id=OuterRef("user_id")
+    ).order_by().values("chat_id").annotate(n=Count("id")).values("n")
+
+    ChatReadState.objects.update(unread_count=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatreadstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatreadstate',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_unread_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts "
+            "USING fts5(text, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            "INSERT INTO chat_message_fts(rowid, text) "
+            "SELECT id, text FROM chat_message WHERE is_deleted = 0 AND text != ''"
+        )
+
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS chat_message_text_search "
+            "ON chat_message USING GIN (to_tsvector('simple', text))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+
+    vendor = schema_editor.connection.vendor
+
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS chat_message_fts")
+
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS chat_message_text_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0010_message_chat_id_idx"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
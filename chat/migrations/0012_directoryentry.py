@@ -0,0 +1,49 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:25
+
+import unicodedata
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_directory(apps, schema_editor):
+
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split("."))
+    Chat = apps.get_model("chat", "Chat")
+    DirectoryEntry = apps.get_model("chat", "DirectoryEntry")
+
+    def entry(kind, object_id, name):
+        key = unicodedata.normalize("NFKC", name).casefold()
+        return DirectoryEntry(kind=kind, object_id=object_id, key=key, label=name)
+
+    DirectoryEntry.objects.bulk_create(
+        [entry("user", pk, name) for pk, name in User.objects.values_list("pk", "username").iterator()]
+        + [entry("group", pk, name) for pk, name in Chat.objects.filter(type="group").values_list("pk", "name").iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_search'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user', 'User'), ('group', 'Group')], max_length=5)),
+                ('object_id', models.BigIntegerField()),
+                ('key', models.CharField(max_length=150)),
+                ('label', models.CharField(max_length=150)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', 'key'], name='directory_kind_key_idx')],
+                'unique_together': {('kind', 'object_id')},
+            },
+        ),
+        migrations.RunPython(fill_directory, migrations.RunPython.noop),
+    ]
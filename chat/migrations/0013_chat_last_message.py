@@ -0,0 +1,39 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_last_message(apps, schema_editor):
+
+    Chat = apps.get_model("chat", "Chat")
+    Message = apps.get_model("chat", "Message")
+
+    newest = Message.objects.filter(chat=OuterRef("pk")).order_by("-id")
+
+    Chat.objects.update(
+        last_message=Subquery(newest.values("id")[:1]),
+        last_activity_at=Subquery(newest.values("timestamp")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_directoryentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.RunPython(fill_last_message, migrations.RunPython.noop),
+    ]
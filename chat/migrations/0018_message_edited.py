@@ -0,0 +1,18 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_media_serving'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='edited',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def fill_reaction_counts(apps, schema_editor):
+
+    Reaction = apps.get_model("chat", "Reaction")
+    ReactionCount = apps.get_model("chat", "ReactionCount")
+
+    totals = Reaction.objects.values("message_id", "emoji").annotate(
+        count=Count("id"),
+        first=Min("id"),
+    ).order_by("first")
+
+    ReactionCount.objects.bulk_create(
+        ReactionCount(message_id=row["message_id"], emoji=row["emoji"], count=row["count"])
+        for row in totals.iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_message_edited'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReactionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_counts', to='chat.message')),
+            ],
+            options={
+                'unique_together': {('message', 'emoji')},
+            },
+        ),
+        migrations.RunPython(fill_reaction_counts, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -6,6 +8,8 @@ class Profile(models.Model):
     
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     avatar = models.ImageField(upload_to="avatars/", null=True, blank=True)
+    # {"48": "blobs/…webp", …}, filled in the background by chat/thumbnails.py
+    thumbnails = models.JSONField(default=dict, blank=True)
     bio = models.CharField(max_length=150, blank=True)
     online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(null=True, blank=True)
@@ -28,6 +32,16 @@ class Chat(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # denormalized for the chat list, moved forward on message create
+    last_message = models.ForeignKey(
+        "Message",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="+"
+    )
+    last_activity_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return self.name or str(self.id)
     
@@ -49,13 +63,26 @@ class Message(models.Model):
         on_delete=models.SET_NULL
     )
 
+    # what the sender called the file, storage names are content hashes
+    file_name = models.CharField(max_length=255, blank=True)
+
     is_read = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
+    edited = models.BooleanField(default=False)
 
     updated_at = models.DateTimeField(auto_now=True)
 
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # history pages are id ranges within a single chat
+            models.Index(fields=["chat", "id"], name="message_chat_id_idx"),
+            # media requests look up the messages a file was posted in
+            models.Index(fields=["file"], name="message_file_idx"),
+            models.Index(fields=["audio"], name="message_audio_idx"),
+        ]
+
     def __str__(self):
         return self.text[:20]
 
@@ -91,3 +118,112 @@ class Reaction(models.Model):
 
     class Meta:
         unique_together = ("message", "user", "emoji")
+
+
+class ReactionCount(models.Model):
+    """
+    How many users reacted to a message with each emoji, kept next to
+    the Reaction rows by chat/actions.py so a page of history reads the
+    badges without grouping every user's reaction.
+    """
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="reaction_counts")
+
+    emoji = models.CharField(max_length=10)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("message", "emoji")
+
+
+class ChatReadState(models.Model):
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="read_states")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_states")
+
+    # id of the newest message this member has seen in the chat
+    last_read_message_id = models.BigIntegerField(default=0)
+
+    # denormalized, kept current on message create / read ack
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("chat", "user")
+
+
+class DirectoryEntry(models.Model):
+    """
+    Lowercased names of users and group chats for prefix search,
+    kept in sync by chat/signals.py (see chat/directory.py).
+    """
+
+    KIND_CHOICES = (
+        ("user", "User"),
+        ("group", "Group"),
+    )
+
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+
+    # normalized name, prefix lookups are range scans on (kind, key)
+    key = models.CharField(max_length=150)
+    label = models.CharField(max_length=150)
+
+    class Meta:
+        unique_together = ("kind", "object_id")
+        indexes = [
+            models.Index(fields=["kind", "key"], name="directory_kind_key_idx"),
+        ]
+
+
+class Upload(models.Model):
+    """
+    A resumable upload in progress, see chat/uploads.py.
+    """
+
+    KIND_CHOICES = (
+        ("file", "File"),
+        ("audio", "Voice"),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+
+    sha256 = models.CharField(max_length=64, blank=True)
+    message = models.OneToOneField(Message, null=True, blank=True, on_delete=models.SET_NULL)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class UploadChunk(models.Model):
+
+    upload = models.ForeignKey(Upload, on_delete=models.CASCADE, related_name="chunks")
+    index = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ("upload", "index")
+
+
+class Blob(models.Model):
+    """
+    One stored file in ContentAddressedStorage (chat/storage.py).
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+
+    # Message.file / Message.audio / Profile.avatar values pointing here
+    refs = models.PositiveIntegerField(default=0)
+
+    # avatars and thumbnails, served to any logged-in user (chat/files.py)
+    public = models.BooleanField(default=False)
+
+    created_at = models.DateTimeField(auto_now_add=True)
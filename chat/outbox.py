@@ -0,0 +1,212 @@
+"""
+Per-socket outbound queue.
+
+Channel-layer handlers only put frames on the socket's Outbox and
+return, so a slow client never holds up the channel layer; a writer
+task sends what is queued, several events per frame for the batching
+codecs.
+
+The writer keeps at most ``WINDOW`` frames unacknowledged: the client
+reports how many frames it has received (``{"action": "ack", "frames":
+n}``, chat.js does so after each burst) and nothing more is handed to
+``send()`` until it does. The server's own send buffer therefore never
+holds more than a window per socket, whatever it does with ``send()``
+(Daphne never blocks it), and a client that reads slowly or not at all
+makes this queue grow instead.
+
+Above ``HIGH_WATERMARK`` queued events the socket is congested until it
+drains to ``LOW_WATERMARK``. While congested, lossy events (typing,
+presence, unread counts) are dropped rather than queued. Updates that
+supersede each other (the unread count, a user's presence, a message's
+reactions) replace the queued one in place at any depth. A socket that
+stays congested for ``MAX_STALL`` seconds or reaches ``LIMIT`` events
+is disconnected; on reconnect chat.js resumes from the replay buffer.
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, deque
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+HIGH_WATERMARK = getattr(settings, "CHAT_OUTBOX_HIGH_WATERMARK", 256)
+LOW_WATERMARK = getattr(settings, "CHAT_OUTBOX_LOW_WATERMARK", 64)
+LIMIT = getattr(settings, "CHAT_OUTBOX_LIMIT", 1024)
+MAX_STALL = getattr(settings, "CHAT_OUTBOX_MAX_STALL", 10.0)
+WINDOW = getattr(settings, "CHAT_OUTBOX_WINDOW", 64)
+
+# events sent per frame by the batching codecs
+MAX_BATCH = 64
+
+LOSSY = {"typing", "presence", "unread"}
+
+
+class OutboxMetrics:
+    """
+    Process-wide counters for every live Outbox, see ``snapshot``.
+    """
+
+    def __init__(self):
+        self.outboxes = weakref.WeakSet()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = Counter()
+        self.disconnected = 0
+
+    def snapshot(self):
+
+        depths = [len(outbox) for outbox in self.outboxes]
+
+        return {
+            "sockets": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "congested": sum(1 for outbox in self.outboxes if outbox.congested_since is not None),
+            "window_full": sum(1 for outbox in self.outboxes if outbox.frames - outbox.acked >= outbox.window),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": dict(self.dropped),
+            "disconnected": self.disconnected,
+        }
+
+
+outbox_metrics = OutboxMetrics()
+
+
+class Outbox:
+
+    def __init__(self, write, overflow, high=HIGH_WATERMARK, low=LOW_WATERMARK, limit=LIMIT,
+                 max_stall=MAX_STALL, window=WINDOW, batch=MAX_BATCH, metrics=outbox_metrics):
+        # write(events) sends up to ``batch`` encoded events as one frame,
+        # overflow() drops the socket
+        self.write = write
+        self.overflow = overflow
+        self.high = high
+        self.low = low
+        self.limit = limit
+        self.max_stall = max_stall
+        self.window = window
+        self.batch = batch
+        self.metrics = metrics
+
+        # frames written / acknowledged by the client so far
+        self.frames = 0
+        self.acked = 0
+        self._credit = asyncio.Event()
+
+        # [key, event] entries, keyed ones are also in self.keyed for coalescing
+        self.queue = deque()
+        self.keyed = {}
+        self.congested_since = None
+        self.closed = False
+        self._task = None
+
+        metrics.outboxes.add(self)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, event, kind, key=None):
+        """
+        Queue an encoded event. ``key`` marks updates that replace the
+        queued one with the same key, e.g. ("presence", user_id).
+        """
+
+        if self.closed:
+            return
+
+        if key is not None and key in self.keyed:
+            self.keyed[key][1] = event
+            self.metrics.coalesced += 1
+            return
+
+        if self.congested_since is not None and kind in LOSSY:
+            self.metrics.dropped[kind] += 1
+            return
+
+        entry = [key, event]
+        self.queue.append(entry)
+
+        if key is not None:
+            self.keyed[key] = entry
+
+        depth = len(self.queue)
+
+        if depth >= self.high and self.congested_since is None:
+            self.congested_since = time.monotonic()
+
+        if depth >= self.limit or self.stalled():
+            self.disconnect(depth)
+            return
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.drain())
+
+    def ack(self, frames):
+        """
+        The client has received ``frames`` frames in total.
+        """
+
+        if self.acked < frames <= self.frames:
+            self.acked = frames
+            self._credit.set()
+
+    def stalled(self):
+        return self.congested_since is not None and time.monotonic() - self.congested_since > self.max_stall
+
+    def disconnect(self, depth):
+
+        logger.warning("Dropping slow socket with %d queued events", depth)
+
+        self.metrics.disconnected += 1
+        self.close()
+
+        asyncio.get_running_loop().create_task(self.overflow())
+
+    def close(self):
+
+        self.closed = True
+        self.queue.clear()
+        self.keyed.clear()
+        self.metrics.outboxes.discard(self)
+
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+
+    async def drain(self):
+
+        # let the rest of this loop tick queue up first, it shares the frame
+        await asyncio.sleep(0)
+
+        try:
+            while self.queue and not self.closed:
+
+                # the window is full, the rest waits here until the client acks
+                if self.frames - self.acked >= self.window:
+                    self._credit.clear()
+                    await self._credit.wait()
+                    continue
+
+                events = []
+
+                while self.queue and len(events) < self.batch:
+                    key, event = self.queue.popleft()
+                    if key is not None:
+                        del self.keyed[key]
+                    events.append(event)
+
+                await self.write(events)
+                self.frames += 1
+                self.metrics.sent += len(events)
+
+                if self.congested_since is not None and len(self.queue) <= self.low:
+                    self.congested_since = None
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
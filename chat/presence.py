@@ -0,0 +1,286 @@
+import asyncio
+import uuid
+from collections import Counter, defaultdict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .buffers import WriteBehindBuffer
+from .models import Profile
+
+
+FLUSH_INTERVAL = getattr(settings, "CHAT_PRESENCE_FLUSH_INTERVAL", 2)
+PRESENCE_TTL = getattr(settings, "CHAT_PRESENCE_TTL", 60)
+
+# a slot's users are kept in this many keys, so a connect rewrites a small one
+BUCKETS = 64
+
+SLOTS_KEY = "chat:presence:slots"
+SWEEPER_KEY = "chat:presence:sweeper"
+
+
+def slot_key(slot):
+    return f"chat:presence:slot:{slot}"
+
+
+def bucket_key(slot, bucket):
+    return f"chat:presence:users:{slot}:{bucket}"
+
+
+def presence_key(user_id, slot):
+    return f"chat:presence:{user_id}:{slot}"
+
+
+class PresenceTracker(WriteBehindBuffer):
+    """
+    Reference-counts live sockets per user and writes Profile.online /
+    last_seen only when a user really comes online or goes offline.
+
+    Sockets are counted per process. Each process claims a numbered slot
+    in the cache with ``cache.add``, so two workers starting together
+    never share one, and keeps a short-lived key per connected user under
+    it, refreshed with the slot every third of ``ttl``. A user is online
+    elsewhere while another slot holds such a key, so a second tab or a
+    second worker does not flip the profile back and forth.
+
+    The slot also lists its users. When a worker dies its slot expires
+    within ``ttl`` seconds, and the one worker elected to sweep (or the
+    next one to claim the slot) marks those of its users that are not
+    connected elsewhere offline.
+
+    Cache calls run in the database thread, never on the event loop.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL, ttl=PRESENCE_TTL, worker_id=None):
+        super().__init__(interval)
+        self.ttl = ttl
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self.slot = None
+        self.local = Counter()
+        self.last_seen = {}
+        # bucket -> local user ids, mirrored to the slot's bucket keys
+        self.buckets = defaultdict(set)
+        self._keepalive = None
+
+    async def connect(self, user_id):
+        """
+        Register a socket, returns True if the user just came online.
+        """
+
+        self.local[user_id] += 1
+        self.last_seen[user_id] = timezone.now()
+
+        if self.local[user_id] > 1:
+            return False
+
+        await self.start()
+
+        bucket = user_id % BUCKETS
+        self.buckets[bucket].add(user_id)
+
+        # ours is set before looking, of two racing workers at least one sees the other
+        if await database_sync_to_async(self.announce)(user_id, bucket, frozenset(self.buckets[bucket])):
+            return False
+
+        self.pending[user_id] = (True, self.last_seen[user_id])
+        self.schedule()
+
+        return True
+
+    async def disconnect(self, user_id):
+        """
+        Drop a socket, returns True if the user just went offline.
+        """
+
+        if user_id not in self.local:
+            return False
+
+        self.local[user_id] -= 1
+
+        if self.local[user_id] > 0:
+            return False
+
+        del self.local[user_id]
+        last_seen = self.last_seen.pop(user_id, None) or timezone.now()
+
+        bucket = user_id % BUCKETS
+        self.buckets[bucket].discard(user_id)
+
+        if await database_sync_to_async(self.withdraw)(user_id, bucket, frozenset(self.buckets[bucket])):
+            return False
+
+        self.pending[user_id] = (False, last_seen)
+        self.schedule()
+
+        return True
+
+    def heartbeat(self, user_id):
+        self.last_seen[user_id] = timezone.now()
+
+    def is_online(self, user_id):
+        return user_id in self.local or self.connected_elsewhere(user_id)
+
+    # =========================
+    # SLOT
+    # =========================
+
+    async def start(self):
+
+        loop = asyncio.get_running_loop()
+
+        if self._keepalive is not None and not self._keepalive.done() and self._keepalive.get_loop() is loop:
+            return
+
+        # set first, a connect arriving meanwhile queues behind the claim
+        self._keepalive = loop.create_task(self._refresh_forever())
+
+        await database_sync_to_async(self.claim)(self.snapshot())
+
+    def snapshot(self):
+        return {bucket: frozenset(users) for bucket, users in self.buckets.items()}
+
+    async def _refresh_forever(self):
+
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await database_sync_to_async(self.refresh)(self.snapshot())
+
+    def claim(self, buckets):
+        """
+        Take the first free slot, or add one, and publish the local users in it.
+        """
+
+        while True:
+            count = cache.get(SLOTS_KEY) or 0
+
+            slot = next((s for s in range(count) if cache.add(slot_key(s), self.worker_id, self.ttl)), None)
+
+            if slot is not None:
+                break
+
+            cache.add(SLOTS_KEY, 0, None)
+            cache.incr(SLOTS_KEY)
+
+        self.slot = slot
+
+        # whoever held it before is gone, settle its users first
+        self.sweep_slot(slot, keep=set().union(*buckets.values()))
+
+        cache.set_many({bucket_key(slot, bucket): users for bucket, users in buckets.items()}, None)
+        self.publish(buckets)
+
+    def refresh(self, buckets):
+
+        # stalled past the ttl and lost the slot, start over in a free one
+        if cache.get(slot_key(self.slot)) != self.worker_id:
+            self.claim(buckets)
+        else:
+            cache.touch(slot_key(self.slot), self.ttl)
+            self.publish(buckets)
+
+        if self.elected():
+            self.sweep()
+
+    def publish(self, buckets):
+        cache.set_many({presence_key(u, self.slot): True for users in buckets.values() for u in users}, self.ttl)
+
+    def announce(self, user_id, bucket, users):
+        """
+        Publish a user's first local socket; True if they are connected elsewhere.
+        """
+
+        cache.set(presence_key(user_id, self.slot), True, self.ttl)
+        cache.set(bucket_key(self.slot, bucket), users, None)
+
+        return self.connected_elsewhere(user_id)
+
+    def withdraw(self, user_id, bucket, users):
+        """
+        Drop a user's last local socket; True if they are connected elsewhere.
+        """
+
+        cache.delete(presence_key(user_id, self.slot))
+        cache.set(bucket_key(self.slot, bucket), users, None)
+
+        return self.connected_elsewhere(user_id)
+
+    def connected_elsewhere(self, user_id):
+
+        slots = [s for s in range(cache.get(SLOTS_KEY) or 0) if s != self.slot]
+
+        return bool(cache.get_many([presence_key(user_id, s) for s in slots]))
+
+    # =========================
+    # SWEEP
+    # =========================
+
+    def elected(self):
+
+        if cache.add(SWEEPER_KEY, self.worker_id, self.ttl):
+            return True
+
+        if cache.get(SWEEPER_KEY) == self.worker_id:
+            cache.touch(SWEEPER_KEY, self.ttl)
+            return True
+
+        return False
+
+    def sweep(self):
+        """
+        Settle the users of every expired slot, returns the ids marked offline.
+        """
+
+        count = cache.get(SLOTS_KEY) or 0
+        alive = cache.get_many([slot_key(s) for s in range(count)])
+
+        stale = []
+        for slot in range(count):
+            if slot_key(slot) not in alive:
+                stale += self.sweep_slot(slot)
+
+        return stale
+
+    def sweep_slot(self, slot, keep=()):
+        """
+        Mark offline the users a dead worker left in ``slot``, unless some
+        other slot still holds them (or they are in ``keep``).
+        """
+
+        left = cache.get_many([bucket_key(slot, bucket) for bucket in range(BUCKETS)])
+
+        if not left:
+            return []
+
+        cache.delete_many(list(left))
+
+        user_ids = set().union(*left.values()) - set(keep)
+        slots = [s for s in range(cache.get(SLOTS_KEY) or 0) if s != slot]
+
+        live = cache.get_many([presence_key(u, s) for u in user_ids for s in slots])
+        live_users = {int(key.split(":")[2]) for key in live}
+
+        stale = sorted(user_ids - live_users)
+
+        if stale:
+            Profile.objects.filter(user_id__in=stale, online=True).update(online=False, last_seen=timezone.now())
+
+        return stale
+
+    def write(self, pending):
+
+        profiles = list(Profile.objects.filter(user_id__in=pending))
+
+        for profile in profiles:
+            online, seen = pending[profile.user_id]
+
+            profile.online = online
+
+            if not online:
+                profile.last_seen = seen
+
+        Profile.objects.bulk_update(profiles, ["online", "last_seen"])
+
+
+presence = PresenceTracker()
@@ -0,0 +1,177 @@
+"""
+Wire formats for ChatConsumer.
+
+A client picks one with the Sec-WebSocket-Protocol header:
+
+* no subprotocol - one JSON object per frame, the format chat.js uses.
+* ``chat.v1.json`` - every frame is a JSON array of events.
+* ``chat.v1.msgpack`` - the same array, msgpack encoded in binary frames.
+
+In the v1 formats an event is ``[kind, field, field, ...]`` with the
+kind as a small integer and the fields in the order of ``EVENT_FIELDS``,
+so repeated key names never go over the wire, and several events can
+share one frame. Events are encoded on their own and frames are built by
+concatenating encoded events, so an event shared by a whole group is
+encoded once by the sender and spliced into each recipient's frame.
+
+On the multiplexed ``ws/user/`` socket each chat event is wrapped with
+its chat id the same way, by splicing: ``{"chat_id": id, "event": {...}}``
+in legacy JSON and ``[11, chat_id, event]`` in the v1 formats.
+
+Whatever the format, clients acknowledge the frames they have received
+with ``{"action": "ack", "frames": n}``, see chat/outbox.py.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+EVENT_KINDS = {
+    "message": 1,
+    "unread": 2,
+    "typing": 3,
+    "presence": 4,
+    "history": 5,
+    "edit": 6,
+    "delete": 7,
+    "reactions": 8,
+    "pin": 9,
+    "replay": 10,
+    "chat": 11,
+    "membership": 12,
+}
+
+EVENT_FIELDS = {
+    "message": ("id", "username", "message", "time", "edited", "seq"),
+    "unread": ("unread_count",),
+    "typing": ("typing_users",),
+    "presence": ("user_id", "online", "last_seen"),
+    "history": ("history", "next_cursor"),
+    "edit": ("id", "message", "edited", "seq"),
+    "delete": ("id", "seq"),
+    "reactions": ("id", "reactions", "seq"),
+    "pin": ("id", "username", "message", "seq"),
+    "replay": ("messages", "seq", "complete"),
+    "chat": ("chat_id", "event"),
+    "membership": ("chat_id", "member"),
+}
+
+# kinds whose legacy JSON object is nested under the kind name
+LEGACY_NESTED = {"presence", "edit", "delete", "reactions", "pin", "replay", "membership"}
+
+
+def as_array(kind, payload):
+    return [EVENT_KINDS[kind], *(payload.get(field) for field in EVENT_FIELDS[kind])]
+
+
+class LegacyJsonCodec:
+
+    name = None
+    key = "legacy"
+    binary = False
+    batches = False
+
+    def encode_event(self, kind, payload):
+
+        if kind in LEGACY_NESTED:
+            payload = {kind: payload}
+
+        return json.dumps(payload)
+
+    def wrap(self, chat_id, event):
+        return '{"chat_id": %d, "event": %s}' % (chat_id, event)
+
+    def frame(self, events):
+        # never batched, one event per frame
+        return events[0]
+
+    def decode(self, text_data, bytes_data):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class CompactJsonCodec:
+
+    name = "chat.v1.json"
+    key = "json"
+    binary = False
+    batches = True
+
+    def encode_event(self, kind, payload):
+        return json.dumps(as_array(kind, payload), separators=(",", ":"))
+
+    def wrap(self, chat_id, event):
+        return "[%d,%d,%s]" % (EVENT_KINDS["chat"], chat_id, event)
+
+    def frame(self, events):
+        return "[" + ",".join(events) + "]"
+
+    def decode(self, text_data, bytes_data):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackCodec:
+
+    name = "chat.v1.msgpack"
+    key = "msgpack"
+    binary = True
+    batches = True
+
+    def encode_event(self, kind, payload):
+        return msgpack.packb(as_array(kind, payload))
+
+    def wrap(self, chat_id, event):
+        # a three-element array header, then the parts
+        return b"\x93" + msgpack.packb(EVENT_KINDS["chat"]) + msgpack.packb(chat_id) + event
+
+    def frame(self, events):
+
+        count = len(events)
+
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b"\xdc" + count.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + count.to_bytes(4, "big")
+
+        return header + b"".join(events)
+
+    def decode(self, text_data, bytes_data):
+
+        if bytes_data is not None:
+            return msgpack.unpackb(bytes_data)
+
+        return json.loads(text_data)
+
+
+LEGACY = LegacyJsonCodec()
+
+# negotiated subprotocols, the first one the client offers wins
+CODECS = [CompactJsonCodec()]
+
+if msgpack is not None:
+    CODECS.insert(0, MsgpackCodec())
+
+ALL_CODECS = [LEGACY, *CODECS]
+
+
+def negotiate(subprotocols):
+
+    for requested in subprotocols or ():
+        for codec in CODECS:
+            if codec.name == requested:
+                return codec
+
+    return LEGACY
+
+
+def encode_all(kind, payload):
+    """
+    Encode one event for every codec, for events shared by a whole group.
+    """
+
+    return {codec.key: codec.encode_event(kind, payload) for codec in ALL_CODECS}
@@ -0,0 +1,88 @@
+import atexit
+
+from django.conf import settings
+
+from .buffers import WriteBehindBuffer
+from .models import Chat, ChatReadState
+from .unread import recount
+
+
+FLUSH_INTERVAL = getattr(settings, "CHAT_RECEIPT_FLUSH_INTERVAL", 0.5)
+
+
+class ReceiptBuffer(WriteBehindBuffer):
+    """
+    Collects read acks in memory and writes them in bulk.
+
+    Only the highest message id per (chat, member) is kept, so a burst of
+    messages in a busy group turns into one row update per member instead
+    of one query per delivered message.
+    """
+
+    def __init__(self, interval=FLUSH_INTERVAL):
+        super().__init__(interval)
+
+    def ack(self, chat_id, user_id, msg_id):
+
+        key = (int(chat_id), user_id)
+
+        if msg_id > self.pending.get(key, 0):
+            self.pending[key] = msg_id
+
+        self.schedule()
+
+    def watermark(self, chat_id, user_id):
+        return self.pending.get((int(chat_id), user_id), 0)
+
+    def write(self, pending):
+        write_watermarks(pending)
+
+
+read_receipts = ReceiptBuffer()
+
+# closing sockets do not flush, so a reconnect storm stays batched; acks
+# still pending when the worker shuts down are written on the way out
+atexit.register(read_receipts.flush_now)
+
+
+def write_watermarks(pending):
+    """
+    Persist {(chat_id, user_id): msg_id} acks, never moving a watermark
+    back nor past the chat's newest message.
+    """
+
+    chat_ids = {chat_id for chat_id, _ in pending}
+    user_ids = {user_id for _, user_id in pending}
+
+    # ids come from clients; one past the end would hide every later message
+    newest = dict(Chat.objects.filter(id__in=chat_ids).values_list("id", "last_message_id"))
+
+    pending = {
+        (chat_id, user_id): min(msg_id, newest.get(chat_id) or 0)
+        for (chat_id, user_id), msg_id in pending.items()
+    }
+
+    current = {
+        (state.chat_id, state.user_id): state.last_read_message_id
+        for state in ChatReadState.objects.filter(chat_id__in=chat_ids, user_id__in=user_ids)
+    }
+
+    rows = [
+        ChatReadState(chat_id=chat_id, user_id=user_id, last_read_message_id=msg_id)
+        for (chat_id, user_id), msg_id in pending.items()
+        if msg_id > current.get((chat_id, user_id), 0)
+    ]
+
+    if rows:
+        ChatReadState.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["chat", "user"],
+            update_fields=["last_read_message_id"],
+        )
+
+        recount(ChatReadState.objects.filter(chat_id__in=chat_ids, user_id__in=user_ids))
+
+
+def mark_read_up_to(chat_id, user_id, msg_id):
+    write_watermarks({(int(chat_id), user_id): msg_id})
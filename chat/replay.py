@@ -0,0 +1,129 @@
+"""
+Replay of recent chat events for reconnecting sockets.
+
+Every event that changes what a chat shows (a message, an edit, a
+delete, reactions, a pin) gets the chat's next sequence number from a
+counter in the cache (chat/broadcast.py), shared by all workers when
+the cache is. Each worker keeps the last ``REPLAY_SIZE`` events of the
+chats its sockets are in, as they arrive from the channel layer. A
+client that
+reconnects sends the last sequence number it saw and gets the events
+it missed, or, when the buffer has rolled past it or has holes, the
+missing messages from the database.
+"""
+
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from .feed import message_feed
+from .history import MAX_PAGE_SIZE
+
+
+REPLAY_SIZE = getattr(settings, "CHAT_REPLAY_SIZE", 256)
+REPLAY_CHATS = getattr(settings, "CHAT_REPLAY_CHATS", 1000)
+
+
+class ChatEvents:
+
+    def __init__(self, size, floor):
+        self.events = deque()
+        self.size = size
+        # everything after this sequence number has been seen or is in flight
+        self.floor = floor
+
+    @property
+    def last(self):
+        return self.events[-1][0] if self.events else self.floor
+
+    def add(self, seq, event):
+
+        # events sent by two workers at once can arrive out of order
+        position = len(self.events)
+        while position and self.events[position - 1][0] >= seq:
+            if self.events[position - 1][0] == seq:
+                return
+            position -= 1
+
+        self.events.insert(position, (seq, event))
+
+        while len(self.events) > self.size:
+            self.floor = self.events.popleft()[0]
+
+    def since(self, seq):
+
+        if seq < self.floor or seq > self.last:
+            return None
+
+        missed = [(s, event) for s, event in self.events if s > seq]
+
+        # a hole is an event this worker never received
+        expected = range(seq + 1, self.last + 1)
+        if [s for s, _ in missed] != list(expected):
+            return None
+
+        return [event for _, event in missed]
+
+
+class ReplayBuffer:
+    """
+    Per-process ring buffers of recent events, one per chat, for the
+    ``REPLAY_CHATS`` most recently active chats.
+    """
+
+    def __init__(self, size=REPLAY_SIZE, chats=REPLAY_CHATS):
+        self.size = size
+        self.chats = chats
+        self.buffers = OrderedDict()
+
+    def record(self, chat_id, event):
+
+        seq = event.get("seq")
+        if seq is None:
+            return
+
+        buffer = self.buffers.get(chat_id)
+
+        # older than anything kept: the counter restarted (cache flushed)
+        if buffer is not None and seq <= buffer.floor:
+            buffer = None
+
+        if buffer is None:
+            buffer = ChatEvents(self.size, seq - 1)
+
+        buffer.add(seq, event)
+
+        self.buffers[chat_id] = buffer
+        self.buffers.move_to_end(chat_id)
+
+        if len(self.buffers) > self.chats:
+            self.buffers.popitem(last=False)
+
+    def since(self, chat_id, seq):
+        """
+        Events after ``seq`` in order, or None if this worker cannot tell.
+        """
+
+        buffer = self.buffers.get(chat_id)
+
+        if buffer is None:
+            return None
+
+        return buffer.since(seq)
+
+    def clear(self):
+        self.buffers.clear()
+
+
+replay_buffer = ReplayBuffer()
+
+
+def missed_messages(chat_id, after_id, limit=MAX_PAGE_SIZE):
+    """
+    (messages, complete) after message ``after_id``, oldest first; not
+    complete when more than ``limit`` were missed.
+    """
+
+    messages = list(message_feed(chat_id).filter(id__gt=after_id).order_by("id")[:limit + 1])
+
+    return messages[:limit], len(messages) <= limit
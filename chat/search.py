@@ -0,0 +1,206 @@
+"""
+Message search.
+
+SQLite keeps an FTS5 table ``chat_message_fts`` (rowid = message id) and
+PostgreSQL uses a GIN index on ``to_tsvector('simple', text)``; both are
+created by migration 0011. The index is updated from signals when a
+message is created, edited, deleted or removed, see chat/signals.py.
+
+Results are ranked, limited to chats the user is a member of, and paged
+with an opaque cursor holding the (score, id) of the last hit.
+"""
+
+import base64
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+
+from .models import Message
+
+
+PAGE_SIZE = getattr(settings, "CHAT_SEARCH_PAGE_SIZE", 20)
+
+# snippet markers that cannot appear in user text, turned into <mark> after escaping
+START, STOP = "\x02", "\x03"
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def highlight(snippet):
+    return escape(snippet).replace(START, "<mark>").replace(STOP, "</mark>")
+
+
+def encode_cursor(score, msg_id):
+    return base64.urlsafe_b64encode(f"{score!r}:{msg_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+
+    if not cursor:
+        return None
+
+    try:
+        score, msg_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return float(score), int(msg_id)
+    except ValueError:
+        return None
+
+
+class Fts5Backend:
+
+    def index(self, messages):
+
+        rows = [(m.id, m.text) for m in messages if not m.is_deleted and m.text]
+
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM chat_message_fts WHERE rowid = %s", [(m.id,) for m in messages])
+
+            if rows:
+                cursor.executemany("INSERT INTO chat_message_fts(rowid, text) VALUES (%s, %s)", rows)
+
+    def remove(self, ids):
+
+        with connection.cursor() as cursor:
+            cursor.executemany("DELETE FROM chat_message_fts WHERE rowid = %s", [(i,) for i in ids])
+
+    def rebuild(self):
+
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM chat_message_fts")
+            cursor.execute(
+                "INSERT INTO chat_message_fts(rowid, text) "
+                "SELECT id, text FROM chat_message WHERE is_deleted = 0 AND text != ''"
+            )
+
+    def match_expression(self, query):
+
+        tokens = TOKEN_RE.findall(query)
+
+        if not tokens:
+            return None
+
+        # every word must match, the last one as a prefix while the user is still typing
+        quoted = [f'"{token}"' for token in tokens]
+        quoted[-1] += "*"
+
+        return " ".join(quoted)
+
+    def search(self, user_id, query, after=None, limit=PAGE_SIZE):
+
+        match = self.match_expression(query)
+
+        if match is None:
+            return []
+
+        # bm25 is lower for better matches, so ascending (score, id) is best first
+        sql = f"""
+            SELECT m.id, bm25(chat_message_fts) AS score,
+                   snippet(chat_message_fts, 0, '{START}', '{STOP}', '…', 12)
+            FROM chat_message_fts
+            JOIN chat_message m ON m.id = chat_message_fts.rowid
+            JOIN chat_chat_participants p ON p.chat_id = m.chat_id AND p.user_id = %s
+            WHERE chat_message_fts MATCH %s AND m.is_deleted = 0
+        """
+        params = [user_id, match]
+
+        if after:
+            sql += " AND (bm25(chat_message_fts) > %s OR (bm25(chat_message_fts) = %s AND m.id > %s))"
+            params += [after[0], after[0], after[1]]
+
+        sql += " ORDER BY score, m.id LIMIT %s"
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+class PostgresBackend:
+
+    # the GIN expression index covers Message.text directly, nothing to maintain
+    def index(self, messages):
+        pass
+
+    def remove(self, ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, user_id, query, after=None, limit=PAGE_SIZE):
+
+        if not TOKEN_RE.search(query):
+            return []
+
+        # ts_rank is higher for better matches, negated so ascending (score, id) is best first
+        sql = f"""
+            SELECT m.id, -ts_rank(to_tsvector('simple', m.text), q) AS score,
+                   ts_headline('simple', m.text, q,
+                               'StartSel={START}, StopSel={STOP}, MaxWords=24, MinWords=8')
+            FROM chat_message m
+            JOIN chat_chat_participants p ON p.chat_id = m.chat_id AND p.user_id = %s,
+                 websearch_to_tsquery('simple', %s) q
+            WHERE to_tsvector('simple', m.text) @@ q AND NOT m.is_deleted
+        """
+        params = [user_id, query]
+
+        if after:
+            sql += (
+                " AND (-ts_rank(to_tsvector('simple', m.text), q) > %s"
+                " OR (-ts_rank(to_tsvector('simple', m.text), q) = %s AND m.id > %s))"
+            )
+            params += [after[0], after[0], after[1]]
+
+        sql += " ORDER BY score, m.id LIMIT %s"
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+BACKENDS = {
+    "sqlite": Fts5Backend,
+    "postgresql": PostgresBackend,
+}
+
+
+def get_backend():
+    return BACKENDS[connection.vendor]()
+
+
+def search_messages(user_id, query, cursor=None, limit=PAGE_SIZE):
+    """
+    Return (hits, next_cursor). Each hit has the message id, chat id,
+    sender, time and an HTML-safe snippet with matches in <mark>.
+    """
+
+    rows = get_backend().search(user_id, query, after=decode_cursor(cursor), limit=limit + 1)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+
+    messages = Message.objects.select_related("sender", "chat").in_bulk([row[0] for row in rows])
+
+    hits = []
+    for msg_id, score, snippet in rows:
+        msg = messages.get(msg_id)
+
+        # deleted between the two queries
+        if msg is None:
+            continue
+
+        hits.append({
+            "id": msg.id,
+            "chat_id": msg.chat_id,
+            "chat": msg.chat.name,
+            "username": msg.sender.username,
+            "time": msg.timestamp.strftime("%d.%m %H:%M"),
+            "snippet": highlight(snippet),
+        })
+
+    return hits, next_cursor
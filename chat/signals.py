@@ -1,10 +1,169 @@
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
 from django.contrib.auth.models import User
-from .models import Profile
+from .models import Profile, Chat, Message, ChatReadState
+from .unread import increment_unread, add_read_states
+from .membership import forget_members
+from .broadcast import group_broadcast_sync
+from .search import get_backend
+from .feed import record_activity
+from .storage import BLOB_FIELDS, adjust_refs, blob_fields
+from .directory import user_entry, group_entry, save_entries, remove_entry
 
 
 @receiver(post_save, sender=User)
 def create_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
+
+
+# directory: login saves only last_login, the name is untouched
+@receiver(post_save, sender=User)
+def index_user(sender, instance, created, update_fields, **kwargs):
+    if created or update_fields is None or "username" in update_fields:
+        save_entries([user_entry(instance)])
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    remove_entry("user", instance.pk)
+
+
+@receiver(post_save, sender=Chat)
+def index_group(sender, instance, **kwargs):
+    if instance.type == "group":
+        save_entries([group_entry(instance)])
+
+
+@receiver(post_delete, sender=Chat)
+def unindex_group(sender, instance, **kwargs):
+    remove_entry("group", instance.pk)
+
+
+# sent by the ingest pipeline after bulk_create, which skips post_save
+messages_created = Signal()
+
+
+@receiver(post_save, sender=Message)
+def count_unread(sender, instance, created, **kwargs):
+    if created:
+        increment_unread([instance])
+
+
+@receiver(messages_created)
+def count_unread_batch(sender, messages, **kwargs):
+    increment_unread(messages)
+
+
+# chat list ordering and preview
+@receiver(post_save, sender=Message)
+def track_activity(sender, instance, created, **kwargs):
+    if created:
+        record_activity([instance])
+
+
+@receiver(messages_created)
+def track_activity_batch(sender, messages, **kwargs):
+    record_activity(messages)
+
+
+# search index: created, edited and soft-deleted messages all go through save()
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    get_backend().index([instance])
+
+
+@receiver(messages_created)
+def index_message_batch(sender, messages, **kwargs):
+    get_backend().index(messages)
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    get_backend().remove([instance.id])
+
+
+# blob references: remember what a row pointed at when loaded, diff on save
+def remember_blobs(sender, instance, **kwargs):
+    instance._blob_fields = blob_fields(instance)
+
+
+def count_blob_refs(sender, instance, created, **kwargs):
+
+    before = {} if created else instance._blob_fields
+    after = blob_fields(instance)
+
+    added, removed = [], []
+
+    for field, names in after.items():
+        if created or field in before:
+            added += [name for name in names if name not in before.get(field, [])]
+            removed += [name for name in before.get(field, []) if name not in names]
+
+    if added or removed:
+        adjust_refs(added, removed)
+
+    instance._blob_fields = after
+
+
+def release_blobs(sender, instance, **kwargs):
+    adjust_refs([], [name for names in instance._blob_fields.values() for name in names])
+
+
+for model in BLOB_FIELDS:
+    post_init.connect(remember_blobs, sender=model)
+    post_save.connect(count_blob_refs, sender=model)
+    post_delete.connect(release_blobs, sender=model)
+
+
+def member_pairs(instance, reverse, pk_set):
+
+    # chat.participants.add(user) or user.chats.add(chat)
+    if reverse:
+        return [(chat_id, instance.pk) for chat_id in pk_set or ()]
+
+    return [(instance.pk, user_id) for user_id in pk_set or ()]
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def sync_read_states(sender, instance, action, reverse, pk_set, **kwargs):
+
+    pairs = member_pairs(instance, reverse, pk_set)
+
+    if action == "post_add" and pairs:
+        add_read_states(pairs)
+
+    elif action == "post_remove":
+        for chat_id, user_id in pairs:
+            ChatReadState.objects.filter(chat_id=chat_id, user_id=user_id).delete()
+
+    elif action == "pre_clear":
+        if reverse:
+            ChatReadState.objects.filter(user_id=instance.pk).delete()
+        else:
+            ChatReadState.objects.filter(chat_id=instance.pk).delete()
+
+
+@receiver(m2m_changed, sender=Chat.participants.through)
+def invalidate_membership(sender, instance, action, reverse, pk_set, **kwargs):
+
+    if action in ("post_add", "post_remove"):
+        forget_members(member_pairs(instance, reverse, pk_set))
+
+    elif action == "pre_clear":
+        current = instance.chats if reverse else instance.participants
+        forget_members(member_pairs(instance, reverse, set(current.values_list("pk", flat=True))))
+
+
+# multiplexed sockets (UserConsumer) follow their user into and out of chats
+@receiver(m2m_changed, sender=Chat.participants.through)
+def announce_membership(sender, instance, action, reverse, pk_set, **kwargs):
+
+    if action not in ("post_add", "post_remove"):
+        return
+
+    for chat_id, user_id in member_pairs(instance, reverse, pk_set):
+        event = {"type": "membership_update", "chat_id": chat_id, "member": action == "post_add"}
+
+        transaction.on_commit(lambda user_id=user_id, event=event: group_broadcast_sync(f"user_{user_id}", event))
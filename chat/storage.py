@@ -0,0 +1,157 @@
+"""
+Content-addressed media storage.
+
+Every file saved through ContentAddressedStorage is stored once under
+``blobs/ab/cd/<sha256><ext>``, whatever field or upload it came from:
+a second upload of the same bytes hashes, finds the blob and writes
+nothing. Message and Profile rows that point at a blob (files, voice
+messages, avatars and their thumbnails) hold a reference on its Blob
+row; the counts are kept by the signals in chat/signals.py and
+``gc_media`` deletes blobs nobody references.
+"""
+
+import hashlib
+import os
+
+from django.core.files import File
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+
+from .models import Blob, Message, Profile
+
+
+BLOB_DIR = "blobs"
+
+BLOCK_SIZE = 64 * 1024
+
+# file fields whose values are blob references
+BLOB_FIELDS = {
+    Message: ("file", "audio"),
+    Profile: ("avatar", "thumbnails"),
+}
+
+
+def content_hash(content):
+
+    digest = hashlib.sha256()
+
+    content.seek(0)
+    for block in content.chunks(BLOCK_SIZE):
+        digest.update(block)
+    content.seek(0)
+
+    return digest.hexdigest()
+
+
+def blob_name(digest, name):
+
+    ext = os.path.splitext(name)[1].lower()[:16]
+
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def __init__(self, **kwargs):
+        # two uploads of the same bytes racing write identical content
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(**kwargs)
+
+    def save(self, name, content, max_length=None):
+
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        # finished resumable uploads arrive already hashed
+        digest = getattr(content, "sha256", None) or content_hash(content)
+        name = blob_name(digest, name or content.name or "")
+
+        if not self.exists(name):
+            name = self._save(name, content)
+
+        Blob.objects.get_or_create(name=name, defaults={"sha256": digest, "size": content.size})
+
+        return name
+
+
+def publish(names):
+    """
+    Let every logged-in user read these blobs (avatars and their thumbnails).
+    """
+    Blob.objects.filter(name__in=list(names)).update(public=True)
+
+
+class HashedStaticStorage(ManifestStaticFilesStorage):
+    """
+    Static files with the content hash in their names after collectstatic,
+    so chat/files.py can let browsers cache them for good. Files missing
+    from the manifest (no collectstatic yet, tests) keep their plain name.
+    """
+
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIR + "/")
+
+
+def stored_names(value):
+    """
+    Blob names held by one field value: a file field, or a dict of names
+    like Profile.thumbnails.
+    """
+
+    if isinstance(value, dict):
+        return [name for name in value.values() if is_blob(name)]
+
+    name = getattr(value, "name", value)
+
+    return [name] if is_blob(name) else []
+
+
+def blob_fields(instance):
+    """
+    {field: blob names} for the instance's loaded blob fields; deferred
+    fields are left out rather than fetched.
+    """
+
+    return {
+        field: stored_names(getattr(instance, field))
+        for field in BLOB_FIELDS[type(instance)]
+        if field in instance.__dict__
+    }
+
+
+def adjust_refs(added, removed):
+
+    for name in added:
+        Blob.objects.filter(name=name).update(refs=F("refs") + 1)
+
+    for name in removed:
+        Blob.objects.filter(name=name, refs__gt=0).update(refs=F("refs") - 1)
+
+
+def recount_refs():
+    """
+    Rebuild every Blob.refs from the rows that point at it.
+    """
+
+    counts = {}
+
+    for model, fields in BLOB_FIELDS.items():
+        for field in fields:
+            for value in model.objects.values_list(field, flat=True).iterator():
+                for name in stored_names(value):
+                    counts[name] = counts.get(name, 0) + 1
+
+    Blob.objects.exclude(name__in=counts).update(refs=0)
+
+    for name, refs in counts.items():
+        Blob.objects.filter(name=name).update(refs=refs)
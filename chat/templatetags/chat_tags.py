@@ -1,7 +1,25 @@
 from django import template
 
+from chat import actions, thumbnails
+
 register = template.Library()
 
 @register.filter
 def get_item(list, index):
     return list[index]
+
+
+@register.simple_tag
+def avatar_url(profile, size):
+    """
+    {% avatar_url user.profile 48 %} - the thumbnail closest to 48px.
+    """
+    return thumbnails.avatar_url(profile, int(size))
+
+
+@register.filter
+def reaction_counts(msg):
+    """
+    (emoji, count) pairs from the message's prefetched reaction totals.
+    """
+    return actions.reaction_counts(msg).items()
@@ -1,3 +1,1671 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+
+from .models import Blob, Chat, ChatReadState, Message, Profile, Reaction, ReactionCount, Upload
+from . import actions
+from .broadcast import group_event
+from .directory import autocomplete, lookup
+from .files import FileServer, parse_range
+from .feed import record_activity, user_chats
+from .history import history_page, serialize_message
+from .ingest import MessageIngest
+from .layers import ShardedRedisChannelLayer
+from .membership import is_member, local_members
+from .outbox import WINDOW, Outbox, OutboxMetrics
+from .presence import PresenceTracker, presence_key, slot_key
+from .protocol import CompactJsonCodec, LEGACY, MsgpackCodec, msgpack, negotiate
+from .routing import websocket_urlpatterns
+from .search import get_backend, search_messages
+from .thumbnails import SIZES, avatar_url, build_thumbnails, log_failure
+from .typing import TypingSnapshot, TypingThrottle, typing_throttle
+from .receipts import ReceiptBuffer, mark_read_up_to
+from .replay import ReplayBuffer, replay_buffer
+from .unread import get_unread
+
+try:
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection
+except ImportError:
+    fakeredis = None
+
+
+class ReadReceiptTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.carol = User.objects.create(username="carol")
+
+        self.chat = Chat.objects.create(name="group", type="group")
+        self.chat.participants.add(self.alice, self.bob, self.carol)
+
+    def send(self, user, text="hi"):
+        return Message.objects.create(chat=self.chat, sender=user, text=text)
+
+    def test_unread_count_is_per_member(self):
+        first = self.send(self.alice)
+        self.send(self.alice)
+
+        mark_read_up_to(self.chat.id, self.bob.id, first.id)
+
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 1)
+        self.assertEqual(get_unread(self.chat.id, self.carol.id), 2)
+        self.assertEqual(get_unread(self.chat.id, self.alice.id), 0)
+
+    def test_watermark_never_moves_back(self):
+        first = self.send(self.alice)
+        second = self.send(self.alice)
+
+        mark_read_up_to(self.chat.id, self.bob.id, second.id)
+        mark_read_up_to(self.chat.id, self.bob.id, first.id)
+
+        state = ChatReadState.objects.get(chat=self.chat, user=self.bob)
+        self.assertEqual(state.last_read_message_id, second.id)
+
+    def test_watermark_stops_at_the_newest_message(self):
+        last = self.send(self.alice)
+
+        mark_read_up_to(self.chat.id, self.bob.id, last.id + 10 ** 9)
+        self.send(self.alice)
+
+        state = ChatReadState.objects.get(chat=self.chat, user=self.bob)
+        self.assertEqual(state.last_read_message_id, last.id)
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 1)
+
+    def test_counter_lookup_is_cached(self):
+        self.send(self.alice)
+
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread(self.chat.id, self.bob.id), 1)
+
+    def test_new_messages_bump_cached_counters(self):
+        self.send(self.alice)
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.alice)
+            self.send(self.carol)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread(self.chat.id, self.bob.id), 3)
+
+    def test_rolled_back_messages_leave_cached_counters_alone(self):
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.send(self.alice)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 0)
+
+    def test_new_member_starts_caught_up(self):
+        self.send(self.alice)
+
+        dave = User.objects.create(username="dave")
+        self.chat.participants.add(dave)
+
+        self.assertEqual(get_unread(self.chat.id, dave.id), 0)
+
+        self.chat.participants.remove(dave)
+        self.assertFalse(ChatReadState.objects.filter(user=dave).exists())
+
+    def test_rebuild_command_fixes_drift(self):
+        self.send(self.alice)
+        self.send(self.alice)
+
+        ChatReadState.objects.update(unread_count=42)
+
+        call_command("rebuild_unread_counters", stdout=StringIO())
+
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 2)
+        self.assertEqual(get_unread(self.chat.id, self.alice.id), 0)
+
+
+class ReceiptBufferTests(TransactionTestCase):
+
+    def test_acks_are_coalesced_into_one_flush(self):
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+
+        chat = Chat.objects.create(name="group", type="group")
+        chat.participants.add(alice, bob)
+
+        ids = [Message.objects.create(chat=chat, sender=alice, text=str(i)).id for i in range(5)]
+
+        buffer = ReceiptBuffer(interval=60)
+
+        async def deliver():
+            for msg_id in ids:
+                buffer.ack(chat.id, bob.id, msg_id)
+            self.assertEqual(buffer.watermark(chat.id, bob.id), ids[-1])
+            await buffer.flush()
+
+        async_to_sync(deliver)()
+
+        state = ChatReadState.objects.get(chat=chat, user=bob)
+        self.assertEqual(state.last_read_message_id, ids[-1])
+        self.assertEqual(buffer.pending, {})
+
+    def test_pending_acks_are_written_on_shutdown(self):
+        alice = User.objects.create(username="alice")
+        bob = User.objects.create(username="bob")
+
+        chat = Chat.objects.create(name="group", type="group")
+        chat.participants.add(alice, bob)
+
+        msg = Message.objects.create(chat=chat, sender=alice, text="hi")
+
+        buffer = ReceiptBuffer(interval=60)
+
+        async def deliver():
+            buffer.ack(chat.id, bob.id, msg.id)
+
+        async_to_sync(deliver)()
+        self.assertEqual(ChatReadState.objects.get(chat=chat, user=bob).last_read_message_id, 0)
+
+        # what atexit runs
+        buffer.flush_now()
+
+        self.assertEqual(ChatReadState.objects.get(chat=chat, user=bob).last_read_message_id, msg.id)
+        self.assertEqual(buffer.pending, {})
+
+
+class PresenceTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username="alice")
+
+    def test_only_real_transitions_are_written(self):
+        tracker = PresenceTracker(interval=60)
+
+        async def tabs():
+            self.assertTrue(await tracker.connect(self.alice.id))
+            self.assertFalse(await tracker.connect(self.alice.id))
+            await tracker.flush()
+
+        async_to_sync(tabs)()
+        self.assertTrue(Profile.objects.get(user=self.alice).online)
+
+        async def close_tabs():
+            # closing one of two tabs keeps the user online
+            self.assertFalse(await tracker.disconnect(self.alice.id))
+            self.assertTrue(tracker.is_online(self.alice.id))
+
+            self.assertTrue(await tracker.disconnect(self.alice.id))
+            await tracker.flush()
+
+        async_to_sync(close_tabs)()
+
+        profile = Profile.objects.get(user=self.alice)
+        self.assertFalse(profile.online)
+        self.assertIsNotNone(profile.last_seen)
+
+    def test_other_worker_keeps_user_online(self):
+        worker_a = PresenceTracker(interval=60)
+        worker_b = PresenceTracker(interval=60)
+
+        async def run():
+            self.assertTrue(await worker_a.connect(self.alice.id))
+            self.assertFalse(await worker_b.connect(self.alice.id))
+            self.assertFalse(await worker_a.disconnect(self.alice.id))
+            self.assertTrue(await worker_b.disconnect(self.alice.id))
+
+            await worker_a.flush()
+            await worker_b.flush()
+
+        async_to_sync(run)()
+
+    def test_workers_starting_together_get_their_own_slots(self):
+        workers = [PresenceTracker(interval=60) for _ in range(3)]
+
+        async def run():
+            await asyncio.gather(*[worker.start() for worker in workers])
+
+        async_to_sync(run)()
+
+        self.assertEqual(sorted(worker.slot for worker in workers), [0, 1, 2])
+
+    def test_crashed_worker_goes_stale_after_ttl(self):
+        crashed = PresenceTracker(interval=60)
+        survivor = PresenceTracker(interval=60)
+
+        async def run():
+            self.assertTrue(await crashed.connect(self.alice.id))
+            await survivor.start()
+            await crashed.flush()
+
+        async_to_sync(run)()
+
+        # the worker dies without disconnecting, its keys run out
+        cache.delete_many([slot_key(crashed.slot), presence_key(self.alice.id, crashed.slot)])
+
+        self.assertFalse(survivor.is_online(self.alice.id))
+        self.assertEqual(survivor.sweep(), [self.alice.id])
+        self.assertFalse(Profile.objects.get(user=self.alice).online)
+
+        # settled once
+        self.assertEqual(survivor.sweep(), [])
+
+    def test_sweep_keeps_users_connected_elsewhere(self):
+        crashed = PresenceTracker(interval=60)
+        worker_b = PresenceTracker(interval=60)
+
+        async def run():
+            self.assertTrue(await crashed.connect(self.alice.id))
+            self.assertFalse(await worker_b.connect(self.alice.id))
+            await crashed.flush()
+
+        async_to_sync(run)()
+
+        cache.delete(slot_key(crashed.slot))
+
+        self.assertEqual(worker_b.sweep(), [])
+        self.assertTrue(Profile.objects.get(user=self.alice).online)
+
+    def test_claiming_a_dead_slot_settles_its_users(self):
+        crashed = PresenceTracker(interval=60)
+        successor = PresenceTracker(interval=60)
+
+        async def run():
+            self.assertTrue(await crashed.connect(self.alice.id))
+            await crashed.flush()
+
+            cache.delete_many([slot_key(crashed.slot), presence_key(self.alice.id, crashed.slot)])
+
+            await successor.start()
+
+        async_to_sync(run)()
+
+        self.assertEqual(successor.slot, crashed.slot)
+        self.assertFalse(Profile.objects.get(user=self.alice).online)
+
+
+class IngestTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.chat = Chat.objects.create(name="group", type="group")
+        self.chat.participants.add(self.alice, self.bob)
+
+    def test_burst_is_one_batch_in_order(self):
+        ingest = MessageIngest(max_batch=100, max_latency=0.01)
+
+        async def burst():
+            return await asyncio.gather(*[
+                ingest.submit(self.chat.id, self.alice.id, str(i)) for i in range(20)
+            ])
+
+        with CaptureQueriesContext(connection) as ctx:
+            messages = async_to_sync(burst)()
+
+        inserts = [q for q in ctx.captured_queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual([m.text for m in messages], [str(i) for i in range(20)])
+        self.assertEqual([m.id for m in messages], sorted(m.id for m in messages))
+        # reserved with the write, in the same order
+        self.assertEqual([m.seq for m in messages], list(range(1, 21)))
+
+        self.assertEqual(get_unread(self.chat.id, self.bob.id), 20)
+
+    def test_max_batch_splits_and_bad_reply_is_dropped(self):
+        ingest = MessageIngest(max_batch=2, max_latency=1)
+
+        async def send():
+            return await asyncio.gather(
+                ingest.submit(self.chat.id, self.alice.id, "a"),
+                ingest.submit(self.chat.id, self.alice.id, "b", reply_to_id=999999),
+            )
+
+        first, second = async_to_sync(send)()
+
+        self.assertIsNone(second.reply_to_id)
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 2)
+
+    def test_bad_row_fails_only_its_own_submit(self):
+        ingest = MessageIngest(max_batch=3, max_latency=1)
+
+        async def send():
+            return await asyncio.gather(
+                ingest.submit(self.chat.id, self.alice.id, "a"),
+                ingest.submit(999999, self.alice.id, "lost"),
+                ingest.submit(self.chat.id, self.alice.id, "b"),
+                return_exceptions=True,
+            )
+
+        first, bad, last = async_to_sync(send)()
+
+        self.assertIsInstance(bad, IntegrityError)
+        self.assertEqual([first.text, last.text], ["a", "b"])
+        self.assertLess(first.id, last.id)
+        self.assertEqual(list(Message.objects.filter(chat=self.chat).values_list("text", flat=True)), ["a", "b"])
+
+
+class ConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_members.clear()
+        typing_throttle.last_sent.clear()
+        replay_buffer.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.chat = Chat.objects.create(name="group", type="group")
+        self.chat.participants.add(self.alice, self.bob)
+
+    async def open(self, user, chat_id=None, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns),
+            f"/ws/chat/{chat_id or self.chat.id}/",
+            subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def open_user(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/user/", subprotocols=subprotocols)
+        communicator.scope["user"] = user
+
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def drain(self, communicator):
+        frames = []
+        while not await communicator.receive_nothing(timeout=0.05):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    def test_message_reaches_other_member(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob)
+
+            await alice.send_json_to({"message": "hello"})
+
+            received = []
+            while not any("message" in frame for frame in received):
+                received.append(await bob.receive_json_from())
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return received
+
+        frames = async_to_sync(run)()
+
+        message = next(frame for frame in frames if "message" in frame)
+        self.assertEqual(message["username"], "alice")
+        self.assertEqual(message["message"], "hello")
+        self.assertTrue(Message.objects.filter(chat=self.chat, text="hello").exists())
+
+    def test_frames_past_the_ack_window_wait_for_the_client(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            layer = get_channel_layer()
+
+            for i in range(WINDOW + 3):
+                await layer.group_send(f"chat_{self.chat.id}", group_event("chat_delta", "delete", {"id": i}))
+
+            first = await self.drain(alice)
+
+            await alice.send_json_to({"action": "ack", "frames": WINDOW})
+            rest = await self.drain(alice)
+
+            await alice.disconnect()
+            return first, rest
+
+        first, rest = async_to_sync(run)()
+
+        self.assertEqual(len(first), WINDOW)
+        self.assertEqual([frame["delete"]["id"] for frame in rest], [WINDOW, WINDOW + 1, WINDOW + 2])
+
+    def test_actions_broadcast_deltas(self):
+        msg = Message.objects.create(chat=self.chat, sender=self.alice, text="helo")
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob)
+
+            await alice.send_json_to({"action": "edit", "id": msg.id, "text": "hello"})
+            # not bob's message, dropped
+            await bob.send_json_to({"action": "delete", "id": msg.id})
+            await bob.send_json_to({"action": "pin", "id": msg.id})
+
+            received = []
+            while not any("pin" in frame for frame in received):
+                received.append(await bob.receive_json_from())
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return received
+
+        frames = [frame for frame in async_to_sync(run)() if "presence" not in frame]
+
+        self.assertEqual(frames, [
+            {"edit": {"id": msg.id, "message": "hello", "edited": True, "seq": 1}},
+            {"pin": {"id": msg.id, "username": "alice", "message": "hello", "seq": 2}},
+        ])
+        self.assertFalse(Message.objects.get(id=msg.id).is_deleted)
+
+    def test_reaction_burst_is_one_frame(self):
+        msg = Message.objects.create(chat=self.chat, sender=self.alice, text="hello")
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob)
+
+            await alice.send_json_to({"action": "react", "id": msg.id, "emoji": "👍"})
+            await bob.send_json_to({"action": "react", "id": msg.id, "emoji": "👍"})
+            await alice.send_json_to({"action": "react", "id": msg.id, "emoji": "🔥"})
+
+            frames = [await alice.receive_json_from()]
+            while "reactions" not in frames[-1]:
+                frames.append(await alice.receive_json_from())
+
+            quiet = await alice.receive_nothing(timeout=0.5)
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames[-1], quiet
+
+        frame, quiet = async_to_sync(run)()
+
+        # one broadcast for the burst: a single sequence number went out
+        self.assertEqual(frame, {"reactions": {"id": msg.id, "reactions": {"👍": 2, "🔥": 1}, "seq": 1}})
+        self.assertTrue(quiet)
+
+    def test_reconnect_replays_the_gap(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob)
+
+            await alice.send_json_to({"message": "before"})
+            frames = [await bob.receive_json_from()]
+            while "message" not in frames[-1]:
+                frames.append(await bob.receive_json_from())
+            seen = frames[-1]["seq"]
+
+            await bob.disconnect()
+
+            await alice.send_json_to({"message": "missed"})
+            await alice.send_json_to({"message": "also missed"})
+            await self.drain(alice)
+
+            bob, _ = await self.open(self.bob)
+            await bob.send_json_to({"action": "resume", "seq": seen, "last_id": frames[-1]["id"]})
+            replayed = [frame for frame in await self.drain(bob) if "message" in frame]
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return seen, replayed
+
+        seen, replayed = async_to_sync(run)()
+
+        self.assertEqual([frame["message"] for frame in replayed], ["missed", "also missed"])
+        self.assertEqual([frame["seq"] for frame in replayed], [seen + 1, seen + 2])
+
+    def test_reconnect_falls_back_to_the_database(self):
+        first = Message.objects.create(chat=self.chat, sender=self.alice, text="seen")
+        Message.objects.create(chat=self.chat, sender=self.alice, text="missed")
+
+        async def run():
+            bob, _ = await self.open(self.bob)
+
+            # nothing buffered on this worker for a sequence number this old
+            await bob.send_json_to({"action": "resume", "seq": 5, "last_id": first.id})
+            frames = await self.drain(bob)
+
+            await bob.disconnect()
+            return frames
+
+        replay = next(frame["replay"] for frame in async_to_sync(run)() if "replay" in frame)
+
+        self.assertEqual([m["message"] for m in replay["messages"]], ["missed"])
+        self.assertTrue(replay["complete"])
+
+    def test_user_socket_gets_every_chat_tagged_with_its_id(self):
+        other = Chat.objects.create(name="other", type="group")
+        other.participants.add(self.alice, self.bob)
+
+        async def run():
+            alice, connected = await self.open_user(self.alice)
+            bob, _ = await self.open(self.bob, chat_id=other.id)
+
+            await bob.send_json_to({"message": "over here"})
+
+            frames = [await alice.receive_json_from()]
+            while "unread_count" not in frames[-1].get("event", {}):
+                frames.append(await alice.receive_json_from())
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return connected, [frame for frame in frames if "chat_id" in frame]
+
+        connected, frames = async_to_sync(run)()
+
+        self.assertTrue(connected)
+        self.assertEqual([frame["chat_id"] for frame in frames], [other.id, other.id])
+        self.assertEqual(frames[0]["event"]["message"], "over here")
+        self.assertEqual(frames[1]["event"], {"unread_count": 1})
+
+    def test_user_socket_routes_frames_by_chat_id(self):
+        outsider = User.objects.create(username="mallory")
+        private = Chat.objects.create(type="private")
+        private.participants.add(outsider, self.bob)
+
+        async def run():
+            mallory, _ = await self.open_user(outsider)
+            bob, _ = await self.open(self.bob)
+
+            # not a member: neither subscribed nor allowed to post
+            await mallory.send_json_to({"action": "subscribe", "chat_id": self.chat.id})
+            await mallory.send_json_to({"chat_id": self.chat.id, "message": "let me in"})
+            await mallory.send_json_to({"chat_id": private.id, "message": "wrong room"})
+
+            await bob.send_json_to({"message": "members only"})
+            bob_frames = await self.drain(bob)
+            mallory_frames = await self.drain(mallory)
+
+            await mallory.disconnect()
+            await bob.disconnect()
+            return bob_frames, mallory_frames
+
+        bob_frames, mallory_frames = async_to_sync(run)()
+
+        self.assertEqual([f["message"] for f in bob_frames if "message" in f], ["members only"])
+        self.assertFalse([f for f in mallory_frames if f.get("chat_id") == self.chat.id])
+        self.assertEqual(
+            list(Message.objects.filter(sender=outsider).values_list("chat_id", "text")),
+            [(private.id, "wrong room")],
+        )
+
+    def test_user_socket_follows_membership_and_unsubscribe(self):
+        later = Chat.objects.create(name="later", type="group")
+        later.participants.add(self.bob)
+
+        async def run():
+            alice, _ = await self.open_user(self.alice)
+
+            await database_sync_to_async(later.participants.add)(self.alice)
+            joined = await alice.receive_json_from()
+
+            await alice.send_json_to({"action": "unsubscribe", "chat_id": self.chat.id})
+            await self.drain(alice)
+
+            bob, _ = await self.open(self.bob)
+            await bob.send_json_to({"message": "muted"})
+            await self.drain(bob)
+
+            frames = await self.drain(alice)
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return joined, frames
+
+        joined, frames = async_to_sync(run)()
+
+        self.assertEqual(joined, {"membership": {"chat_id": later.id, "member": True}})
+        self.assertFalse([f for f in frames if "chat_id" in f])
+
+    def test_typing_burst_is_one_snapshot_for_others_only(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob)
+
+            for _ in range(5):
+                await alice.send_json_to({"typing": True})
+
+            await asyncio.sleep(0.2)
+            frames = await self.drain(alice), await self.drain(bob)
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames
+
+        alice_frames, bob_frames = async_to_sync(run)()
+
+        self.assertEqual([f for f in bob_frames if "typing_users" in f], [{"typing_users": ["alice"]}])
+        self.assertFalse([f for f in alice_frames if "typing_users" in f])
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_clients_get_one_frame_per_message(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob, subprotocols=["chat.v1.msgpack", "chat.v1.json"])
+
+            await alice.send_json_to({"message": "hello"})
+
+            frames = []
+            while not any(event[0] == 1 for frame in frames for event in frame):
+                frames.append(msgpack.unpackb(await bob.receive_from()))
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames[-1]
+
+        frame = async_to_sync(run)()
+
+        self.assertEqual(frame[0], [2, 0])
+        self.assertEqual(frame[1][:3], [1, Message.objects.get(text="hello").id, "alice"])
+
+    def test_unchanged_unread_is_not_resent(self):
+
+        async def run():
+            alice, _ = await self.open(self.alice)
+            bob, _ = await self.open(self.bob, subprotocols=["chat.v1.json"])
+
+            await alice.send_json_to({"message": "one"})
+            await alice.send_json_to({"message": "two"})
+
+            frames = []
+            while sum(event[0] == 1 for frame in frames for event in frame) < 2:
+                frames.append(json.loads(await bob.receive_from()))
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return frames
+
+        # alice's presence may land before her messages
+        first, second = [frame for frame in async_to_sync(run)() if frame[0][0] != 4]
+
+        self.assertEqual([event[0] for event in first], [2, 1])
+        self.assertEqual([event[0] for event in second], [1])
+        self.assertEqual(second[0][3], "two")
+
+    def test_non_member_is_rejected(self):
+        mallory = User.objects.create(username="mallory")
+
+        async def run():
+            communicator, connected = await self.open(mallory)
+            await communicator.disconnect()
+            return connected
+
+        self.assertFalse(async_to_sync(run)())
+
+
+class LoadTestCommandTests(TransactionTestCase):
+
+    def test_small_run_reports_latency(self):
+        out = StringIO()
+
+        call_command("loadtest", clients=4, chats=1, duration=1, rate=5, typing=0, churn=0, stdout=out)
+
+        report = dict(line.split(None, 1) for line in out.getvalue().splitlines())
+        self.assertGreater(int(report["delivered"]), 0)
+        self.assertGreater(float(report["latency_p50_ms"]), 0)
+        self.assertFalse(User.objects.filter(username__startswith="load-").exists())
+
+
+class TypingTests(TestCase):
+
+    def test_throttle_allows_one_event_per_window(self):
+        throttle = TypingThrottle(rate_limit=60)
+
+        self.assertTrue(throttle.allow(1, 1))
+        self.assertFalse(throttle.allow(1, 1))
+        self.assertTrue(throttle.allow(1, 2))
+        self.assertTrue(throttle.allow(2, 1))
+
+    def test_snapshot_coalesces_and_expires(self):
+        sent = []
+
+        async def send(usernames):
+            sent.append(usernames)
+
+        async def run():
+            snapshot = TypingSnapshot(send, interval=0.05, ttl=0.1)
+
+            snapshot.typing("alice")
+            snapshot.typing("bob")
+            snapshot.typing("alice")
+
+            await asyncio.sleep(0.3)
+
+        async_to_sync(run)()
+
+        self.assertEqual(sent, [["alice", "bob"], []])
+
+
+class OutboxTests(TestCase):
+
+    def run_outbox(self, feed, **options):
+        written = []
+        dropped = []
+        metrics = OutboxMetrics()
+
+        async def run():
+            gate = asyncio.Event()
+
+            async def write(events):
+                await gate.wait()
+                written.append(events)
+
+            async def overflow():
+                dropped.append(True)
+
+            outbox = Outbox(write, overflow, metrics=metrics, **options)
+            feed(outbox)
+
+            await asyncio.sleep(0)
+            snapshot = metrics.snapshot()
+
+            gate.set()
+            await asyncio.sleep(0.01)
+
+            return outbox, snapshot
+
+        outbox, snapshot = async_to_sync(run)()
+        return written, dropped, snapshot, outbox
+
+    def test_congested_socket_drops_lossy_events_and_coalesces(self):
+
+        def feed(outbox):
+            outbox.put("m1", "message")
+            outbox.put("u1", "unread", key="unread")
+            outbox.put("m2", "message")
+            outbox.put("t1", "typing", key="typing")
+            outbox.put("u2", "unread", key="unread")
+            outbox.put("m3", "message")
+
+        written, dropped, snapshot, outbox = self.run_outbox(feed, high=3, low=1, limit=10)
+
+        self.assertEqual(written, [["m1", "u2", "m2", "m3"]])
+        self.assertEqual(snapshot["dropped"], {"typing": 1})
+        self.assertEqual((snapshot["coalesced"], snapshot["congested"], snapshot["max_depth"]), (1, 1, 4))
+        self.assertIsNone(outbox.congested_since)
+        self.assertFalse(dropped)
+
+    def test_socket_over_the_limit_is_disconnected(self):
+
+        def feed(outbox):
+            for i in range(5):
+                outbox.put(f"m{i}", "message")
+
+        with self.assertLogs("chat.outbox", "WARNING"):
+            written, dropped, snapshot, _ = self.run_outbox(feed, high=2, low=1, limit=4)
+
+        self.assertEqual(dropped, [True])
+        self.assertEqual(written, [])
+        self.assertEqual((snapshot["disconnected"], snapshot["sockets"]), (1, 0))
+
+    def test_writer_waits_for_acks_past_the_window(self):
+        written = []
+
+        async def run():
+
+            async def write(events):
+                written.append(events)
+
+            async def overflow():
+                pass
+
+            outbox = Outbox(write, overflow, window=2, batch=1, metrics=OutboxMetrics())
+
+            for i in range(4):
+                outbox.put(f"m{i}", "message")
+
+            await asyncio.sleep(0.01)
+            before = list(written)
+
+            # acks beyond what was sent are ignored
+            outbox.ack(5)
+            outbox.ack(1)
+            await asyncio.sleep(0.01)
+
+            return before, len(outbox)
+
+        before, queued = async_to_sync(run)()
+
+        self.assertEqual(before, [["m0"], ["m1"]])
+        self.assertEqual(written, [["m0"], ["m1"], ["m2"]])
+        self.assertEqual(queued, 1)
+
+    def test_metrics_are_for_staff(self):
+        user = User.objects.create(username="alice")
+        self.client.force_login(user)
+
+        self.assertEqual(self.client.get("/metrics/outbox/").status_code, 403)
+
+        user.is_staff = True
+        user.save()
+
+        self.assertIn("queued", self.client.get("/metrics/outbox/").json())
+
+
+class ProtocolTests(TestCase):
+
+    def test_negotiation_falls_back_to_legacy_json(self):
+        self.assertIs(negotiate(None), LEGACY)
+        self.assertIs(negotiate(["graphql-ws"]), LEGACY)
+        self.assertEqual(negotiate(["chat.v1.json", "chat.v1.msgpack"]).name, "chat.v1.json")
+
+    def test_frames_are_spliced_from_encoded_events(self):
+        codec = CompactJsonCodec()
+        events = [codec.encode_event("unread", {"unread_count": 3}), codec.encode_event("typing", {"typing_users": ["bob"]})]
+
+        self.assertEqual(json.loads(codec.frame(events)), [[2, 3], [3, ["bob"]]])
+
+    def test_chat_wrapper_is_spliced_around_the_event(self):
+        event = LEGACY.encode_event("unread", {"unread_count": 2})
+        self.assertEqual(json.loads(LEGACY.wrap(7, event)), {"chat_id": 7, "event": {"unread_count": 2}})
+
+        codec = CompactJsonCodec()
+        event = codec.encode_event("unread", {"unread_count": 2})
+        self.assertEqual(json.loads(codec.frame([codec.wrap(7, event)])), [[11, 7, [2, 2]]])
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_chat_wrapper(self):
+        codec = MsgpackCodec()
+        event = codec.encode_event("unread", {"unread_count": 2})
+
+        self.assertEqual(msgpack.unpackb(codec.frame([codec.wrap(7, event)])), [[11, 7, [2, 2]]])
+
+    @skipUnless(msgpack, "msgpack is not installed")
+    def test_msgpack_array_header(self):
+        codec = MsgpackCodec()
+
+        for count in (1, 15, 16, 70000):
+            events = [codec.encode_event("unread", {"unread_count": 1})] * count
+            self.assertEqual(len(msgpack.unpackb(codec.frame(events))), count)
+
+
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        local_members.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.chat = Chat.objects.create(type="private")
+        self.chat.participants.add(self.alice, self.bob)
+
+        self.ids = [
+            Message.objects.create(chat=self.chat, sender=self.alice, text=str(i)).id
+            for i in range(7)
+        ]
+
+    def test_pages_walk_back_to_the_start(self):
+        page, cursor = history_page(self.chat.id, limit=3)
+        self.assertEqual([m.id for m in page], self.ids[4:])
+        self.assertEqual(cursor, self.ids[4])
+
+        page, cursor = history_page(self.chat.id, before=cursor, limit=3)
+        self.assertEqual([m.id for m in page], self.ids[1:4])
+
+        page, cursor = history_page(self.chat.id, before=cursor, limit=3)
+        self.assertEqual([m.id for m in page], self.ids[:1])
+        self.assertIsNone(cursor)
+
+    def test_history_endpoint(self):
+        self.client.force_login(self.bob)
+
+        response = self.client.get(f"/chat/{self.chat.id}/history/", {"before": self.ids[2], "limit": 5})
+
+        data = response.json()
+        self.assertEqual([m["id"] for m in data["messages"]], self.ids[:2])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_history_endpoint_requires_membership(self):
+        self.client.force_login(User.objects.create(username="mallory"))
+
+        response = self.client.get(f"/chat/{self.chat.id}/history/")
+
+        self.assertEqual(response.status_code, 403)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.chat = Chat.objects.create(type="private")
+        self.chat.participants.add(self.alice, self.bob)
+
+        self.other = Chat.objects.create(type="group", name="other")
+        self.other.participants.add(self.bob)
+
+    def say(self, chat, text):
+        return Message.objects.create(chat=chat, sender=self.bob, text=text)
+
+    def test_only_member_chats_are_searched(self):
+        mine = self.say(self.chat, "meet at the station")
+        self.say(self.other, "the station is closed")
+
+        hits, cursor = search_messages(self.alice.id, "station")
+
+        self.assertEqual([hit["id"] for hit in hits], [mine.id])
+        self.assertIsNone(cursor)
+
+    def test_better_matches_come_first(self):
+        weak = self.say(self.chat, "train tickets are on the table next to the keys and the wallet")
+        strong = self.say(self.chat, "train train")
+
+        hits, _ = search_messages(self.alice.id, "train")
+
+        self.assertEqual([hit["id"] for hit in hits], [strong.id, weak.id])
+
+    def test_cursor_walks_all_hits(self):
+        ids = {self.say(self.chat, f"ping {i}").id for i in range(5)}
+
+        seen, cursor = [], None
+        while True:
+            hits, cursor = search_messages(self.alice.id, "ping", cursor=cursor, limit=2)
+            seen += [hit["id"] for hit in hits]
+            if cursor is None:
+                break
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(set(seen), ids)
+
+    def test_edit_and_delete_update_the_index(self):
+        msg = self.say(self.chat, "old words")
+
+        msg.text = "new words"
+        msg.save()
+        self.assertEqual(search_messages(self.alice.id, "old")[0], [])
+        self.assertEqual(len(search_messages(self.alice.id, "new")[0]), 1)
+
+        msg.is_deleted = True
+        msg.save()
+        self.assertEqual(search_messages(self.alice.id, "new")[0], [])
+
+    def test_snippet_is_escaped(self):
+        self.say(self.chat, "<b>pizza</b> tonight")
+
+        hits, _ = search_messages(self.alice.id, "pizza")
+
+        self.assertIn("&lt;b&gt;<mark>pizza</mark>&lt;/b&gt;", hits[0]["snippet"])
+
+    def test_hit_deleted_before_fetch_is_skipped(self):
+        gone = self.say(self.chat, "lunch is late")
+        kept = self.say(self.chat, "lunch at noon")
+
+        backend = get_backend()
+        search = backend.search
+
+        # deleted after the index query, before the messages are fetched
+        def search_then_delete(*args, **kwargs):
+            rows = search(*args, **kwargs)
+            gone.delete()
+            return rows
+
+        backend.search = search_then_delete
+
+        with mock.patch("chat.search.get_backend", return_value=backend):
+            hits, _ = search_messages(self.alice.id, "lunch")
+
+        self.assertEqual([hit["id"] for hit in hits], [kept.id])
+
+    def test_search_endpoint(self):
+        self.say(self.chat, "hello there")
+        self.client.force_login(self.alice)
+
+        data = self.client.get("/search/messages/", {"q": "hel"}).json()
+
+        self.assertEqual(len(data["results"]), 1)
+        self.assertEqual(data["results"][0]["chat_id"], self.chat.id)
+
+
+class DirectoryTests(TestCase):
+
+    def test_new_users_and_groups_are_listed(self):
+        alice = User.objects.create(username="Alice")
+        User.objects.create(username="alfred")
+        User.objects.create(username="bob")
+        Chat.objects.create(name="Algebra", type="group")
+        Chat.objects.create(type="private")
+
+        self.assertEqual(autocomplete("AL", user_id=alice.id), {
+            "users": [{"id": User.objects.get(username="alfred").id, "username": "alfred"}],
+            "groups": [{"id": Chat.objects.get(name="Algebra").id, "name": "Algebra"}],
+        })
+
+    def test_rename_and_delete_follow(self):
+        user = User.objects.create(username="carol")
+
+        user.username = "dave"
+        user.save()
+        self.assertEqual(lookup("user", "car"), [])
+        self.assertEqual(lookup("user", "da"), [(user.id, "dave")])
+
+        user.delete()
+        self.assertEqual(lookup("user", "da"), [])
+
+    def test_lookup_is_a_bounded_range(self):
+        for name in ["ann", "anna", "annette", "anne", "bo"]:
+            User.objects.create(username=name)
+
+        self.assertEqual([label for _, label in lookup("user", "ann", limit=3)], ["ann", "anna", "anne"])
+        self.assertEqual(lookup("user", ""), [])
+
+    def test_autocomplete_endpoint(self):
+        alice = User.objects.create(username="alice")
+        User.objects.create(username="alina")
+        self.client.force_login(alice)
+
+        data = self.client.get("/search/directory/", {"q": "ali"}).json()
+
+        self.assertEqual([u["username"] for u in data["users"]], ["alina"])
+
+
+class FeedQueryCountTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_members.clear()
+
+        self.alice = User.objects.create(username="alice")
+
+    def make_chat(self, members, messages):
+        chat = Chat.objects.create(name="group", type="group")
+        users = [User.objects.create(username=f"{chat.id}-{i}") for i in range(members)]
+        chat.participants.add(self.alice, *users)
+
+        previous = None
+        for i in range(messages):
+            previous = Message.objects.create(
+                chat=chat,
+                sender=users[i % members],
+                text=str(i),
+                reply_to=previous
+            )
+            Reaction.objects.create(message=previous, user=self.alice, emoji="👍")
+
+        return chat
+
+    def count_queries(self, url):
+        self.client.force_login(self.alice)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_chat_room_query_count_is_constant(self):
+        small = self.make_chat(members=2, messages=3)
+        large = self.make_chat(members=12, messages=30)
+
+        self.assertEqual(
+            self.count_queries(f"/chat/{small.id}/"),
+            self.count_queries(f"/chat/{large.id}/"),
+        )
+
+    def test_index_query_count_is_constant(self):
+        self.make_chat(members=2, messages=2)
+        few = self.count_queries("/")
+
+        for _ in range(5):
+            self.make_chat(members=3, messages=4)
+
+        self.assertEqual(few, self.count_queries("/"))
+
+
+class ChatListTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.quiet = Chat.objects.create(name="quiet", type="group")
+        self.busy = Chat.objects.create(name="busy", type="group")
+        self.empty = Chat.objects.create(name="empty", type="group")
+
+        for chat in (self.quiet, self.busy, self.empty):
+            chat.participants.add(self.alice, self.bob)
+
+    def test_ordered_by_activity_with_preview_and_unread(self):
+        Message.objects.create(chat=self.busy, sender=self.bob, text="first")
+        Message.objects.create(chat=self.quiet, sender=self.bob, text="hello")
+        last = Message.objects.create(chat=self.busy, sender=self.bob, text="second")
+
+        with self.assertNumQueries(1):
+            chats = [(c.name, c.last_message and c.last_message.text, c.unread) for c in user_chats(self.alice)]
+
+        self.assertEqual(chats, [("busy", "second", 2), ("quiet", "hello", 1), ("empty", None, 0)])
+        self.assertEqual(Chat.objects.get(id=self.busy.id).last_activity_at, last.timestamp)
+
+    def test_older_batch_does_not_move_last_message_back(self):
+        old = Message.objects.create(chat=self.busy, sender=self.bob, text="old")
+        new = Message.objects.create(chat=self.busy, sender=self.bob, text="new")
+
+        record_activity([old])
+
+        self.assertEqual(Chat.objects.get(id=self.busy.id).last_message_id, new.id)
+
+    def test_chat_list_endpoint(self):
+        Message.objects.create(chat=self.quiet, sender=self.alice, text="mine")
+        self.client.force_login(self.alice)
+
+        data = self.client.get("/chats/").json()
+
+        self.assertEqual(data["chats"][0]["name"], "quiet")
+        self.assertEqual(data["chats"][0]["last_message"]["message"], "mine")
+        self.assertEqual(data["chats"][0]["unread"], 0)
+
+
+class UploadTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        local_members.clear()
+
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create(username="alice")
+        self.chat = Chat.objects.create(type="private")
+        self.chat.participants.add(self.alice)
+
+        self.client.force_login(self.alice)
+
+    def start(self, data, **fields):
+        response = self.client.post(f"/upload/{self.chat.id}/", {
+            "kind": "file", "name": "notes.txt", "size": len(data), **fields
+        })
+        return response
+
+    def put(self, upload_id, index, body):
+        return self.client.put(f"/upload/{upload_id}/{index}/", body, content_type="application/octet-stream")
+
+    def test_chunks_in_any_order_make_one_message(self):
+        data = bytes(range(256)) * 10
+        state = self.start(data).json()
+
+        # three chunks instead of the default megabyte
+        size = 1000
+        Upload.objects.filter(id=state["id"]).update(chunk_size=size)
+
+        for index in (2, 0, 1, 0):
+            self.assertEqual(self.put(state["id"], index, data[index * size:(index + 1) * size]).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=False) as announced:
+            response = self.client.post(f"/upload/{state['id']}/finish/")
+
+        self.assertEqual(response.json()["sha256"], hashlib.sha256(data).hexdigest())
+        # the announcement and the cached unread bump
+        self.assertEqual(len(announced), 2)
+
+        msg = Message.objects.get(id=response.json()["message_id"])
+        with msg.file.open("rb") as fh:
+            self.assertEqual(fh.read(), data)
+
+        # finishing again is a no-op
+        self.assertEqual(self.client.post(f"/upload/{state['id']}/finish/").json()["message_id"], msg.id)
+
+    def test_resume_lists_missing_chunks(self):
+        data = b"x" * 10
+        state = self.start(data).json()
+
+        self.assertEqual(self.put(state["id"], 0, b"short").status_code, 400)
+
+        response = self.client.post(f"/upload/{state['id']}/finish/")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(f"/upload/{state['id']}/").json()["missing"], [0])
+
+    def test_size_limit(self):
+        response = self.start(b"", size=10 ** 12)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_plain_upload_is_announced_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as announced:
+            self.client.post(f"/upload-file/{self.chat.id}/", {"file": SimpleUploadedFile("a.txt", b"hi")})
+
+        # the announcement and the cached unread bump
+        self.assertEqual(len(announced), 2)
+        self.assertEqual(Message.objects.get(chat=self.chat).file_name, "a.txt")
+
+
+class MediaStorageTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create(username="alice")
+        self.chat = Chat.objects.create(type="private")
+
+    def send(self, name, data):
+        msg = Message(chat=self.chat, sender=self.alice, file_name=name)
+        msg.file.save(name, SimpleUploadedFile(name, data))
+        return msg
+
+    def blob_files(self):
+        return [name for _, _, names in os.walk(os.path.join(self.media, "blobs")) for name in names]
+
+    def test_same_bytes_are_stored_once(self):
+        first = self.send("cat.jpg", b"meow")
+        second = self.send("copy of cat.jpg", b"meow")
+
+        profile = Profile.objects.get(user=self.alice)
+        profile.avatar.save("avatar.jpg", SimpleUploadedFile("avatar.jpg", b"meow"))
+
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(profile.avatar.name, first.file.name)
+        self.assertEqual(len(self.blob_files()), 1)
+        self.assertEqual(Blob.objects.get().refs, 3)
+
+    def test_forward_and_delete_move_refs(self):
+        msg = self.send("a.txt", b"data")
+
+        # forwarding reuses the stored name
+        forward = Message.objects.create(chat=self.chat, sender=self.alice, file=msg.file.name)
+        self.assertEqual(Blob.objects.get().refs, 2)
+
+        Message.objects.get(id=forward.id).delete()
+        Message.objects.get(id=msg.id).delete()
+        self.assertEqual(Blob.objects.get().refs, 0)
+
+    def test_gc_removes_unreferenced_blobs(self):
+        keep = self.send("keep.txt", b"keep")
+        self.send("drop.txt", b"drop").delete()
+
+        call_command("gc_media", grace=0, stdout=StringIO())
+
+        self.assertEqual(list(Blob.objects.values_list("name", flat=True)), [keep.file.name])
+        self.assertEqual(len(self.blob_files()), 1)
+
+    def test_adopt_deduplicates_legacy_files(self):
+        for folder in ("files", "avatars"):
+            os.makedirs(os.path.join(self.media, folder))
+            with open(os.path.join(self.media, folder, "pic.jpg"), "wb") as fh:
+                fh.write(b"same picture")
+
+        Message.objects.filter(id=Message.objects.create(chat=self.chat, sender=self.alice).id).update(
+            file="files/pic.jpg"
+        )
+        Profile.objects.filter(user=self.alice).update(avatar="avatars/pic.jpg")
+
+        call_command("gc_media", adopt=True, grace=0, stdout=StringIO())
+
+        self.assertEqual(Blob.objects.get().refs, 2)
+        self.assertEqual(Message.objects.get().file_name, "pic.jpg")
+        self.assertEqual(len(self.blob_files()), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.media, "files", "pic.jpg")))
+
+
+class ThumbnailTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create(username="alice")
+        self.profile = Profile.objects.get(user=self.alice)
+
+    def image(self, size=(1200, 800)):
+        buffer = io.BytesIO()
+        Image.effect_noise(size, 60).convert("RGB").save(buffer, "JPEG", quality=95)
+        return SimpleUploadedFile("me.jpg", buffer.getvalue())
+
+    def test_thumbnails_are_small_and_referenced(self):
+        self.profile.avatar.save("me.jpg", self.image())
+
+        build_thumbnails(self.profile.id, self.profile.avatar.name)
+        self.profile.refresh_from_db()
+
+        self.assertEqual(sorted(map(int, self.profile.thumbnails)), sorted(SIZES))
+
+        original = Blob.objects.get(name=self.profile.avatar.name)
+        small = Blob.objects.get(name=self.profile.thumbnails[str(min(SIZES))])
+        self.assertLess(small.size * 20, original.size)
+        self.assertEqual(small.refs, 1)
+
+    def test_avatar_url_picks_the_closest_size(self):
+        self.profile.avatar.save("me.jpg", self.image())
+        self.assertEqual(avatar_url(self.profile, 40), self.profile.avatar.url)
+
+        build_thumbnails(self.profile.id, self.profile.avatar.name)
+        self.profile.refresh_from_db()
+
+        self.assertTrue(avatar_url(self.profile, 40).endswith(self.profile.thumbnails["48"]))
+        self.assertTrue(avatar_url(self.profile, 100).endswith(self.profile.thumbnails["128"]))
+        self.assertTrue(avatar_url(self.profile, 999).endswith(self.profile.thumbnails["256"]))
+
+    def test_stale_job_is_ignored(self):
+        self.profile.avatar.save("old.jpg", self.image((300, 300)))
+        old = self.profile.avatar.name
+        self.profile.avatar.save("new.jpg", self.image((400, 400)))
+
+        build_thumbnails(self.profile.id, old)
+
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.thumbnails, {})
+
+    def test_upload_schedules_after_commit(self):
+        self.client.force_login(self.alice)
+
+        with self.captureOnCommitCallbacks(execute=False) as scheduled:
+            self.client.post("/profile/avatar/", {"avatar": self.image()})
+
+        self.assertEqual(len(scheduled), 1)
+
+    def test_failed_job_is_logged(self):
+        future = Future()
+        future.set_exception(RuntimeError("boom"))
+
+        with self.assertLogs("chat.thumbnails", "ERROR"):
+            log_failure(future, "me.jpg")
+
+
+class FileServerTests(TransactionTestCase):
+
+    def setUp(self):
+        local_members.clear()
+
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create(username="alice")
+        self.mallory = User.objects.create(username="mallory")
+
+        self.chat = Chat.objects.create(type="private")
+        self.chat.participants.add(self.alice)
+
+        self.data = bytes(range(256)) * 40
+        self.msg = Message(chat=self.chat, sender=self.alice)
+        self.msg.audio.save("voice.webm", SimpleUploadedFile("voice.webm", self.data))
+
+        self.server = FileServer(application=None)
+
+    def get(self, user, path=None, headers=(), method="GET"):
+        communicator = HttpCommunicator(
+            self.server, method, path or "/media/" + self.msg.audio.name,
+            headers=[(k.encode(), v.encode()) for k, v in headers]
+        )
+        communicator.scope["user"] = user
+
+        response = async_to_sync(communicator.get_response)()
+        response["headers"] = {k.decode(): v.decode() for k, v in response["headers"]}
+        return response
+
+    def test_members_get_the_file_with_cache_headers(self):
+        response = self.get(self.alice)
+
+        self.assertEqual(response["status"], 200)
+        self.assertEqual(response["body"], self.data)
+        self.assertIn("immutable", response["headers"]["cache-control"])
+        self.assertEqual(response["headers"]["accept-ranges"], "bytes")
+
+    def test_non_members_cannot_tell_it_exists(self):
+        self.assertEqual(self.get(self.mallory)["status"], 404)
+        self.assertEqual(self.get(self.alice, "/media/../db.sqlite3")["status"], 404)
+
+    def test_range_for_audio_seeking(self):
+        response = self.get(self.alice, headers=[("range", "bytes=100-199")])
+
+        self.assertEqual(response["status"], 206)
+        self.assertEqual(response["body"], self.data[100:200])
+        self.assertEqual(response["headers"]["content-range"], f"bytes 100-199/{len(self.data)}")
+
+        self.assertEqual(self.get(self.alice, headers=[("range", "bytes=999999-")])["status"], 416)
+
+    def test_conditional_requests(self):
+        etag = self.get(self.alice)["headers"]["etag"]
+
+        self.assertEqual(self.get(self.alice, headers=[("if-none-match", etag)])["status"], 304)
+
+        # a stale If-Range gets the whole file instead of a piece of the wrong one
+        response = self.get(self.alice, headers=[("range", "bytes=0-9"), ("if-range", '"stale"')])
+        self.assertEqual(response["status"], 200)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=0-5000", 100), (0, 99))
+        self.assertIsNone(parse_range("bytes=0-1,5-6", 100))
+        self.assertFalse(parse_range("bytes=100-", 100))
+
+
+class ReplayBufferTests(TestCase):
+
+    def event(self, seq):
+        return {"type": "chat_delta", "seq": seq}
+
+    def test_events_after_a_sequence_number(self):
+        buffer = ReplayBuffer(size=4)
+
+        for seq in (1, 2, 4, 3):
+            buffer.record(7, self.event(seq))
+
+        self.assertEqual([e["seq"] for e in buffer.since(7, 1)], [2, 3, 4])
+        self.assertEqual(buffer.since(7, 4), [])
+        self.assertIsNone(buffer.since(8, 1))
+
+    def test_rolled_over_or_holed_buffers_cannot_answer(self):
+        buffer = ReplayBuffer(size=3)
+
+        for seq in (1, 2, 3, 4, 6):
+            buffer.record(7, self.event(seq))
+
+        # 1 fell out, 5 never arrived
+        self.assertIsNone(buffer.since(7, 0))
+        self.assertIsNone(buffer.since(7, 3))
+        self.assertIsNone(buffer.since(7, 9))
+
+    def test_restarted_counter_starts_over(self):
+        buffer = ReplayBuffer(size=3)
+
+        for seq in (10, 11, 12, 13, 1):
+            buffer.record(7, self.event(seq))
+
+        self.assertEqual(buffer.since(7, 0), [self.event(1)])
+
+
+class ActionTests(TestCase):
+
+    def setUp(self):
+        local_members.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.mallory = User.objects.create(username="mallory")
+
+        self.chat = Chat.objects.create(type="private")
+        self.chat.participants.add(self.alice, self.bob)
+
+        self.msg = Message.objects.create(chat=self.chat, sender=self.alice, text="hi")
+
+    def test_only_the_sender_edits_and_deletes(self):
+        with self.assertRaises(actions.ActionError):
+            actions.edit_message(self.bob, self.msg.id, "mine now")
+
+        with self.assertRaises(actions.ActionError):
+            actions.delete_message(self.bob, self.msg.id)
+
+        actions.delete_message(self.alice, self.msg.id)
+        self.assertTrue(Message.objects.get(id=self.msg.id).is_deleted)
+
+    def test_outsiders_cannot_react_or_pin(self):
+        with self.assertRaises(actions.ActionError):
+            actions.react(self.mallory, self.msg.id, "👍")
+
+        with self.assertRaises(actions.ActionError):
+            actions.pin_message(self.mallory, self.msg.id)
+
+    def test_reaction_counts_follow_add_and_remove(self):
+        actions.react(self.alice, self.msg.id, "👍")
+        actions.react(self.bob, self.msg.id, "👍")
+        actions.react(self.bob, self.msg.id, "🔥")
+
+        self.assertEqual(actions.react(self.bob, self.msg.id, "👍", remove=True), {"👍": 1, "🔥": 1})
+
+    def test_totals_are_kept_with_the_reactions(self):
+        actions.react(self.alice, self.msg.id, "👍")
+        actions.react(self.alice, self.msg.id, "👍")
+        actions.react(self.bob, self.msg.id, "👍")
+        actions.react(self.bob, self.msg.id, "🔥", remove=True)
+        actions.react(self.alice, self.msg.id, "👍", remove=True)
+
+        totals = ReactionCount.objects.filter(message=self.msg)
+
+        self.assertEqual(list(totals.values_list("emoji", "count")), [("👍", 1)])
+
+        actions.react(self.bob, self.msg.id, "👍", remove=True)
+
+        self.assertFalse(totals.exists())
+
+    def test_history_page_reads_totals_in_one_query(self):
+        for i in range(5):
+            msg = Message.objects.create(chat=self.chat, sender=self.alice, text=str(i))
+            actions.react(self.alice, msg.id, "👍")
+            actions.react(self.bob, msg.id, "👍")
+
+        with self.assertNumQueries(2):
+            page, _ = history_page(self.chat.id)
+            data = [serialize_message(msg) for msg in page]
+
+        self.assertEqual(data[-1]["reactions"], {"👍": 2})
+
+    def test_delta_is_sent_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            actions.pin_message(self.bob, self.msg.id)
+
+        self.assertEqual(len(callbacks), 1)
+
+    def test_http_view_uses_the_same_service(self):
+        self.client.force_login(self.alice)
+
+        self.client.post(f"/message/edit/{self.msg.id}/", {"text": "edited"}, HTTP_REFERER=f"/chat/{self.chat.id}/")
+
+        msg = Message.objects.get(id=self.msg.id)
+        self.assertEqual((msg.text, msg.edited), ("edited", True))
+
+
+class MembershipTests(TestCase):
+
+    def setUp(self):
+        local_members.clear()
+
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+        self.chat = Chat.objects.create(name="group", type="group")
+        self.chat.participants.add(self.alice)
+
+    def test_positive_answers_are_cached(self):
+        self.assertTrue(is_member(self.chat.id, self.alice.id))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(is_member(self.chat.id, self.alice.id))
+
+    def test_add_and_remove_invalidate(self):
+        self.assertFalse(is_member(self.chat.id, self.bob.id))
+
+        self.chat.participants.add(self.bob)
+        self.assertTrue(is_member(self.chat.id, self.bob.id))
+
+        self.chat.participants.remove(self.bob)
+        self.assertFalse(is_member(self.chat.id, self.bob.id))
+
+    def test_clear_invalidates(self):
+        self.assertTrue(is_member(self.chat.id, self.alice.id))
+
+        self.alice.chats.clear()
+
+        self.assertFalse(is_member(self.chat.id, self.alice.id))
+
+
+class ShardedLayerTests(TestCase):
+
+    def test_adding_a_host_moves_few_groups(self):
+        groups = [f"chat_{i}" for i in range(2000)]
+
+        three = ShardedRedisChannelLayer(hosts=[f"redis://shard-{i}" for i in range(3)])
+        four = ShardedRedisChannelLayer(hosts=[f"redis://shard-{i}" for i in range(4)])
+
+        moved = sum(three.consistent_hash(g) != four.consistent_hash(g) for g in groups)
+
+        # ideal is 1/4, the stock modulo placement moves about 3/4
+        self.assertLess(moved / len(groups), 0.35)
+
+    @skipUnless(fakeredis, "fakeredis[lua] is not installed")
+    def test_group_send_crosses_workers(self):
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+        hosts = [
+            {"address": f"redis://shard-{i}", "connection_class": FakeConnection, "server": server}
+            for i, server in enumerate(servers)
+        ]
+
+        # two layers stand in for two Daphne processes sharing the same hosts
+        worker_a = ShardedRedisChannelLayer(hosts=hosts)
+        worker_b = ShardedRedisChannelLayer(hosts=hosts)
+
+        async def fan_out():
+            channel = await worker_a.new_channel()
+            await worker_a.group_add("chat_42", channel)
+
+            await worker_b.group_send("chat_42", {"type": "chat_message", "text": "hi"})
+
+            message = await worker_a.receive(channel)
+
+            await worker_a.flush()
+            await worker_b.close_pools()
+            return message
+
+        self.assertEqual(async_to_sync(fan_out)()["text"], "hi")
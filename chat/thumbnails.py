@@ -0,0 +1,140 @@
+"""
+Avatar thumbnails.
+
+When a user uploads an avatar, a few square sizes are rendered with
+Pillow in a small thread pool (Pillow releases the GIL while resizing
+and encoding) once the upload has committed. They are saved through
+the default storage, so their names are content hashes: a new avatar
+gets new URLs and the old ones can be cached forever. The names land
+in Profile.thumbnails and ``{% avatar_url %}`` picks the size to show.
+"""
+
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .models import Profile
+from .storage import publish
+
+
+logger = logging.getLogger(__name__)
+
+SIZES = getattr(settings, "CHAT_AVATAR_SIZES", (48, 128, 256))
+
+WORKERS = getattr(settings, "CHAT_THUMBNAIL_WORKERS", 2)
+
+FORMAT, EXTENSION = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+QUALITY = 80
+
+thumbnail_pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="thumbnails")
+
+
+def render(image, size):
+
+    thumb = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+
+    if FORMAT == "JPEG" and thumb.mode != "RGB":
+        thumb = thumb.convert("RGB")
+
+    buffer = io.BytesIO()
+
+    if FORMAT == "WEBP":
+        thumb.save(buffer, FORMAT, quality=QUALITY, method=4)
+    else:
+        thumb.save(buffer, FORMAT, quality=QUALITY, optimize=True, progressive=True)
+
+    return buffer.getvalue()
+
+
+def make_thumbnails(avatar_name):
+    """
+    Render every size of the stored avatar and return {size: stored name}.
+    """
+
+    with default_storage.open(avatar_name) as fh:
+        image = Image.open(fh)
+
+        # a 10k x 10k upload decodes at a fraction of the size it is shrunk to
+        image.draft("RGB", (max(SIZES) * 2, max(SIZES) * 2))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+        return {
+            str(size): default_storage.save(f"thumb.{EXTENSION}", ContentFile(render(image, size)))
+            for size in SIZES
+        }
+
+
+def build_thumbnails(profile_id, avatar_name):
+
+    try:
+        try:
+            thumbnails = make_thumbnails(avatar_name)
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+            logger.warning("Cannot make thumbnails for %s", avatar_name, exc_info=True)
+            return
+
+        with transaction.atomic():
+            profile = Profile.objects.select_for_update().get(id=profile_id)
+
+            # a newer avatar was uploaded meanwhile, its own job will fill these in
+            if profile.avatar.name != avatar_name:
+                return
+
+            profile.thumbnails = thumbnails
+            profile.save(update_fields=["thumbnails"])
+
+            publish(thumbnails.values())
+    finally:
+        close_old_connections()
+
+
+def schedule_thumbnails(profile):
+    """
+    Queue thumbnails for the profile's avatar once the current transaction commits.
+    """
+
+    profile_id, avatar_name = profile.id, profile.avatar.name
+
+    def submit():
+        future = thumbnail_pool.submit(build_thumbnails, profile_id, avatar_name)
+        future.add_done_callback(lambda f: log_failure(f, avatar_name))
+
+    transaction.on_commit(submit)
+
+
+def log_failure(future, avatar_name):
+
+    # nobody waits on the future, an exception would vanish with it
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Thumbnail job for %s failed", avatar_name, exc_info=future.exception())
+
+
+def avatar_url(profile, size):
+    """
+    URL of the smallest thumbnail at least ``size`` pixels wide, the
+    largest one if none is, or the original while they are being made.
+    """
+
+    if not profile.avatar:
+        return ""
+
+    thumbnails = sorted((int(width), name) for width, name in profile.thumbnails.items())
+
+    for width, name in thumbnails:
+        if width >= size:
+            return default_storage.url(name)
+
+    if thumbnails:
+        return default_storage.url(thumbnails[-1][1])
+
+    return profile.avatar.url
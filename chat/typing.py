@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+
+RATE_LIMIT = getattr(settings, "CHAT_TYPING_RATE_LIMIT", 2.0)
+SNAPSHOT_INTERVAL = getattr(settings, "CHAT_TYPING_SNAPSHOT_INTERVAL", 0.5)
+TYPING_TTL = getattr(settings, "CHAT_TYPING_TTL", 3.0)
+
+
+class TypingThrottle:
+    """
+    Sender side: lets at most one typing event per user per chat through
+    every ``rate_limit`` seconds, however fast the keystrokes arrive.
+    """
+
+    def __init__(self, rate_limit=RATE_LIMIT):
+        self.rate_limit = rate_limit
+        self.last_sent = {}
+
+    def allow(self, chat_id, user_id):
+
+        now = time.monotonic()
+        key = (chat_id, user_id)
+
+        if now - self.last_sent.get(key, -self.rate_limit) < self.rate_limit:
+            return False
+
+        self.last_sent[key] = now
+
+        if len(self.last_sent) > 10000:
+            self.last_sent = {k: t for k, t in self.last_sent.items() if now - t < self.rate_limit}
+
+        return True
+
+
+typing_throttle = TypingThrottle()
+
+
+class TypingSnapshot:
+    """
+    Receiver side, one per socket: folds typing events from everyone in
+    the chat into a single "who is typing" list, sent at most once per
+    ``interval``. A typist drops out ``ttl`` seconds after their last
+    event or as soon as their message arrives.
+    """
+
+    def __init__(self, send, interval=SNAPSHOT_INTERVAL, ttl=TYPING_TTL):
+        self.send = send
+        self.interval = interval
+        self.ttl = ttl
+        self.typists = {}
+        self.last_sent = []
+        self._task = None
+
+    def typing(self, username):
+
+        self.typists[username] = time.monotonic() + self.ttl
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stopped(self, username):
+        self.typists.pop(username, None)
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+
+        while True:
+            now = time.monotonic()
+            self.typists = {name: expires for name, expires in self.typists.items() if expires > now}
+
+            current = sorted(self.typists)
+
+            if current != self.last_sent:
+                self.last_sent = current
+                await self.send(current)
+
+            if not current:
+                return
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,123 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import ChatReadState, Message
+
+
+CACHE_TIMEOUT = getattr(settings, "CHAT_UNREAD_CACHE_TIMEOUT", 300)
+
+
+def cache_key(chat_id, user_id):
+    return f"chat:unread:{chat_id}:{user_id}"
+
+
+def get_unread(chat_id, user_id):
+
+    key = cache_key(chat_id, user_id)
+    count = cache.get(key)
+
+    if count is None:
+        count = ChatReadState.objects.filter(
+            chat_id=chat_id,
+            user_id=user_id
+        ).values_list("unread_count", flat=True).first() or 0
+
+        cache.set(key, count, CACHE_TIMEOUT)
+
+    return count
+
+
+def reset_unread(chat_id, user_id):
+    cache.set(cache_key(chat_id, user_id), 0, CACHE_TIMEOUT)
+
+
+def increment_unread(messages):
+    """
+    Bump counters for a batch of new messages with one UPDATE per
+    (chat, sender) pair: every other member gains that many unread.
+
+    Counters already in the cache are bumped too rather than dropped, so
+    sockets that do not reset them (UserConsumer) keep reading the cache;
+    that happens once the transaction commits.
+    """
+
+    batches = Counter((m.chat_id, m.sender_id) for m in messages)
+    bumps = Counter()
+
+    for (chat_id, sender_id), count in batches.items():
+
+        states = ChatReadState.objects.filter(chat_id=chat_id).exclude(user_id=sender_id)
+
+        for user_id in states.values_list("user_id", flat=True):
+            bumps[cache_key(chat_id, user_id)] += count
+
+        states.update(unread_count=F("unread_count") + count)
+
+    def bump_cached():
+
+        # one round trip to find the cached ones, missing keys load from the row later
+        for key in cache.get_many(list(bumps)):
+            try:
+                cache.incr(key, bumps[key])
+            except ValueError:
+                # expired in between
+                pass
+
+    # outside the write transaction, and never for a batch that rolls back
+    # (chat/ingest.py retries those row by row)
+    transaction.on_commit(bump_cached)
+
+
+def recount(states):
+    """
+    Rebuild unread_count for the given ChatReadState queryset from Message.
+
+    Each row only counts messages past its own watermark, so this is an
+    index range scan per member rather than a scan of the whole history.
+    """
+
+    unread = Message.objects.filter(
+        chat_id=OuterRef("chat_id"),
+        id__gt=OuterRef("last_read_message_id")
+    ).exclude(
+        sender_id=OuterRef("user_id")
+    ).order_by().values("chat_id").annotate(n=Count("id")).values("n")
+
+    updated = states.update(unread_count=Coalesce(Subquery(unread), 0))
+
+    cache.delete_many([
+        cache_key(chat_id, user_id)
+        for chat_id, user_id in states.values_list("chat_id", "user_id")
+    ])
+
+    return updated
+
+
+def add_read_states(pairs):
+    """
+    Create counter rows for new (chat_id, user_id) members.
+
+    New members start with everything already in the chat marked as read.
+    """
+
+    chat_ids = {chat_id for chat_id, _ in pairs}
+
+    latest = dict(
+        Message.objects.filter(chat_id__in=chat_ids)
+        .values("chat_id")
+        .annotate(last_id=Max("id"))
+        .values_list("chat_id", "last_id")
+    )
+
+    ChatReadState.objects.bulk_create(
+        [
+            ChatReadState(chat_id=chat_id, user_id=user_id, last_read_message_id=latest.get(chat_id, 0))
+            for chat_id, user_id in pairs
+        ],
+        ignore_conflicts=True,
+    )
@@ -0,0 +1,223 @@
+"""
+Resumable chunked uploads for files and voice messages.
+
+1. ``start_upload`` records the upload and reserves a sparse ``.part``
+   file of the final size under MEDIA_ROOT/uploads/.
+2. Chunks are PUT by index, in any order and in parallel; each one is
+   streamed from the request straight to its offset in the part file
+   and recorded as an UploadChunk row, so a client that lost its
+   connection asks which chunks are missing and sends only those.
+3. ``finish_upload`` hashes the part file in blocks, hands it to the
+   storage (a move on FileSystemStorage, no copy, and nothing at all
+   when ContentAddressedStorage already has the bytes) and creates the
+   Message. The group is told only after the transaction commits, so
+   nobody receives a message that is not in the database yet.
+
+Everything here is blocking I/O and runs in the sync views, which the
+ASGI handler executes in its thread pool, away from the event loop.
+"""
+
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+from .broadcast import group_broadcast_sync, message_event
+from .models import Message, Upload, UploadChunk
+
+
+CHUNK_SIZE = getattr(settings, "CHAT_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+
+MAX_SIZE = getattr(settings, "CHAT_UPLOAD_MAX_SIZE", {
+    "file": 50 * 1024 * 1024,
+    "audio": 10 * 1024 * 1024,
+})
+
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class PartialFile(File):
+    """
+    A finished part file. FileSystemStorage moves anything that has a
+    temporary_file_path() instead of copying it.
+    """
+
+    def __init__(self, path, name, size):
+        super().__init__(open(path, "rb"), name=name)
+        self.path = path
+        self.size = size
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def upload_dir():
+    return os.path.join(settings.MEDIA_ROOT, "uploads")
+
+
+def part_path(upload):
+    return os.path.join(upload_dir(), f"{upload.id}.part")
+
+
+def chunk_count(upload):
+    return max(1, -(-upload.size // upload.chunk_size))
+
+
+def chunk_length(upload, index):
+    return min(upload.chunk_size, upload.size - index * upload.chunk_size)
+
+
+def check_size(kind, size):
+
+    if kind not in MAX_SIZE:
+        raise UploadError(f"unknown upload kind {kind!r}")
+
+    if size > MAX_SIZE[kind]:
+        raise UploadError(f"{kind} is larger than {MAX_SIZE[kind]} bytes")
+
+
+def start_upload(chat_id, user, kind, name, size):
+
+    check_size(kind, size)
+
+    if size <= 0:
+        raise UploadError("empty upload")
+
+    upload = Upload.objects.create(
+        chat_id=chat_id,
+        user=user,
+        kind=kind,
+        name=os.path.basename(name) or kind,
+        size=size,
+        chunk_size=CHUNK_SIZE,
+    )
+
+    os.makedirs(upload_dir(), exist_ok=True)
+
+    # sparse on the filesystems we care about, chunks fill it in place
+    with open(part_path(upload), "wb") as fh:
+        fh.truncate(size)
+
+    return upload
+
+
+def write_chunk(upload, index, stream):
+    """
+    Copy one chunk from ``stream`` (the request) to its offset in the
+    part file without holding more than BLOCK_SIZE in memory. Writing
+    the same chunk twice is harmless, so clients can simply retry.
+    """
+
+    if upload.message_id:
+        raise UploadError("upload is already finished")
+
+    if not 0 <= index < chunk_count(upload):
+        raise UploadError(f"chunk {index} is out of range")
+
+    expected = chunk_length(upload, index)
+    remaining = expected
+
+    with open(part_path(upload), "r+b") as fh:
+        fh.seek(index * upload.chunk_size)
+
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            fh.write(block)
+            remaining -= len(block)
+
+    # not recorded, so a short or oversized chunk is simply sent again
+    if remaining or stream.read(1):
+        raise UploadError(f"chunk {index} should be {expected} bytes")
+
+    UploadChunk.objects.get_or_create(upload=upload, index=index)
+
+
+def missing_chunks(upload):
+
+    received = set(upload.chunks.values_list("index", flat=True))
+
+    return [index for index in range(chunk_count(upload)) if index not in received]
+
+
+def hash_file(path):
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def announce(msg, username):
+
+    text = f"📎 File: {msg.file_name}" if msg.file else "🎤 Voice message"
+
+    group_broadcast_sync(f"chat_{msg.chat_id}", message_event(msg, username, text))
+
+
+def create_message(chat_id, user, kind, content):
+    """
+    Create the message for an uploaded file and announce it once committed.
+    """
+
+    with transaction.atomic():
+        msg = Message(chat_id=chat_id, sender=user, file_name=os.path.basename(content.name))
+        getattr(msg, kind).save(content.name, content, save=False)
+        msg.save()
+
+        transaction.on_commit(lambda: announce(msg, user.username))
+
+    return msg
+
+
+def finish_upload(upload):
+
+    with transaction.atomic():
+        # two finish requests racing: the second one waits and sees the message
+        upload = Upload.objects.select_for_update().get(pk=upload.pk)
+
+        if upload.message_id:
+            return upload.message
+
+        if missing_chunks(upload):
+            raise UploadError("upload is incomplete")
+
+        path = part_path(upload)
+
+        upload.sha256 = hash_file(path)
+
+        with PartialFile(path, upload.name, upload.size) as content:
+            content.sha256 = upload.sha256
+            upload.message = create_message(upload.chat_id, upload.user, upload.kind, content)
+
+        upload.save(update_fields=["sha256", "message"])
+        upload.chunks.all().delete()
+
+    # storages that copied instead of moving leave the part file behind
+    discard_part(upload)
+
+    return upload.message
+
+
+def discard_part(upload):
+
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def discard_upload(upload):
+
+    discard_part(upload)
+    upload.delete()
@@ -9,20 +9,33 @@ urlpatterns = [
     path("register/", views.register_view),
     path("logout/", views.logout_view),
 
+    path("chats/", views.chat_list),
+
     path("start/<str:username>/", views.start_private_chat),
 
+    path("search/messages/", views.search_view),
+    path("search/directory/", views.directory_view),
+
+    path("metrics/outbox/", views.outbox_metrics_view),
+
     path("create-group/", views.create_group),
 
     path("chat/<int:chat_id>/", views.chat_room),
+    path("chat/<int:chat_id>/history/", views.chat_history),
     path("chat/<int:chat_id>/add-user/", views.add_user_to_group),
     path("profile/avatar/", views.upload_avatar),
     path("chat/<int:chat_id>/kick/<int:user_id>/", views.kick_user),
 
 path("upload-file/<int:chat_id>/", views.upload_file),
 path("upload-voice/<int:chat_id>/", views.upload_voice),
+path("upload/<int:chat_id>/", views.upload_start),
+path("upload/<uuid:upload_id>/", views.upload_status),
+path("upload/<uuid:upload_id>/<int:index>/", views.upload_chunk),
+path("upload/<uuid:upload_id>/finish/", views.upload_finish),
 path("react/<int:msg_id>/<str:emoji>/", views.react_message),
 
 path("message/delete/<int:msg_id>/", views.delete_message),
 path("message/edit/<int:msg_id>/", views.edit_message),
+path("message/pin/<int:msg_id>/", views.pin_message),
 
 ]  
@@ -1,33 +1,87 @@
 from django.shortcuts import render, redirect
+from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
-from .models import Chat, Message, ChatMember, PinnedMessage, Reaction
+from .models import Chat, Message, ChatMember, Upload
+from . import actions
 from .utils import get_or_create_private_chat
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from .receipts import mark_read_up_to
+from .history import history_page, serialize_message, PAGE_SIZE
+from .feed import get_chat, user_chats, serialize_chat
+from .broadcast import current_seq
+from .outbox import outbox_metrics
+from .membership import is_member
+from .search import search_messages
+from .directory import autocomplete
+from .thumbnails import schedule_thumbnails
+from .storage import publish
+from .uploads import UploadError, check_size, create_message, finish_upload, missing_chunks, start_upload, write_chunk
 
 
 @login_required
 def index(request):
 
-    chats = request.user.chats.all()
+    chats = user_chats(request.user)
 
     q = request.GET.get("q")
 
     users = []
     groups = []
+    found = []
 
     if q:
-        users = User.objects.filter(username__icontains=q).exclude(id=request.user.id)
-        groups = Chat.objects.filter(type="group", name__icontains=q)
+        # префиксный поиск по индексу вместо icontains по всей таблице
+        match = autocomplete(q, user_id=request.user.id)
+        users = match["users"]
+        groups = match["groups"]
+        found, _ = search_messages(request.user.id, q, limit=10)
 
     return render(request, "chat/index.html", {
         "chats": chats,
         "users": users,
-        "groups": groups
+        "groups": groups,
+        "found": found
     })
 
+
+@login_required
+def chat_list(request):
+
+    return JsonResponse({
+        "chats": [serialize_chat(chat) for chat in user_chats(request.user)]
+    })
+
+
+@login_required
+def search_view(request):
+
+    q = request.GET.get("q", "")
+
+    hits, next_cursor = search_messages(request.user.id, q, cursor=request.GET.get("cursor"))
+
+    return JsonResponse({
+        "results": hits,
+        "next_cursor": next_cursor,
+    })
+
+
+@login_required
+def directory_view(request):
+
+    return JsonResponse(autocomplete(request.GET.get("q", ""), user_id=request.user.id))
+
+
+@login_required
+def outbox_metrics_view(request):
+
+    if not request.user.is_staff:
+        return JsonResponse({"error": "forbidden"}, status=403)
+
+    # счётчики только этого процесса, у каждого воркера свои
+    return JsonResponse(outbox_metrics.snapshot())
+
+
 @login_required
 def upload_avatar(request):
 
@@ -40,8 +94,15 @@ def upload_avatar(request):
 
         profile = request.user.profile
         profile.avatar = avatar
+
+        # старые миниатюры больше не нужны, новые соберёт пул в фоне
+        profile.thumbnails = {}
         profile.save()
 
+        publish([profile.avatar.name])
+
+        schedule_thumbnails(profile)
+
         return redirect("/")
 
     return render(request, "chat/avatar.html")
@@ -89,22 +150,51 @@ def create_group(request):
 @login_required
 def chat_room(request, chat_id):
 
-    chat = Chat.objects.get(id=chat_id)
-
-    if request.user not in chat.participants.all():
+    if not is_member(chat_id, request.user.id):
         return redirect("/")
 
-    messages = chat.messages.all().order_by("timestamp")
+    chat = get_chat(chat_id)
+
+    # read before the page, the socket replays whatever is broadcast in between
+    seq = current_seq(chat.id)
+
+    # only the latest page, older ones are streamed on scroll
+    messages, next_cursor = history_page(chat.id)
 
     members = ChatMember.objects.filter(chat=chat)
 
+    if messages:
+        mark_read_up_to(chat.id, request.user.id, messages[-1].id)
+
     return render(request, "chat/chat.html", {
         "chat": chat,
         "messages": messages,
+        "next_cursor": next_cursor,
+        "seq": seq,
         "members": members
     })
 
 
+@login_required
+def chat_history(request, chat_id):
+
+    if not is_member(chat_id, request.user.id):
+        return JsonResponse({"error": "forbidden"}, status=403)
+
+    try:
+        before = int(request.GET.get("before") or 0)
+        limit = int(request.GET.get("limit") or PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({"error": "bad cursor"}, status=400)
+
+    messages, next_cursor = history_page(chat_id, before=before, limit=limit)
+
+    return JsonResponse({
+        "messages": [serialize_message(m) for m in messages],
+        "next_cursor": next_cursor,
+    })
+
+
 def login_view(request):
 
     if request.method == "POST":
@@ -144,12 +234,12 @@ def logout_view(request):
 @login_required
 def add_user_to_group(request, chat_id):
 
-    chat = Chat.objects.get(id=chat_id)
-
     # защита
-    if request.user not in chat.participants.all():
+    if not is_member(chat_id, request.user.id):
         return redirect("/")
 
+    chat = Chat.objects.get(id=chat_id)
+
     if chat.type != "group":
         return redirect("/")
 
@@ -163,7 +253,7 @@ def add_user_to_group(request, chat_id):
             return redirect(f"/chat/{chat_id}/")
 
         # не добавляем дубликат
-        if user in chat.participants.all():
+        if is_member(chat_id, user.id):
             return redirect(f"/chat/{chat_id}/")
 
         chat.participants.add(user)
@@ -206,74 +296,60 @@ def kick_user(request, chat_id, user_id):
     return redirect(f"/chat/{chat_id}/")
 
 
+def back(request):
+
+    # без JS формы возвращают на страницу чата, с JS всё идёт через WebSocket
+    return redirect(request.META.get("HTTP_REFERER") or "/")
+
+
 @login_required
 def delete_message(request, msg_id):
 
-    msg = Message.objects.get(id=msg_id)
-
-    if msg.sender != request.user:
+    try:
+        actions.delete_message(request.user, msg_id)
+    except actions.ActionError:
         return redirect("/")
 
-    msg.is_deleted = True
-    msg.save()
-
-    return redirect(request.META.get("HTTP_REFERER"))
+    return back(request)
 
 
 @login_required
 def edit_message(request, msg_id):
 
-    msg = Message.objects.get(id=msg_id)
-
-    if msg.sender != request.user:
-        return redirect("/")
-
     if request.method == "POST":
-        msg.text = request.POST["text"]
-        msg.save()
+        try:
+            actions.edit_message(request.user, msg_id, request.POST.get("text"))
+        except actions.ActionError:
+            return redirect("/")
 
-    return redirect(request.META.get("HTTP_REFERER"))
+    return back(request)
 
 
 @login_required
 def pin_message(request, msg_id):
 
-    msg = Message.objects.get(id=msg_id)
-
-    PinnedMessage.objects.update_or_create(
-        chat=msg.chat,
-        defaults={"message": msg}
-    )
+    try:
+        actions.pin_message(request.user, msg_id, unpin=request.GET.get("unpin") == "1")
+    except actions.ActionError:
+        return redirect("/")
 
-    return redirect(f"/chat/{msg.chat.id}/")
+    return back(request)
 
 
 @login_required
 def upload_file(request, chat_id):
 
-    if request.method == "POST" and request.FILES.get("file"):
+    if request.method == "POST" and request.FILES.get("file") and is_member(chat_id, request.user.id):
 
         file = request.FILES["file"]
-        chat = Chat.objects.get(id=chat_id)
 
-        msg = Message.objects.create(
-            chat=chat,
-            sender=request.user,
-            file=file
-        )
+        try:
+            check_size("file", file.size)
+        except UploadError:
+            return redirect(f"/chat/{chat_id}/")
 
-        # SEND WS EVENT
-        channel_layer = get_channel_layer()
-
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{chat_id}",
-            {
-                "type": "chat_message",
-                "msg_id": msg.id,
-                "username": request.user.username,
-                "message": f"📎 File: {file.name}",
-            }
-        )
+        # WS событие уходит после коммита
+        create_message(chat_id, request.user, "file", file)
 
     return redirect(f"/chat/{chat_id}/")
 
@@ -281,42 +357,113 @@ def upload_file(request, chat_id):
 @login_required
 def upload_voice(request, chat_id):
 
-    if request.method == "POST" and request.FILES.get("audio"):
+    if request.method == "POST" and request.FILES.get("audio") and is_member(chat_id, request.user.id):
 
         audio = request.FILES["audio"]
-        chat = Chat.objects.get(id=chat_id)
 
-        msg = Message.objects.create(
-            chat=chat,
-            sender=request.user,
-            audio=audio
-        )
+        try:
+            check_size("audio", audio.size)
+        except UploadError:
+            return redirect(f"/chat/{chat_id}/")
 
-        # SEND WS EVENT
-        channel_layer = get_channel_layer()
-
-        async_to_sync(channel_layer.group_send)(
-            f"chat_{chat_id}",
-            {
-                "type": "chat_message",
-                "msg_id": msg.id,
-                "username": request.user.username,
-                "message": "🎤 Voice message",
-            }
-        )
+        create_message(chat_id, request.user, "audio", audio)
 
     return redirect(f"/chat/{chat_id}/")
 
 
+# =========================
+# RESUMABLE UPLOADS
+# =========================
+
+def upload_state(upload):
+    return {
+        "id": str(upload.id),
+        "size": upload.size,
+        "chunk_size": upload.chunk_size,
+        "missing": missing_chunks(upload),
+    }
+
+
 @login_required
-def react_message(request, msg_id, emoji):
+def upload_start(request, chat_id):
 
-    msg = Message.objects.get(id=msg_id)
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
 
-    Reaction.objects.get_or_create(
-        message=msg,
-        user=request.user,
-        emoji=emoji
-    )
+    if not is_member(chat_id, request.user.id):
+        return JsonResponse({"error": "forbidden"}, status=403)
+
+    try:
+        upload = start_upload(
+            chat_id,
+            request.user,
+            request.POST.get("kind", "file"),
+            request.POST.get("name", ""),
+            int(request.POST.get("size", 0)),
+        )
+    except (UploadError, ValueError) as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    return JsonResponse(upload_state(upload), status=201)
+
+
+@login_required
+def upload_status(request, upload_id):
+
+    upload = Upload.objects.filter(id=upload_id, user=request.user).first()
+
+    if upload is None:
+        return JsonResponse({"error": "not found"}, status=404)
+
+    return JsonResponse(upload_state(upload))
+
+
+@login_required
+def upload_chunk(request, upload_id, index):
+
+    if request.method != "PUT":
+        return JsonResponse({"error": "PUT required"}, status=405)
+
+    upload = Upload.objects.filter(id=upload_id, user=request.user).first()
+
+    if upload is None:
+        return JsonResponse({"error": "not found"}, status=404)
+
+    try:
+        write_chunk(upload, index, request)
+    except UploadError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    return JsonResponse({"index": index})
+
+
+@login_required
+def upload_finish(request, upload_id):
+
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+
+    upload = Upload.objects.filter(id=upload_id, user=request.user).first()
+
+    if upload is None:
+        return JsonResponse({"error": "not found"}, status=404)
+
+    try:
+        msg = finish_upload(upload)
+    except UploadError as exc:
+        return JsonResponse({"error": str(exc), **upload_state(upload)}, status=409)
+
+    upload.refresh_from_db()
+
+    return JsonResponse({"message_id": msg.id, "sha256": upload.sha256})
+
+
+@login_required
+def react_message(request, msg_id, emoji):
+
+    try:
+        actions.react(request.user, msg_id, emoji, remove=request.GET.get("remove") == "1")
+    except actions.ActionError:
+        return redirect("/")
 
-    return redirect(f"/chat/{msg.chat.id}/")
+    return back(request)
@@ -10,14 +10,20 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import chat.routing
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 
+# set up Django before importing anything that touches models
+django_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.auth import AuthMiddlewareStack  # noqa: E402
+import chat.routing  # noqa: E402
+from chat.files import FileServer  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    # static and media are answered by FileServer, the rest goes to Django
+    "http": FileServer(django_application),
     "websocket": AuthMiddlewareStack(
         URLRouter(chat.routing.websocket_urlpatterns)
     )
@@ -0,0 +1,86 @@
+"""
+Database profiles for the chat.
+
+Select one with the CHAT_DB_PROFILE environment variable:
+
+* ``sqlite`` (default) - SQLite in WAL mode with tuned pragmas and
+  persistent connections, so readers never wait on the writer and the
+  ChatConsumer thread pool does not reopen the file on every call.
+* ``sqlite-default`` - plain Django SQLite settings, kept as a baseline
+  for ``manage.py bench_db``.
+* ``postgres`` - PostgreSQL through psycopg 3 with a server-side
+  connection pool. Configured with the usual POSTGRES_* variables,
+  needs the ``postgres`` extra (psycopg[pool]).
+"""
+
+import os
+
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -20000,
+    "temp_store": "MEMORY",
+}
+
+
+def sqlite_default(base_dir):
+
+    return {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": base_dir / "db.sqlite3",
+    }
+
+
+def sqlite(base_dir):
+
+    return {
+        **sqlite_default(base_dir),
+        "CONN_MAX_AGE": int(os.environ.get("CHAT_DB_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "init_command": ";".join(f"PRAGMA {name}={value}" for name, value in SQLITE_PRAGMAS.items()),
+            # take the write lock up front instead of failing the upgrade under contention
+            "transaction_mode": "IMMEDIATE",
+        },
+    }
+
+
+def postgres(base_dir):
+
+    return {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("POSTGRES_DB", "chat"),
+        "USER": os.environ.get("POSTGRES_USER", "chat"),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ.get("POSTGRES_HOST", "127.0.0.1"),
+        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+        # pooled connections replace CONN_MAX_AGE, which must stay 0 with a pool
+        "CONN_MAX_AGE": 0,
+        "OPTIONS": {
+            "pool": {
+                "min_size": int(os.environ.get("POSTGRES_POOL_MIN", 2)),
+                "max_size": int(os.environ.get("POSTGRES_POOL_MAX", 20)),
+                "timeout": 10,
+            },
+        },
+    }
+
+
+PROFILES = {
+    "sqlite": sqlite,
+    "sqlite-default": sqlite_default,
+    "postgres": postgres,
+}
+
+
+def database_settings(base_dir, profile=None):
+
+    profile = profile or os.environ.get("CHAT_DB_PROFILE", "sqlite")
+
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown CHAT_DB_PROFILE {profile!r}, use one of {', '.join(PROFILES)}")
+
+    return {"default": PROFILES[profile](base_dir)}
@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from .database import database_settings
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -73,21 +76,100 @@ TEMPLATES = [
 WSGI_APPLICATION = "config.wsgi.application"
 ASGI_APPLICATION = "config.asgi.application"
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+# Comma separated redis:// URLs. With more than one, chat_<id> groups are
+# spread over the hosts on a hash ring. Unset means a single process with
+# the in-memory layer.
+REDIS_URLS = [url.strip() for url in os.environ.get("CHAT_REDIS_URLS", "").split(",") if url.strip()]
+
+if REDIS_URLS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chat.layers.ShardedRedisChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_URLS,
+                "capacity": int(os.environ.get("CHAT_CHANNEL_CAPACITY", 1000)),
+            },
+        }
+    }
+
+    # unread counters and other per-member caches must be shared by all workers
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URLS[0],
+        }
     }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        }
+    }
+
+# Chat
+# read acks are coalesced in memory and written in bulk at this interval (seconds)
+CHAT_RECEIPT_FLUSH_INTERVAL = 0.5
+# unread counters are served from the cache, falling back to ChatReadState
+CHAT_UNREAD_CACHE_TIMEOUT = 300
+# chat_room renders the latest page only, older pages are loaded on scroll
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+# membership checks: per-process LRU (positive answers only), then the
+# shared cache when one is configured, then an EXISTS query
+CHAT_MEMBERSHIP_CACHE_SIZE = 10000
+CHAT_MEMBERSHIP_CACHE_TTL = 30
+CHAT_MEMBERSHIP_SHARED_CACHE = bool(REDIS_URLS)
+# Profile.online / last_seen are written in batches on real transitions only
+CHAT_PRESENCE_FLUSH_INTERVAL = 2
+# each worker holds a key per connected user for this long (seconds), refreshed
+# every third of it; users of a crashed worker go offline within about this long
+CHAT_PRESENCE_TTL = 60
+# incoming WebSocket messages are inserted with bulk_create, a batch is
+# written when it is full or its first message has waited this long (seconds)
+CHAT_INGEST_MAX_BATCH = 100
+CHAT_INGEST_MAX_LATENCY = 0.005
+# typing: one broadcast per user per chat per RATE_LIMIT seconds, each socket
+# gets at most one "who is typing" snapshot per SNAPSHOT_INTERVAL, a typist
+# expires TTL seconds after their last event
+CHAT_TYPING_RATE_LIMIT = 2.0
+CHAT_TYPING_SNAPSHOT_INTERVAL = 0.5
+CHAT_TYPING_TTL = 3.0
+# a message's reaction counts are broadcast by each worker, and sent by each
+# socket, at most once per window (seconds)
+CHAT_REACTION_WINDOW = 0.25
+# each worker keeps the last REPLAY_SIZE events of up to REPLAY_CHATS chats
+# for reconnecting sockets, see chat/replay.py
+CHAT_REPLAY_SIZE = 256
+CHAT_REPLAY_CHATS = 1000
+# per-socket outbound queue, see chat/outbox.py: above HIGH queued events
+# typing/presence/unread are dropped until it drains to LOW; a socket at
+# LIMIT events or congested for MAX_STALL seconds is disconnected
+# at most WINDOW frames go to send() ahead of the client's acks, the rest waits
+# in the queue, so the limits hold under Daphne too
+CHAT_OUTBOX_WINDOW = 64
+CHAT_OUTBOX_HIGH_WATERMARK = 256
+CHAT_OUTBOX_LOW_WATERMARK = 64
+CHAT_OUTBOX_LIMIT = 1024
+CHAT_OUTBOX_MAX_STALL = 10.0
+# message search, see chat/search.py
+CHAT_SEARCH_PAGE_SIZE = 20
+# user and group autocomplete, see chat/directory.py
+CHAT_DIRECTORY_LIMIT = 10
+# resumable uploads, see chat/uploads.py; sizes in bytes
+CHAT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHAT_UPLOAD_MAX_SIZE = {
+    "file": 50 * 1024 * 1024,
+    "audio": 10 * 1024 * 1024,
 }
+# avatar thumbnail widths in px, rendered by a background pool
+CHAT_AVATAR_SIZES = (48, 128, 256)
+CHAT_THUMBNAIL_WORKERS = 2
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
-    }
-}
+# profile is picked with CHAT_DB_PROFILE, see config/database.py
+DATABASES = database_settings(BASE_DIR)
 
 
 # Password validation
@@ -131,6 +213,17 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 MEDIA_URL = "media/"
 MEDIA_ROOT = BASE_DIR / "media"
 
+# media is stored once per content hash, see chat/storage.py
+STORAGES = {
+    "default": {
+        "BACKEND": "chat.storage.ContentAddressedStorage",
+    },
+    # hashed names after collectstatic, cached as immutable by chat/files.py
+    "staticfiles": {
+        "BACKEND": "chat.storage.HashedStaticStorage",
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
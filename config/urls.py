@@ -17,8 +17,6 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
-from django.conf.urls.static import static
-from django.conf import settings
 
 
 urlpatterns = [
@@ -26,5 +24,4 @@ urlpatterns = [
     path("", include("chat.urls"))
 ]
 
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+# STATIC_URL and MEDIA_URL are served by chat.files.FileServer in config/asgi.py
@@ -3,6 +3,161 @@ let recorder = null;
 let audioChunks = [];
 let typingTimeout = null;
 let reconnectTimer = null;
+let loadingOlder = false;
+// chat id -> sequence number of the last event seen, sent back on reconnect
+const lastSeq = {};
+
+// the server sends at most a window of frames ahead of these acks, see chat/outbox.py
+function frameAcker(ws) {
+
+ let received = 0;
+ let timer = null;
+
+ return () => {
+   received += 1;
+
+   if(timer) return;
+
+   // one ack per burst
+   timer = setTimeout(() => {
+     timer = null;
+     if(ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify({action:"ack", frames:received}));
+   }, 20);
+ };
+}
+
+function renderReactions(box, reactions) {
+
+ box.replaceChildren(...Object.entries(reactions || {}).map(([emoji, count]) => {
+   const span = document.createElement("span");
+   span.className = "reaction";
+   span.textContent = `${emoji} ${count}`;
+   return span;
+ }));
+}
+
+function renderMessage(data, username) {
+
+ const div = document.createElement("div");
+ div.classList.add("message");
+ div.dataset.id = data.id;
+
+ const mine = data.username === username;
+ div.classList.add(mine ? "me" : "other");
+
+ // stored text goes in through textContent only, like the server-rendered page escapes it
+ const sender = document.createElement("div");
+ sender.className = "sender";
+ sender.textContent = mine ? "You" : data.username;
+
+ const body = document.createElement("div");
+ body.className = "body";
+
+ if(data.deleted) body.innerHTML = "<i>Deleted</i>";
+ else if(data.file){
+   // the file name is whatever the uploader called it
+   const link = document.createElement("a");
+   link.href = data.file;
+   link.textContent = `📎 ${data.file_name || data.file.split("/").pop()}`;
+   body.appendChild(link);
+ }
+ else if(data.audio){
+   const audio = document.createElement("audio");
+   audio.className = "audio";
+   audio.controls = true;
+   audio.src = data.audio;
+   body.appendChild(audio);
+ }
+ else body.textContent = data.message || "";
+
+ div.append(sender, body);
+
+ if(data.edited && !data.deleted){
+   div.insertAdjacentHTML("beforeend", `<span class="edited">edited</span>`);
+ }
+
+ const reactions = document.createElement("div");
+ reactions.className = "reactions";
+ renderReactions(reactions, data.reactions);
+ div.appendChild(reactions);
+
+ if(!data.deleted){
+   // ids are numbers from the server, the rest is fixed markup
+   const id = Number(data.id);
+   let actions = `<button onclick="reactTo(${id}, '👍')">👍</button>`
+     + `<button onclick="pinMessage(${id})">📌</button>`;
+   if(mine){
+     actions += `<button onclick="editMessage(${id})">✏️</button>`
+       + `<button onclick="deleteMessage(${id})">🗑</button>`;
+   }
+   div.insertAdjacentHTML("beforeend", `<div class="msg-actions">${actions}</div>`);
+ }
+
+ return div;
+}
+
+function findMessage(id) {
+ return document.querySelector(`.message[data-id="${id}"]`);
+}
+
+function eventSeq(data) {
+ if(data.seq) return data.seq;
+ for(const kind of ["edit", "delete", "reactions", "pin"]){
+   if(data[kind]) return data[kind].seq;
+ }
+ return 0;
+}
+
+// ================= UPLOADS =================
+
+const UPLOAD_PARALLEL = 3;
+
+async function uploadChunked(chatId, csrf, kind, blob, name) {
+
+ const headers = {"X-CSRFToken":csrf};
+
+ const form = new FormData();
+ form.append("kind", kind);
+ form.append("name", name);
+ form.append("size", blob.size);
+
+ let res = await fetch(`/upload/${chatId}/`, {method:"POST", body:form, headers});
+ let state = await res.json();
+
+ if(!res.ok) throw new Error(state.error);
+
+ // a few rounds: whatever failed is still listed as missing and sent again
+ for(let round = 0; round < 3 && state.missing.length; round++){
+
+   const queue = [...state.missing];
+
+   const worker = async ()=>{
+     while(queue.length){
+       const index = queue.shift();
+       const start = index * state.chunk_size;
+
+       try{
+         await fetch(`/upload/${state.id}/${index}/`, {
+           method:"PUT",
+           body:blob.slice(start, start + state.chunk_size),
+           headers
+         });
+       } catch(err){
+         console.warn("Chunk failed", index, err);
+       }
+     }
+   };
+
+   await Promise.all(Array.from({length:UPLOAD_PARALLEL}, worker));
+
+   res = await fetch(`/upload/${state.id}/`);
+   state = await res.json();
+ }
+
+ res = await fetch(`/upload/${state.id}/finish/`, {method:"POST", headers});
+
+ if(!res.ok) throw new Error((await res.json()).error);
+}
 
 function initChat(chatId, username, csrf) {
 
@@ -16,6 +171,7 @@ function initChat(chatId, username, csrf) {
  const wsUrl = `${protocol}://${location.host}/ws/chat/${chatId}/`;
 
  socket = new WebSocket(wsUrl);
+ const ack = frameAcker(socket);
 
  const chatBox = document.getElementById("chat-box");
  const typingBox = document.getElementById("typing");
@@ -25,8 +181,19 @@ function initChat(chatId, username, csrf) {
    if(chatBox) chatBox.scrollTop = chatBox.scrollHeight;
  };
 
+ if(lastSeq[chatId] === undefined) lastSeq[chatId] = Number(chatBox?.dataset.seq || 0);
+
  socket.onopen = () => {
    console.log("WS connected");
+
+   // whatever was broadcast since the page was rendered or the socket dropped
+   const shown = chatBox ? chatBox.querySelectorAll(".message") : [];
+   socket.send(JSON.stringify({
+     action:"resume",
+     seq:lastSeq[chatId],
+     last_id:shown.length ? shown[shown.length - 1].dataset.id : 0
+   }));
+
    scrollBottom();
  };
 
@@ -42,6 +209,8 @@ function initChat(chatId, username, csrf) {
 
  socket.onmessage = (e) => {
 
+   ack();
+
    let data;
    try {
      data = JSON.parse(e.data);
@@ -49,6 +218,8 @@ function initChat(chatId, username, csrf) {
      return;
    }
 
+   lastSeq[chatId] = Math.max(lastSeq[chatId], eventSeq(data));
+
    // unread badge update
    if(data.unread_count !== undefined){
 
@@ -66,42 +237,150 @@ function initChat(chatId, username, csrf) {
      return;
    }
 
-   // typing
-   if(data.typing){
-     typingBox.innerText = data.username + " is typing...";
+   // older history page
+   if(data.history !== undefined){
+
+     const oldHeight = chatBox.scrollHeight;
+     const first = chatBox.firstChild;
+
+     data.history.forEach(msg => chatBox.insertBefore(renderMessage(msg, username), first));
+
+     chatBox.dataset.cursor = data.next_cursor || "";
+     loadingOlder = false;
+
+     // keep the viewport on the message the user was looking at
+     chatBox.scrollTop += chatBox.scrollHeight - oldHeight;
+
      return;
    }
 
-   typingBox.innerText = "";
+   // missed messages from the database, when the server no longer had the events
+   if(data.replay !== undefined){
+
+     if(!data.replay.complete){
+       location.reload();
+       return;
+     }
+
+     data.replay.messages.forEach(msg => {
+       if(!findMessage(msg.id)) chatBox.appendChild(renderMessage(msg, username));
+     });
+
+     lastSeq[chatId] = data.replay.seq;
+     scrollBottom();
+
+     return;
+   }
+
+   // edit / delete / reactions / pin deltas for messages on screen
+   if(data.edit !== undefined){
+
+     const div = findMessage(data.edit.id);
+
+     if(div){
+       div.querySelector(".body").textContent = data.edit.message;
+       if(!div.querySelector(".edited")){
+         div.querySelector(".body").insertAdjacentHTML("afterend", `<span class="edited">edited</span>`);
+       }
+     }
+
+     return;
+   }
+
+   if(data.delete !== undefined){
 
-   const div = document.createElement("div");
-   div.classList.add("message");
+     const div = findMessage(data.delete.id);
 
-   if(data.username === username){
-     div.classList.add("me");
-     div.innerHTML = `<div class="sender">You</div>${data.message || ""}`;
-   } else {
-     div.classList.add("other");
-     div.innerHTML = `<div class="sender">${data.username}</div>${data.message || ""}`;
+     if(div){
+       div.querySelector(".body").innerHTML = "<i>Deleted</i>";
+       div.querySelector(".edited")?.remove();
+       div.querySelector(".msg-actions")?.remove();
+     }
+
+     return;
+   }
+
+   if(data.reactions !== undefined){
+
+     const div = findMessage(data.reactions.id);
+
+     if(div) renderReactions(div.querySelector(".reactions"), data.reactions.reactions);
+
+     return;
+   }
+
+   if(data.pin !== undefined){
+
+     const bar = document.getElementById("pinned");
+
+     if(bar){
+       bar.hidden = data.pin.id === null;
+       bar.dataset.id = data.pin.id || "";
+       bar.querySelector(".pinned-text").textContent = data.pin.id === null ? "" : `${data.pin.username}: ${data.pin.message}`;
+     }
+
+     return;
    }
 
-   chatBox.appendChild(div);
+   // presence delta for another participant
+   if(data.presence !== undefined){
+
+     const status = document.querySelector(`.presence[data-user="${data.presence.user_id}"]`);
+
+     if(status){
+       status.innerText = data.presence.online ? "🟢 online" : `last seen ${data.presence.last_seen}`;
+     }
+
+     return;
+   }
+
+   // typing snapshot, an empty list clears the indicator
+   if(data.typing_users !== undefined){
+
+     const names = data.typing_users;
+
+     if(!names.length) typingBox.innerText = "";
+     else if(names.length === 1) typingBox.innerText = names[0] + " is typing...";
+     else typingBox.innerText = names.join(", ") + " are typing...";
+
+     return;
+   }
+
+   typingBox.innerText = "";
+
+   // replayed after a reconnect and already on screen
+   if(findMessage(data.id)) return;
+
+   chatBox.appendChild(renderMessage(data, username));
    scrollBottom();
  };
 
+ // load older pages when scrolled to the top
+ if(chatBox){
+   chatBox.onscroll = () => {
+
+     if(chatBox.scrollTop > 40 || loadingOlder || !chatBox.dataset.cursor) return;
+     if(socket.readyState !== WebSocket.OPEN) return;
+
+     loadingOlder = true;
+     socket.send(JSON.stringify({action:"load_older", before:chatBox.dataset.cursor}));
+   };
+ }
+
  // typing debounce
  if(input){
    input.oninput = () => {
 
      if(socket.readyState !== WebSocket.OPEN) return;
 
-     socket.send(JSON.stringify({typing:true}));
+     // the server rate limits too, this just saves frames
+     if(typingTimeout) return;
 
-     clearTimeout(typingTimeout);
+     socket.send(JSON.stringify({typing:true}));
 
      typingTimeout = setTimeout(()=>{
-       typingBox.innerText="";
-     },1200);
+       typingTimeout = null;
+     },1000);
    };
 
    input.onkeydown = (e)=>{
@@ -125,19 +404,41 @@ function initChat(chatId, username, csrf) {
    input.value="";
  };
 
+ // message actions go over the socket, the result comes back as a delta
+ const act = (action, id, extra={}) => {
+   if(socket.readyState === WebSocket.OPEN){
+     socket.send(JSON.stringify({action, id, ...extra}));
+   }
+ };
+
+ window.reactTo = (id, emoji) => act("react", id, {emoji});
+
+ window.pinMessage = id => act("pin", id);
+
+ window.unpinMessage = () => {
+   const id = document.getElementById("pinned")?.dataset.id;
+   if(id) act("unpin", Number(id));
+ };
+
+ window.editMessage = id => {
+   const current = findMessage(id)?.querySelector(".body")?.textContent.trim() || "";
+   const text = prompt("Edit message", current);
+   if(text && text !== current) act("edit", id, {text});
+ };
+
+ window.deleteMessage = id => {
+   if(confirm("Delete this message?")) act("delete", id);
+ };
+
  window.sendFile = () => {
 
    const fileInput=document.getElementById("fileInput");
    if(!fileInput?.files[0]) return;
 
-   const form=new FormData();
-   form.append("file",fileInput.files[0]);
+   const file=fileInput.files[0];
 
-   fetch(`/upload-file/${chatId}/`,{
-     method:"POST",
-     body:form,
-     headers:{"X-CSRFToken":csrf}
-   });
+   uploadChunked(chatId, csrf, "file", file, file.name)
+     .catch(err=>console.warn("Upload error",err));
 
    fileInput.value="";
  };
@@ -157,15 +458,9 @@ function initChat(chatId, username, csrf) {
      recorder.onstop = ()=>{
 
        const blob = new Blob(audioChunks,{type:"audio/webm"});
-       const form = new FormData();
 
-       form.append("audio",blob);
-
-       fetch(`/upload-voice/${chatId}/`,{
-         method:"POST",
-         body:form,
-         headers:{"X-CSRFToken":csrf}
-       });
+       uploadChunked(chatId, csrf, "audio", blob, "voice.webm")
+         .catch(err=>console.warn("Upload error",err));
      };
 
      setTimeout(()=>{
@@ -179,6 +474,183 @@ function initChat(chatId, username, csrf) {
 
 }
 
+// ================= CHAT LIST =================
+
+function chatListItem(chat) {
+
+ const a = document.createElement("a");
+ a.href = `/chat/${chat.id}/`;
+ a.className = "chat-item";
+ a.dataset.chat = chat.id;
+ a.innerHTML = `<div class="chat-avatar">${chat.type === "group" ? "👥" : "👤"}</div>`
+   + `<div class="chat-info"><b></b><span class="last-msg"></span></div>`
+   + `<div class="chat-meta"></div>`;
+ a.querySelector("b").textContent = chat.type === "group" ? chat.name : "Private Chat";
+
+ const last = chat.last_message;
+ if(last) setLastMessage(a, last.username, last.deleted ? null : last.message, last.time);
+ else a.querySelector(".last-msg").textContent = "No messages yet";
+
+ setUnread(a, chat.unread);
+
+ return a;
+}
+
+function setLastMessage(item, username, text, time) {
+
+ const preview = item.querySelector(".last-msg");
+
+ if(text === null) preview.innerHTML = "<i>Deleted</i>";
+ else preview.textContent = `${username}: ${text.length > 30 ? text.slice(0, 29) + "…" : text}`;
+
+ let clock = item.querySelector(".chat-time");
+ if(!clock){
+   clock = document.createElement("span");
+   clock.className = "chat-time";
+   item.querySelector(".chat-meta").prepend(clock);
+ }
+ clock.textContent = time;
+}
+
+function setUnread(item, count) {
+
+ let badge = item.querySelector(".unread-count");
+
+ if(!count){
+   badge?.remove();
+   return;
+ }
+
+ if(!badge){
+   badge = document.createElement("span");
+   badge.className = "unread-count";
+   item.querySelector(".chat-meta").appendChild(badge);
+ }
+ badge.textContent = count;
+}
+
+async function reloadChatList(list) {
+
+ const res = await fetch("/chats/");
+ const data = await res.json();
+
+ list.querySelectorAll(".chat-item, .empty-sidebar").forEach(el => el.remove());
+ data.chats.forEach(chat => list.appendChild(chatListItem(chat)));
+}
+
+// one socket for every chat of the user, see UserConsumer
+function initChatList() {
+
+ const list = document.querySelector(".chat-list");
+
+ if(!list) return;
+
+ const protocol = location.protocol === "https:" ? "wss" : "ws";
+ const listSocket = new WebSocket(`${protocol}://${location.host}/ws/user/`);
+ const ack = frameAcker(listSocket);
+
+ listSocket.onclose = () => setTimeout(initChatList, 1200);
+
+ listSocket.onmessage = (e) => {
+
+   ack();
+
+   let data;
+   try {
+     data = JSON.parse(e.data);
+   } catch {
+     return;
+   }
+
+   // added to or removed from a chat
+   if(data.membership !== undefined){
+     reloadChatList(list);
+     return;
+   }
+
+   if(data.chat_id === undefined) return;
+
+   const item = list.querySelector(`.chat-item[data-chat="${data.chat_id}"]`);
+   const event = data.event;
+
+   if(!item) return;
+
+   if(event.unread_count !== undefined){
+     setUnread(item, event.unread_count);
+     return;
+   }
+
+   // a new message: fresh preview, and the chat moves to the top
+   if(event.time !== undefined && event.username !== undefined){
+     setLastMessage(item, event.username, event.message, event.time);
+     list.querySelector(".rooms-section-title").after(item);
+   }
+ };
+}
+
+// ================= DIRECTORY SEARCH =================
+
+function directoryItem(href, icon, title, hint) {
+
+ const a = document.createElement("a");
+ a.href = href;
+ a.className = "chat-item";
+ a.innerHTML = `<div class="chat-avatar">${icon}</div><div class="chat-info"><b></b><span class="last-msg"></span></div>`;
+ a.querySelector("b").textContent = title;
+ a.querySelector(".last-msg").textContent = hint;
+
+ return a;
+}
+
+function initDirectorySearch() {
+
+ const input = document.querySelector(".search-box input");
+ const list = document.querySelector(".chat-list");
+
+ if(!input || !list) return;
+
+ const original = list.innerHTML;
+ let timer = null;
+ let latest = 0;
+
+ input.addEventListener("input", ()=>{
+
+   clearTimeout(timer);
+
+   timer = setTimeout(async ()=>{
+
+     const q = input.value.trim();
+     const request = ++latest;
+
+     if(!q){
+       list.innerHTML = original;
+       return;
+     }
+
+     const res = await fetch(`/search/directory/?q=${encodeURIComponent(q)}`);
+     const data = await res.json();
+
+     // an older, slower response must not overwrite a newer one
+     if(request !== latest) return;
+
+     list.innerHTML = `<div class="rooms-section-title">Search results</div>`;
+
+     data.users.forEach(u=>{
+       list.appendChild(directoryItem(`/start/${encodeURIComponent(u.username)}/`, "👤", u.username, "Start private chat"));
+     });
+
+     data.groups.forEach(g=>{
+       list.appendChild(directoryItem(`/chat/${g.id}/`, "👥", g.name, "Open group"));
+     });
+
+     if(!data.users.length && !data.groups.length){
+       list.insertAdjacentHTML("beforeend", `<div class="empty-sidebar">Nothing found, press Enter to search messages</div>`);
+     }
+
+   }, 150);
+ });
+}
+
 // ================= UI =================
 
 window.toggleTheme = ()=>{